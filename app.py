@@ -1,7 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g, Response, has_request_context
+import click
 import sqlite3
 import os
+import json
+import base64
+import glob
+import hashlib
+import hmac
+import logging
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from io import BytesIO
+from logging.handlers import RotatingFileHandler
 from werkzeug.utils import secure_filename
 
 # ✅ NEW: ensure correct MIME types for videos
@@ -12,13 +30,20 @@ mimetypes.add_type("video/quicktime", ".mov")
 
 # ✅ R2 / S3 client (install: pip install boto3)
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 
+# optional: image derivatives (thumbnails / WebP / blur placeholders) need Pillow
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = ImageOps = None
+
 app = Flask(__name__)
 app.secret_key = "change-me-in-prod"
 DB_NAME = "users.db"
 
-# ---- Local Upload settings (kept as fallback if R2 is not configured) ----
+# ---- Local Upload settings (LocalStorage root; see STORAGE BACKENDS) ----
 UPLOAD_FOLDER = os.path.join("static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
@@ -30,12 +55,17 @@ POST_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp", "mp4", "mov"}
 AVATAR_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 
 # =========================================================
-# R2 CONFIG (Python-only integration, no template changes)
+# STORAGE BACKENDS
+#
+# Routes only talk to `storage`. Blobs live under keys like
+# "media/<sha256>.jpg"; the DB stores storage.path_for_key(key):
+#   r2      /r2/<key>              (redirects to a signed URL)
+#   local   /static/uploads/<key>  (served by Flask static)
+#   memory  /mem/<key>             (process memory; benchmarks / load tests)
 #
-# You store paths like: /r2/<key>
-# The /r2/<key> route redirects to a signed URL.
+# STORAGE_BACKEND picks one; default is r2 when the R2_* vars are set, else local.
 #
-# Env vars required:
+# R2 env vars:
 #   R2_ENDPOINT_URL="https://<account_id>.r2.cloudflarestorage.com"
 #   R2_ACCESS_KEY_ID="..."
 #   R2_SECRET_ACCESS_KEY="..."
@@ -49,80 +79,286 @@ R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 R2_BUCKET = os.getenv("R2_BUCKET")
 R2_SIGNED_URL_EXPIRES = int(os.getenv("R2_SIGNED_URL_EXPIRES", "3600"))
 
-_s3 = None
-if all([R2_ENDPOINT_URL, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET]):
-    _s3 = boto3.client(
+# server-side uploads (R2Storage.put): files above the threshold go up as
+# multipart uploads, R2_MULTIPART_CONCURRENCY parts at a time
+_MB = 1024 * 1024
+R2_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(float(os.getenv("R2_MULTIPART_THRESHOLD_MB", "16")) * _MB),
+    multipart_chunksize=int(float(os.getenv("R2_MULTIPART_CHUNKSIZE_MB", "16")) * _MB),
+    max_concurrency=int(os.getenv("R2_MULTIPART_CONCURRENCY", "4")),
+    use_threads=True,
+)
+# parallel showcase uploads x multipart parts share the client's HTTP pool
+R2_MAX_POOL_CONNECTIONS = int(os.getenv("R2_MAX_POOL_CONNECTIONS", "32"))
+
+
+class StorageBackend(ABC):
+    """What routes need from blob storage. Keys are relative ("media/ab12.jpg")."""
+    name = ""
+    path_prefix = ""
+    signs_urls = False  # media URLs must go through sign() (else the path is the URL)
+    supports_presigned_put = False  # browser -> storage direct uploads
+
+    def path_for_key(self, key: str) -> str:
+        return self.path_prefix + key.lstrip("/")
+
+    def key_for_path(self, path: str | None) -> str | None:
+        if path and path.startswith(self.path_prefix):
+            return path[len(self.path_prefix):]
+        return None
+
+    @abstractmethod
+    def put(self, key: str, fileobj, content_type: str, cache_control: str | None = None) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        ...
+
+    def delete(self, key: str) -> None:
+        errors = self.delete_many([key])
+        if errors:
+            raise RuntimeError(errors[key])
+
+    @abstractmethod
+    def delete_many(self, keys: list[str]) -> dict:
+        """Returns {key: error} for keys that failed; raises if the whole call fails.
+        Missing keys count as deleted."""
+
+    def sign(self, key: str, expires_seconds: int) -> str:
+        return self.path_for_key(key)
+
+    @abstractmethod
+    def stat(self, key: str):
+        """(size, content_type) of a blob, or None if it does not exist."""
+
+    def presign_put(self, key: str, content_type: str, expires_seconds: int) -> str:
+        """Only for backends with supports_presigned_put."""
+        raise NotImplementedError(f"{self.name} storage has no presigned uploads")
+
+
+class R2Storage(StorageBackend):
+    name = "r2"
+    path_prefix = "/r2/"
+    signs_urls = True
+    supports_presigned_put = True
+
+    def __init__(self, client, bucket: str):
+        self.client = client
+        self.bucket = bucket
+
+    def put(self, key, fileobj, content_type, cache_control=None):
+        extra = {"ContentType": content_type}
+        if cache_control:
+            extra["CacheControl"] = cache_control
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra, Config=R2_TRANSFER_CONFIG)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def delete_many(self, keys):
+        # one DeleteObjects call per 1000 keys
+        errors = {}
+        for i in range(0, len(keys), 1000):
+            resp = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]], "Quiet": True},
+            )
+            errors.update(
+                {e.get("Key"): f"{e.get('Code')}: {e.get('Message')}" for e in resp.get("Errors", [])}
+            )
+        return errors
+
+    def sign(self, key, expires_seconds):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=expires_seconds,
+        )
+
+    def stat(self, key):
+        try:
+            meta = self.client.head_object(Bucket=self.bucket, Key=key)
+        except Exception:
+            return None
+        return meta.get("ContentLength", 0), meta.get("ContentType", "")
+
+    def presign_put(self, key, content_type, expires_seconds):
+        # Content-Type is part of the signature, so the PUT must send exactly this type
+        return self.client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": self.bucket, "Key": key, "ContentType": content_type},
+            ExpiresIn=expires_seconds,
+        )
+
+
+class LocalStorage(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+        self.path_prefix = "/" + root.replace(os.sep, "/").strip("/") + "/"
+
+    def _file(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError("invalid storage key")
+        return path
+
+    def put(self, key, fileobj, content_type, cache_control=None):
+        dest = self._file(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = f"{dest}.{os.urandom(4).hex()}.tmp"
+        with open(tmp, "wb") as fh:
+            shutil.copyfileobj(fileobj, fh)
+        os.replace(tmp, dest)  # readers never see a half-written blob
+
+    def get(self, key):
+        with open(self._file(key), "rb") as fh:
+            return fh.read()
+
+    def delete_many(self, keys):
+        errors = {}
+        for key in keys:
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                errors[key] = repr(e)
+        return errors
+
+    def stat(self, key):
+        try:
+            size = os.path.getsize(self._file(key))
+        except (OSError, ValueError):
+            return None
+        return size, mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+
+class MemoryStorage(StorageBackend):
+    """Blobs in a dict; lets upload paths be benchmarked without R2 or disk I/O."""
+    name = "memory"
+    path_prefix = "/mem/"
+
+    def __init__(self):
+        self.blobs = {}  # key -> (bytes, content_type)
+        self._lock = threading.Lock()
+
+    def put(self, key, fileobj, content_type, cache_control=None):
+        data = fileobj.read()
+        with self._lock:
+            self.blobs[key] = (data, content_type)
+
+    def get(self, key):
+        with self._lock:
+            return self.blobs[key][0]
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self.blobs.pop(key, None)
+        return {}
+
+    def stat(self, key):
+        with self._lock:
+            blob = self.blobs.get(key)
+        return (len(blob[0]), blob[1]) if blob else None
+
+
+def _make_storage() -> StorageBackend:
+    r2_configured = all([R2_ENDPOINT_URL, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET])
+    backend = (os.getenv("STORAGE_BACKEND") or ("r2" if r2_configured else "local")).lower()
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "local":
+        return LocalStorage(UPLOAD_FOLDER)
+    if backend != "r2":
+        raise RuntimeError(f"unknown STORAGE_BACKEND {backend!r}")
+    if not r2_configured:
+        raise RuntimeError("STORAGE_BACKEND=r2 but R2 is not configured (missing env vars).")
+    client = boto3.client(
         "s3",
         endpoint_url=R2_ENDPOINT_URL,
         aws_access_key_id=R2_ACCESS_KEY_ID,
         aws_secret_access_key=R2_SECRET_ACCESS_KEY,
         region_name="auto",
-        config=Config(signature_version="s3v4"),
+        config=Config(signature_version="s3v4", max_pool_connections=R2_MAX_POOL_CONNECTIONS),
     )
+    return R2Storage(client, R2_BUCKET)
 
 
-def r2_enabled() -> bool:
-    return _s3 is not None
+class MeteredStorage:
+    """Wraps a backend and records call counts and latency per operation (/metrics)."""
 
+    def __init__(self, inner: StorageBackend):
+        self.inner = inner
 
-def r2_make_key(prefix: str, filename: str) -> str:
-    # Example: posts/post_u1_...jpg
-    return f"{prefix.strip('/')}/{filename}"
+    def __getattr__(self, attr):
+        # name, path_prefix, signs_urls, path_for_key(), key_for_path(), ...
+        return getattr(self.inner, attr)
 
+    def _call(self, op: str, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
+            result = fn(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            labels = (("backend", self.inner.name), ("op", op))
+            metrics.inc("bandme_storage_calls_total", labels + (("outcome", outcome),))
+            metrics.observe("bandme_storage_call_duration_seconds", labels, time.perf_counter() - t0)
 
-def r2_path_for_key(key: str) -> str:
-    # What you store in DB so templates can use it directly
-    return f"/r2/{key.lstrip('/')}"
+    def put(self, key, fileobj, content_type, cache_control=None):
+        return self._call("put", self.inner.put, key, fileobj, content_type, cache_control)
 
+    def get(self, key):
+        return self._call("get", self.inner.get, key)
 
-def r2_key_from_db_path(path: str | None) -> str | None:
-    if not path:
-        return None
-    if path.startswith("/r2/"):
-        return path[len("/r2/") :]
-    return None
+    def delete(self, key):
+        return self._call("delete", self.inner.delete, key)
 
+    def delete_many(self, keys):
+        return self._call("delete_many", self.inner.delete_many, keys)
 
-def r2_upload(file_storage, key: str) -> None:
-    if not r2_enabled():
-        raise RuntimeError("R2 not configured (missing env vars).")
+    def sign(self, key, expires_seconds):
+        return self._call("sign", self.inner.sign, key, expires_seconds)
 
-    content_type = mimetypes.guess_type(file_storage.filename)[0] or "application/octet-stream"
-    _s3.upload_fileobj(
-        file_storage.stream,
-        R2_BUCKET,
-        key,
-        ExtraArgs={"ContentType": content_type},
-    )
+    def stat(self, key):
+        return self._call("stat", self.inner.stat, key)
 
+    def presign_put(self, key, content_type, expires_seconds):
+        return self._call("presign_put", self.inner.presign_put, key, content_type, expires_seconds)
 
-def r2_delete_key(key: str) -> None:
-    if not r2_enabled() or not key:
-        return
-    try:
-        _s3.delete_object(Bucket=R2_BUCKET, Key=key)
-    except Exception:
-        # Avoid crashing requests on delete errors
-        pass
 
+storage = MeteredStorage(_make_storage())
 
-def r2_signed_get_url(key: str, expires_seconds: int = R2_SIGNED_URL_EXPIRES) -> str:
-    if not r2_enabled():
-        raise RuntimeError("R2 not configured (missing env vars).")
-    return _s3.generate_presigned_url(
-        "get_object",
-        Params={"Bucket": R2_BUCKET, "Key": key},
-        ExpiresIn=expires_seconds,
-    )
+
+def storage_key(prefix: str, filename: str) -> str:
+    # Example: media/3f2a...9c.jpg
+    return f"{prefix.strip('/')}/{filename}"
 
 
-# ✅ Signed URL redirect route (templates can use /r2/<key> as src/href)
+# ✅ Media paths that are not static files (templates can use /r2/<key> as src/href)
 @app.route("/r2/<path:key>")
-def r2_proxy(key):
-    if not r2_enabled():
-        return "R2 not configured", 500
-    url = r2_signed_get_url(key)
-    return redirect(url)
+@app.route("/mem/<path:key>")
+def storage_blob(key):
+    """Redirect to a signed URL, or serve the bytes when the backend has no URLs of its own."""
+    if storage.key_for_path(request.path) is None:
+        return "Not found", 404  # a path of a backend that is not active
+
+    if storage.signs_urls:
+        url, max_age = signed_url_cached(key)
+        resp = redirect(url)
+        # the redirect is per signature, so the browser may reuse it while the URL is valid
+        resp.headers["Cache-Control"] = f"private, max-age={max_age}" if max_age else "private, no-cache"
+        return resp
+
+    meta = storage.stat(key)
+    if meta is None:
+        return "Not found", 404
+    return Response(storage.get(key), mimetype=meta[1])
 
 
 def allowed_file(filename: str) -> bool:
@@ -145,28 +381,1126 @@ def _unique_upload_name(prefix: str, user_id: int, original_filename: str) -> st
     return f"{prefix}_u{user_id}_{ts}_{rand}{ext.lower()}"
 
 
+# ---- Content-addressed uploads ----
+# Form uploads are hashed while they are read and stored as media/<sha256><ext>
+# (R2) or static/uploads/<sha256><ext>, so the same file posted again is one
+# blob. media_objects counts the rows (avatar / post / showcase item) that point
+# at each stored path; see media_ref() / media_unref().
+MEDIA_HASH_CHUNK = 1024 * 1024
+MEDIA_SPOOL_MAX_MEMORY = int(os.getenv("MEDIA_SPOOL_MAX_MEMORY_MB", "8")) * 1024 * 1024
+SHOWCASE_UPLOAD_WORKERS = int(os.getenv("SHOWCASE_UPLOAD_WORKERS", "4"))
+MEDIA_DELETE_WAIT_POLL = 0.2  # seconds between checks while a leased delete of the same blob finishes
+# A blob whose last reference goes waits this long in the delete queue. A request
+# that saw it stored (and skipped the upload) takes its reference well within
+# gunicorn's timeout; media_ref then cancels the still-unleased delete.
+MEDIA_DELETE_GRACE_SECONDS = float(os.getenv("MEDIA_DELETE_GRACE_SECONDS", "120"))
+
+
+class PreparedUpload:
+    """A form file read into a spooled temp file, with its content-addressed path."""
+    __slots__ = ("spool", "path", "content_type")
+
+    def __init__(self, spool, path: str, content_type: str):
+        self.spool = spool
+        self.path = path
+        self.content_type = content_type
+
+
+def prepare_upload(file_storage) -> PreparedUpload:
+    """Hash the upload while spooling it; the path is derived from the digest."""
+    _, ext = os.path.splitext(secure_filename(file_storage.filename))
+    spool = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_MEMORY)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file_storage.stream.read(MEDIA_HASH_CHUNK), b""):
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+
+    path = storage.path_for_key(storage_key("media", digest.hexdigest() + ext.lower()))
+    return PreparedUpload(spool, path, upload_content_type(file_storage.filename))
+
+
+def _write_prepared(up: PreparedUpload):
+    storage.put(storage.key_for_path(up.path), up.spool, up.content_type)
+
+
+def _stored_media_paths(conn, paths) -> set:
+    """Paths among these that already have a live blob (safe to reuse)."""
+    paths = list(dict.fromkeys(paths))
+    found = set()
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        qmarks = ",".join(["?"] * len(chunk))
+        rows = conn.execute(
+            f"SELECT path FROM media_objects WHERE path IN ({qmarks}) AND refcount > 0", chunk
+        ).fetchall()
+        found.update(r["path"] for r in rows)
+    return found
+
+
+def _settle_queued_deletes(paths):
+    """Make sure no queued delete can remove these blobs once they are rewritten.
+
+    A queued delete of the same content is cancelled. One the worker has
+    already leased may be running delete_many right now, so wait for it to
+    settle (at most R2_DELETE_LEASE_SECONDS) and write afterwards.
+    """
+    keys = list(dict.fromkeys(k for k in (storage.key_for_path(p) for p in paths) if k))
+    if not keys:
+        return
+    conn = connect_db()
+    try:
+        while keys:
+            qmarks = ",".join(["?"] * len(keys))
+            if not conn.execute(f"SELECT 1 FROM r2_delete_queue WHERE key IN ({qmarks}) LIMIT 1", keys).fetchone():
+                return
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(f"""
+                DELETE FROM r2_delete_queue
+                WHERE key IN ({qmarks}) AND (leased_until IS NULL OR leased_until < ?)
+            """, keys + [now])
+            keys = [r["key"] for r in conn.execute(f"SELECT key FROM r2_delete_queue WHERE key IN ({qmarks})", keys)]
+            conn.commit()
+            if keys:
+                time.sleep(MEDIA_DELETE_WAIT_POLL)
+    finally:
+        conn.close()
+
+
+def store_upload(file_storage) -> str:
+    """Store one form file; returns its media path. The transfer is skipped when
+    the same content is already stored. Caller records the reference (media_ref)."""
+    up = prepare_upload(file_storage)
+    with up.spool:
+        if up.path not in _stored_media_paths(get_db(), [up.path]):
+            _settle_queued_deletes([up.path])
+            _write_prepared(up)
+    return up.path
+
+
+def store_showcase_files(files) -> list[str]:
+    """Store form files as showcase media, new blobs in parallel; returns media
+    paths in input order. If any upload fails, the ones that made it are queued
+    for deletion and it raises."""
+    if not files:
+        return []
+
+    prepared = [prepare_upload(f) for f in files]
+    try:
+        known = _stored_media_paths(get_db(), [up.path for up in prepared])
+        todo = list({up.path: up for up in prepared if up.path not in known}.values())
+        _settle_queued_deletes([up.path for up in todo])
+
+        with ThreadPoolExecutor(max_workers=max(1, min(SHOWCASE_UPLOAD_WORKERS, len(todo) or 1))) as pool:
+            futures = [pool.submit(_write_prepared, up) for up in todo]
+        errors = [fut.exception() for fut in futures]
+
+        if any(errors):
+            uploaded = [storage.key_for_path(up.path) for up, err in zip(todo, errors) if err is None]
+            if uploaded:
+                # nothing references these yet; the queue worker removes them
+                queue_storage_delete(get_db(), uploaded)
+                get_db().commit()
+            raise next(e for e in errors if e)
+    finally:
+        for up in prepared:
+            up.spool.close()
+
+    return [up.path for up in prepared]
+
+
+def _is_managed_media(path: str | None) -> bool:
+    # paths of the configured backend (not /static/img defaults or another backend's paths)
+    return storage.key_for_path(path) is not None
+
+
+def media_ref(conn, paths):
+    """Count one more reference per path, in the transaction that stores it."""
+    paths = [p for p in paths if _is_managed_media(p)]
+    if not paths:
+        return
+    conn.executemany("""
+        INSERT INTO media_objects (path, refcount) VALUES (?, 1)
+        ON CONFLICT(path) DO UPDATE SET refcount = refcount + 1
+    """, [(p,) for p in paths])
+    # a blob whose last reference just went may still be waiting in the delete queue
+    # (rewritten blobs were taken out by _settle_queued_deletes before the write)
+    conn.executemany(
+        "DELETE FROM r2_delete_queue WHERE key = ? AND leased_until IS NULL",
+        [(storage.key_for_path(p),) for p in paths],
+    )
+
+
+def media_unref(conn, paths):
+    """Drop one reference per path; blobs left without references (and their
+    variants) go to the delete queue."""
+    dead = []
+    for p in paths:
+        if not _is_managed_media(p):
+            continue
+        row = conn.execute(
+            "UPDATE media_objects SET refcount = refcount - 1 WHERE path = ? RETURNING refcount", (p,)
+        ).fetchone()
+        # untracked paths have nothing else pointing at them
+        if row is None or row["refcount"] <= 0:
+            dead.append(p)
+
+    dead = list(dict.fromkeys(dead))
+    conn.executemany("DELETE FROM media_objects WHERE path = ? AND refcount <= 0", [(p,) for p in dead])
+    queue_storage_delete(conn, [storage.key_for_path(p) for p in dead], delay=MEDIA_DELETE_GRACE_SECONDS)
+
+
+# ---- Direct uploads (presigned PUT + finalize; backends with supports_presigned_put) ----
+# The browser PUTs the file straight to R2 under a key we choose; the worker only
+# signs the URL and HEADs the object afterwards. Forms then send the key
+# (media_key / icon_key / media_keys) instead of the file.
+R2_PRESIGNED_PUT_EXPIRES = int(os.getenv("R2_PRESIGNED_PUT_EXPIRES", "900"))
+# presigned but never used by a form: object + row are removed after this
+UPLOAD_PENDING_TTL_SECONDS = int(os.getenv("UPLOAD_PENDING_TTL_SECONDS", str(24 * 3600)))
+
+# kind -> (filename prefix, storage key prefix, allowed extensions, max bytes)
+UPLOAD_KINDS = {
+    "post": ("post", "posts", POST_EXTENSIONS,
+             int(os.getenv("UPLOAD_MAX_POST_BYTES", str(500 * 1024 * 1024)))),
+    "avatar": ("avatar", "avatars", AVATAR_EXTENSIONS,
+               int(os.getenv("UPLOAD_MAX_AVATAR_BYTES", str(10 * 1024 * 1024)))),
+    "showcase": ("showcase", "showcase", POST_EXTENSIONS,
+                 int(os.getenv("UPLOAD_MAX_SHOWCASE_BYTES", str(500 * 1024 * 1024)))),
+}
+
+_uploads_swept_at = 0.0
+
+
+def upload_content_type(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def _verify_uploaded_object(row) -> int:
+    """HEAD the object behind a pending_uploads row; returns its size or raises ValueError."""
+    _, _, _, max_bytes = UPLOAD_KINDS[row["kind"]]
+    head = storage.stat(row["key"])
+    if head is None:
+        raise ValueError("upload not found")
+    size, content_type = head
+    if size <= 0 or size > max_bytes:
+        raise ValueError("upload too large" if size > max_bytes else "upload is empty")
+    if content_type.split(";")[0].strip().lower() != row["content_type"].lower():
+        raise ValueError("upload content type mismatch")
+    return size
+
+
+def _discard_pending_upload(conn, key: str):
+    queue_storage_delete(conn, [key])
+    conn.execute("DELETE FROM pending_uploads WHERE key = ?", (key,))
+
+
+def claim_upload(conn, user_id: int, kind: str, key: str) -> str:
+    """Turn my finished upload into a media path (raises ValueError). Caller commits
+    the claim; a failed check's discard is committed here if no transaction is open."""
+    c = conn.cursor()
+    c.execute("SELECT * FROM pending_uploads WHERE key = ? AND user_id = ? AND kind = ?", (key, user_id, kind))
+    row = c.fetchone()
+    if not row:
+        raise ValueError("unknown upload")
+
+    # the client may skip /api/uploads/finalize; check here then
+    if row["finalized_at"] is None:
+        try:
+            _verify_uploaded_object(row)
+        except ValueError:
+            # callers usually answer 400 without committing; commit the discard here
+            # unless it joins a transaction the caller goes on to commit
+            outside_tx = not conn.in_transaction
+            _discard_pending_upload(conn, key)
+            if outside_tx:
+                conn.commit()
+            raise
+
+    c.execute("DELETE FROM pending_uploads WHERE key = ?", (key,))
+    return storage.path_for_key(key)
+
+
+def _sweep_pending_uploads(conn, limit: int = 50):
+    # at most once a minute per worker; abandoned uploads are rare
+    global _uploads_swept_at
+
+    now = time.monotonic()
+    if now - _uploads_swept_at < 60:
+        return
+    _uploads_swept_at = now
+
+    c = conn.cursor()
+    c.execute("""
+        SELECT key FROM pending_uploads
+        WHERE created_at < datetime('now', ?)
+        ORDER BY created_at
+        LIMIT ?
+    """, (f"-{UPLOAD_PENDING_TTL_SECONDS} seconds", limit))
+    for r in c.fetchall():
+        _discard_pending_upload(conn, r["key"])
+
+
+@app.route("/api/uploads/presign", methods=["POST"])
+def api_upload_presign():
+    if "user_id" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    if not storage.supports_presigned_put:
+        # local / memory storage: the client falls back to a normal multipart form post
+        return jsonify({"error": "direct upload unavailable"}), 409
+
+    me = session["user_id"]
+    data = request.get_json(force=True) or {}
+    kind = data.get("kind")
+    filename = (data.get("filename") or "").strip()
+
+    spec = UPLOAD_KINDS.get(kind)
+    if not spec:
+        return jsonify({"error": "invalid kind"}), 400
+    name_prefix, key_prefix, extensions, max_bytes = spec
+
+    if "." not in filename or filename.rsplit(".", 1)[1].lower() not in extensions:
+        return jsonify({"error": "invalid file type"}), 400
+
+    try:
+        size = int(data.get("size"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid size"}), 400
+    if size <= 0:
+        return jsonify({"error": "invalid size"}), 400
+    if size > max_bytes:
+        return jsonify({"error": "file too large", "max_bytes": max_bytes}), 413
+
+    key = storage_key(key_prefix, _unique_upload_name(name_prefix, me, filename))
+    content_type = upload_content_type(filename)
+
+    conn = get_db()
+    conn.execute(
+        "INSERT INTO pending_uploads (key, user_id, kind, content_type) VALUES (?, ?, ?, ?)",
+        (key, me, kind, content_type),
+    )
+    _sweep_pending_uploads(conn)
+    conn.commit()
+
+    return jsonify({
+        "key": key,
+        "url": storage.presign_put(key, content_type, R2_PRESIGNED_PUT_EXPIRES),
+        "method": "PUT",
+        "headers": {"Content-Type": content_type},
+        "expires_in": R2_PRESIGNED_PUT_EXPIRES,
+    })
+
+
+@app.route("/api/uploads/finalize", methods=["POST"])
+def api_upload_finalize():
+    if "user_id" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    if not storage.supports_presigned_put:
+        return jsonify({"error": "direct upload unavailable"}), 409
+
+    me = session["user_id"]
+    data = request.get_json(force=True) or {}
+    key = (data.get("key") or "").strip()
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM pending_uploads WHERE key = ? AND user_id = ?", (key, me))
+    row = c.fetchone()
+    if not row:
+        return jsonify({"error": "unknown upload"}), 404
+
+    try:
+        size = _verify_uploaded_object(row)
+    except ValueError as e:
+        _discard_pending_upload(conn, key)
+        conn.commit()
+        return jsonify({"error": str(e)}), 400
+
+    c.execute(
+        "UPDATE pending_uploads SET finalized_at = CURRENT_TIMESTAMP, size = ? WHERE key = ?",
+        (size, key),
+    )
+    conn.commit()
+
+    return jsonify({"key": key, "media_path": storage.path_for_key(key), "size": size})
+
+
+# ---- Storage delete queue (durable, drained by a background thread per worker) ----
+# Handlers only insert keys into r2_delete_queue in their own transaction; the
+# worker leases up to R2_DELETE_BATCH_SIZE due rows, makes one
+# storage.delete_many() call and retries failures with exponential backoff.
+# Leases let several gunicorn workers drain the same table without double work.
+# (Table and setting names predate the storage backends; they cover every backend.)
+R2_DELETE_BATCH_SIZE = min(1000, int(os.getenv("R2_DELETE_BATCH_SIZE", "1000")))
+R2_DELETE_POLL_INTERVAL = float(os.getenv("R2_DELETE_POLL_INTERVAL", "5"))
+R2_DELETE_LEASE_SECONDS = int(os.getenv("R2_DELETE_LEASE_SECONDS", "120"))
+R2_DELETE_BACKOFF_BASE = float(os.getenv("R2_DELETE_BACKOFF_BASE", "10"))
+R2_DELETE_BACKOFF_MAX = float(os.getenv("R2_DELETE_BACKOFF_MAX", "3600"))
+
+_storage_delete_wakeup = threading.Event()
+_storage_delete_worker_pid = None
+_storage_delete_worker_lock = threading.Lock()
+
+
+def queue_storage_delete(conn, keys, delay: float = 0):
+    """Schedule blobs for deletion, due delay seconds from now; happens after the caller commits."""
+    keys = [k for k in dict.fromkeys(keys) if k]
+    if not keys:
+        return
+
+    # derived WebP variants go with their source
+    sources = [storage.path_for_key(k) for k in keys]
+    for i in range(0, len(sources), 500):
+        chunk = sources[i:i + 500]
+        qmarks = ",".join(["?"] * len(chunk))
+        rows = conn.execute(f"SELECT path FROM media_variants WHERE source_path IN ({qmarks})", chunk).fetchall()
+        keys.extend(k for k in (storage.key_for_path(r["path"]) for r in rows) if k)
+        conn.execute(f"DELETE FROM media_variants WHERE source_path IN ({qmarks})", chunk)
+
+    for k in keys:
+        signed_url_cache.pop(k)
+    due = time.time() + delay
+    conn.executemany(
+        "INSERT OR IGNORE INTO r2_delete_queue (key, next_attempt_at) VALUES (?, ?)", [(k, due) for k in keys]
+    )
+    g.storage_delete_queued = True
+
+
+@app.teardown_appcontext
+def wake_storage_delete_worker(exc):
+    if g.pop("storage_delete_queued", False) and exc is None:
+        _storage_delete_wakeup.set()
+
+
+def _storage_delete_backoff(attempts: int) -> float:
+    return min(R2_DELETE_BACKOFF_MAX, R2_DELETE_BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+
+
+def process_storage_delete_batch(conn) -> int:
+    """Lease, delete and settle one batch; returns how many keys were leased."""
+    now = time.time()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    # never delete a blob that was referenced again after it was queued; checked in
+    # the leasing transaction, so no reference can land between check and lease
+    c.execute("""
+        DELETE FROM r2_delete_queue
+        WHERE (leased_until IS NULL OR leased_until < ?)
+          AND EXISTS (
+            SELECT 1 FROM media_objects m
+            WHERE m.path = ? || r2_delete_queue.key AND m.refcount > 0
+          )
+    """, (now, storage.path_prefix))
+    c.execute("""
+        UPDATE r2_delete_queue
+        SET leased_until = ?
+        WHERE id IN (
+            SELECT id FROM r2_delete_queue
+            WHERE next_attempt_at <= ?
+              AND (leased_until IS NULL OR leased_until < ?)
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+        )
+        RETURNING id, key, attempts
+    """, (now + R2_DELETE_LEASE_SECONDS, now, now, R2_DELETE_BATCH_SIZE))
+    rows = c.fetchall()
+    conn.commit()
+    leased = len(rows)
+    if not rows:
+        return 0
+
+    # last check right before deleting: a key referenced again while it sat in
+    # the queue keeps its blob (uploads of the same content also wait for the lease)
+    live = _stored_media_paths(conn, [storage.path_for_key(r["key"]) for r in rows])
+    if live:
+        kept = [r for r in rows if storage.path_for_key(r["key"]) in live]
+        rows = [r for r in rows if storage.path_for_key(r["key"]) not in live]
+        c.executemany("DELETE FROM r2_delete_queue WHERE id = ?", [(r["id"],) for r in kept])
+        conn.commit()
+        if not rows:
+            return leased
+
+    try:
+        errors = storage.delete_many([r["key"] for r in rows])
+    except Exception as e:
+        errors = {r["key"]: repr(e) for r in rows}
+
+    done = [(r["id"],) for r in rows if r["key"] not in errors]
+    failed = [r for r in rows if r["key"] in errors]
+
+    c.execute("BEGIN IMMEDIATE")
+    c.executemany("DELETE FROM r2_delete_queue WHERE id = ?", done)
+    c.executemany("""
+        UPDATE r2_delete_queue
+        SET attempts = ?, next_attempt_at = ?, leased_until = NULL, last_error = ?
+        WHERE id = ?
+    """, [
+        (r["attempts"] + 1, time.time() + _storage_delete_backoff(r["attempts"] + 1), errors[r["key"]][:500], r["id"])
+        for r in failed
+    ])
+    conn.commit()
+
+    if failed:
+        app.logger.warning("storage delete: %d of %d keys failed, will retry", len(failed), len(rows))
+    return leased
+
+
+def _storage_delete_worker():
+    while True:
+        leased = 0
+        try:
+            conn = connect_db()
+            try:
+                leased = process_storage_delete_batch(conn)
+            finally:
+                conn.close()
+        except Exception:
+            app.logger.exception("storage delete worker failed")
+
+        # a full batch means more is probably due; otherwise sleep until woken
+        if leased < R2_DELETE_BATCH_SIZE:
+            _storage_delete_wakeup.wait(R2_DELETE_POLL_INTERVAL)
+            _storage_delete_wakeup.clear()
+
+
+def start_storage_delete_worker():
+    """Start the drain thread once per process (after gunicorn forks)."""
+    global _storage_delete_worker_pid
+    if _storage_delete_worker_pid == os.getpid():
+        return
+    with _storage_delete_worker_lock:
+        if _storage_delete_worker_pid == os.getpid():
+            return
+        _storage_delete_worker_pid = os.getpid()
+        threading.Thread(target=_storage_delete_worker, name="storage-delete", daemon=True).start()
+
+
+@app.before_request
+def _ensure_background_workers():
+    start_storage_delete_worker()
+
+
+# ---- DB connections ----
+# One connection per request context (flask.g), opened lazily and closed on teardown.
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(16 * 1024)))
+
+
+def connect_db():
+    """Open a tuned connection. Routes use get_db(); this is for startup/background work."""
+    conn = sqlite3.connect(DB_NAME, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, factory=MeteredConnection)
+    conn.row_factory = sqlite3.Row
+    conn.set_trace_callback(_trace_sql)
+    # WAL is switched on once in init_db(); these are per-connection
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    return conn
+
+
+def get_db():
+    if "db" not in g:
+        g.db = connect_db()
+    return g.db
+
+
+@app.teardown_appcontext
+def close_db(exc):
+    # uncommitted work (error paths) is rolled back by close()
+    conn = g.pop("db", None)
+    if conn is not None:
+        conn.close()
+
+
+# ======================= METRICS =======================
+# Per-worker counters and histograms, served in Prometheus text format on
+# /metrics. Requests are timed in before/after_request; every connection from
+# connect_db() counts statements with a trace callback and times execute/fetch
+# through _TimedCursor. With METRICS_DIR set (one dir shared by the gunicorn
+# workers), each worker writes a snapshot there every METRICS_FLUSH_SECONDS and
+# /metrics sums all of them; gauges only come from live workers.
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+# set: /metrics wants "Authorization: Bearer <token>"; unset: loopback clients only
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# name -> (type, help, histogram buckets)
+METRIC_DEFS = {
+    "bandme_http_requests_total": ("counter", "HTTP requests by endpoint, method and status.", None),
+    "bandme_http_request_duration_seconds": ("histogram", "Request latency by endpoint.", _LATENCY_BUCKETS),
+    "bandme_request_sql_queries": ("histogram", "SQL statements run per request.", _QUERY_BUCKETS),
+    "bandme_request_sql_seconds": ("histogram", "Time spent in SQLite per request.", _LATENCY_BUCKETS),
+    "bandme_storage_calls_total": ("counter", "Storage backend calls by operation and outcome.", None),
+    "bandme_storage_call_duration_seconds": ("histogram", "Storage backend call latency.", _LATENCY_BUCKETS),
+    "bandme_cache_hits_total": ("counter", "In-process cache hits.", None),
+    "bandme_cache_misses_total": ("counter", "In-process cache misses.", None),
+    "bandme_cache_hit_ratio": ("gauge", "Cache hits / lookups across workers.", None),
+    "bandme_cache_entries": ("gauge", "Entries held in the in-process caches (live workers).", None),
+    "bandme_slow_queries_total": ("counter", "Statements slower than SLOW_QUERY_MS, by endpoint.", None),
+}
+
+
+class Metrics:
+    """Thread-safe counters and histograms keyed by (name, label pairs)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # key -> [count per bucket..., sum, count]
+
+    def inc(self, name: str, labels: tuple, value: float = 1.0):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        buckets = METRIC_DEFS[name][2]
+        key = (name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    def snapshot(self) -> dict:
+        """JSON-able state of this worker, plus cache stats read now."""
+        with self._lock:
+            counters = [[n, list(lbl), v] for (n, lbl), v in self.counters.items()]
+            histograms = [[n, list(lbl), list(h)] for (n, lbl), h in self.histograms.items()]
+        gauges = []
+        for name, cache in _metered_caches().items():
+            lbl = [("cache", name)]
+            counters.append(["bandme_cache_hits_total", lbl, cache.hits])
+            counters.append(["bandme_cache_misses_total", lbl, cache.misses])
+            gauges.append(["bandme_cache_entries", lbl, len(cache._data)])
+        return {"pid": os.getpid(), "counters": counters, "histograms": histograms, "gauges": gauges}
+
+
+metrics = Metrics()
+_request_sql = threading.local()  # queries / seconds of the request on this thread
+_metrics_flushed_at = 0.0
+
+
+def _metered_caches() -> dict:
+    return {"feed": feed_cache, "user_card": user_card_cache, "signed_url": signed_url_cache}
+
+
+def _trace_sql(sql: str):
+    # trigger bodies arrive as "-- ..."; FTS5 reads its shadow tables as 'main'.'posts_fts_...';
+    # EXPLAIN comes from the slow-query log, not the request
+    if (getattr(_request_sql, "active", False) and not sql.startswith(("PRAGMA", "--", "EXPLAIN"))
+            and "'main'." not in sql):
+        _request_sql.queries += 1
+
+
+def _add_sql_time(seconds: float):
+    if getattr(_request_sql, "active", False):
+        _request_sql.seconds += seconds
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that adds time spent in execute/fetch to the current request.
+
+    It also keeps the total for its current statement (execute plus every
+    fetch) and hands slow ones to log_slow_query() once they are finished:
+    exhausted, replaced by the next execute, closed or garbage collected.
+    """
+
+    _stmt = None  # (sql, parameters, many) of the statement being timed
+    _stmt_seconds = 0.0
+
+    def _timed(self, method, *args):
+        t0 = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - t0
+            _add_sql_time(elapsed)
+            self._stmt_seconds += elapsed
+
+    def _begin_statement(self, sql, parameters, many: bool):
+        self._end_statement()
+        self._stmt = (sql, parameters, many)
+        self._stmt_seconds = 0.0
+
+    def _end_statement(self):
+        stmt = self._stmt
+        if stmt is None:
+            return
+        self._stmt = None
+        if SLOW_QUERY_MS > 0 and self._stmt_seconds * 1000 >= SLOW_QUERY_MS:
+            log_slow_query(self.connection, *stmt, self._stmt_seconds)
+
+    def execute(self, sql, parameters=()):
+        self._begin_statement(sql, parameters, False)
+        return self._timed(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # a generator is consumed by the call; only lists are kept for EXPLAIN
+        kept = seq_of_parameters if isinstance(seq_of_parameters, (list, tuple)) else None
+        self._begin_statement(sql, kept, True)
+        return self._timed(sqlite3.Cursor.executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        row = self._timed(sqlite3.Cursor.fetchone)
+        if row is None:
+            self._end_statement()
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._timed(sqlite3.Cursor.fetchmany, *args)
+        if not rows:
+            self._end_statement()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(sqlite3.Cursor.fetchall)
+        self._end_statement()
+        return rows
+
+    def __next__(self):
+        try:
+            return self._timed(sqlite3.Cursor.__next__)
+        except StopIteration:
+            self._end_statement()
+            raise
+
+    def close(self):
+        self._end_statement()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._end_statement()
+        except Exception:
+            pass
+
+
+class MeteredConnection(sqlite3.Connection):
+    # Connection.execute() would bypass the cursor factory, so route it through cursor()
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+@app.before_request
+def _metrics_start_request():
+    _request_sql.active = True
+    _request_sql.queries = 0
+    _request_sql.seconds = 0.0
+    g.metrics_t0 = time.perf_counter()
+
+
+@app.after_request
+def _metrics_finish_request(resp):
+    global _metrics_flushed_at
+
+    t0 = g.pop("metrics_t0", None)
+    if t0 is None:
+        return resp
+    elapsed = time.perf_counter() - t0
+    endpoint = request.endpoint or "unmatched"
+    labels = (("endpoint", endpoint),)
+
+    metrics.inc("bandme_http_requests_total",
+                labels + (("method", request.method), ("status", str(resp.status_code))))
+    metrics.observe("bandme_http_request_duration_seconds", labels, elapsed)
+    metrics.observe("bandme_request_sql_queries", labels, _request_sql.queries)
+    metrics.observe("bandme_request_sql_seconds", labels, _request_sql.seconds)
+    _request_sql.active = False
+
+    if METRICS_DIR and time.monotonic() - _metrics_flushed_at >= METRICS_FLUSH_SECONDS:
+        _metrics_flushed_at = time.monotonic()
+        try:
+            flush_metrics()
+        except OSError:
+            app.logger.warning("writing metrics snapshot failed", exc_info=True)
+    return resp
+
+
+def flush_metrics() -> dict:
+    """Write this worker's snapshot to METRICS_DIR (atomically); returns it."""
+    snap = metrics.snapshot()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"worker-{snap['pid']}.json")
+    tmp = f"{path}.{os.urandom(4).hex()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(snap, fh)
+    os.replace(tmp, path)
+    return snap
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _collect_snapshots() -> list:
+    """[(snapshot, live)] for this worker and, with METRICS_DIR, every other one."""
+    if not METRICS_DIR:
+        return [(metrics.snapshot(), True)]
+
+    own = flush_metrics()
+    snaps = [(own, True)]
+    for fn in os.listdir(METRICS_DIR):
+        if not (fn.startswith("worker-") and fn.endswith(".json")) or fn == f"worker-{own['pid']}.json":
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, fn), encoding="utf-8") as fh:
+                snap = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        # counters of exited workers still count; their gauges do not
+        snaps.append((snap, _pid_alive(snap["pid"])))
+    return snaps
+
+
+def _prom_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _prom_labels(labels, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render_metrics(snaps) -> str:
+    counters, gauges, histograms = {}, {}, {}
+    for snap, live in snaps:
+        for name, labels, value in snap["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0.0) + value
+        for name, labels, h in snap["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            acc = histograms.setdefault(key, [0] * len(h))
+            for i, v in enumerate(h):
+                acc[i] += v
+        if live:
+            for name, labels, value in snap["gauges"]:
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0.0) + value
+
+    for name in _metered_caches():
+        lbl = (("cache", name),)
+        hits = counters.get(("bandme_cache_hits_total", lbl), 0.0)
+        lookups = hits + counters.get(("bandme_cache_misses_total", lbl), 0.0)
+        gauges[("bandme_cache_hit_ratio", lbl)] = hits / lookups if lookups else 0.0
+
+    series = {}
+    for (name, labels), value in list(counters.items()) + list(gauges.items()):
+        series.setdefault(name, []).append(f"{name}{_prom_labels(labels)} {value:g}")
+    for (name, labels), h in histograms.items():
+        buckets = METRIC_DEFS[name][2]
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, n in zip(buckets, h):
+            cumulative += n
+            lines.append(f"{name}_bucket{_prom_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+        lines.append(f"{name}_bucket{_prom_labels(labels, [('le', '+Inf')])} {h[-1]}")
+        lines.append(f"{name}_sum{_prom_labels(labels)} {h[-2]:.6f}")
+        lines.append(f"{name}_count{_prom_labels(labels)} {h[-1]}")
+
+    out = []
+    for name, (kind, help_text, _) in METRIC_DEFS.items():
+        if name in series:
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(sorted(series[name]))
+    return "\n".join(out) + "\n"
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            return "unauthorized", 401
+    elif request.remote_addr not in ("127.0.0.1", "::1"):
+        # route names, DB timings and storage errors are not for the public
+        return "forbidden", 403
+    return Response(render_metrics(_collect_snapshots()), mimetype="text/plain; version=0.0.4")
+
+
+# ======================= SLOW QUERY LOG =======================
+# Statements that take longer than SLOW_QUERY_MS (execute + fetch, measured by
+# _TimedCursor) are written as JSON lines to a rotating log with their
+# normalized SQL, parameter shape, route and EXPLAIN QUERY PLAN.
+# RotatingFileHandler cannot share one file between processes, so each gunicorn
+# worker writes and rotates its own: SLOW_QUERY_LOG=slow_queries.log becomes
+# slow_queries.<pid>.log. `flask slow-queries` reads all of them and groups by
+# statement to show which filter combinations need an index. SLOW_QUERY_MS=0
+# turns it off.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_LOG_MAX_BYTES = int(os.getenv("SLOW_QUERY_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv("SLOW_QUERY_LOG_BACKUPS", "5"))
+
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_SQL_PARAM_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+
+_slow_query_logger = None
+_slow_query_logger_pid = None
+_slow_query_logger_lock = threading.Lock()
+
+
+def normalize_sql(sql: str) -> str:
+    """One line, literals as ?, and IN (?, ?, ...) lists of any length alike."""
+    text = " ".join(sql.split())
+    text = _SQL_STRING_RE.sub("?", text)
+    text = _SQL_NUMBER_RE.sub("?", text)
+    return _SQL_PARAM_LIST_RE.sub("?, ...", text)
+
+
+def sql_fingerprint(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+def param_shape(parameters) -> list | dict:
+    """Types of the bound values, run-length encoded: ["int", "str x2", "int x500"]."""
+    if parameters is None:
+        return []
+    if isinstance(parameters, dict):
+        return {k: type(v).__name__ for k, v in parameters.items()}
+    shape = []
+    prev, n = None, 0
+    for v in parameters:
+        name = type(v).__name__
+        if name == prev:
+            n += 1
+            continue
+        if prev is not None:
+            shape.append(prev if n == 1 else f"{prev} x{n}")
+        prev, n = name, 1
+    if prev is not None:
+        shape.append(prev if n == 1 else f"{prev} x{n}")
+    return shape
+
+
+def explain_query_plan(conn, sql: str, parameters) -> list[str]:
+    """EXPLAIN QUERY PLAN lines, indented by depth; [] when it cannot be explained."""
+    if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return []
+    try:
+        # a plain cursor: EXPLAIN is neither timed nor logged itself
+        rows = conn.cursor(sqlite3.Cursor).execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ()).fetchall()
+    except sqlite3.Error:
+        return []
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+def plan_full_scans(plan) -> list[str]:
+    """Tables read without any index ("SCAN posts", not "SCAN posts USING INDEX ...").
+
+    Names are as the plan shows them: aliases, and CTEs scanned as a whole.
+    """
+    tables = []
+    for line in plan:
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == "SCAN":
+            tables.append(parts[1])
+    return tables
+
+
+def slow_query_log_file(pid: int) -> str:
+    root, ext = os.path.splitext(SLOW_QUERY_LOG)
+    return f"{root}.{pid}{ext}"
+
+
+def _get_slow_query_logger() -> logging.Logger:
+    global _slow_query_logger, _slow_query_logger_pid
+    pid = os.getpid()
+    # a logger set up before gunicorn forked still points at the parent's file
+    if _slow_query_logger_pid != pid:
+        with _slow_query_logger_lock:
+            if _slow_query_logger_pid != pid:
+                logger = logging.getLogger("bandme.slow_sql")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                for old in list(logger.handlers):
+                    logger.removeHandler(old)
+                    old.close()
+                handler = RotatingFileHandler(
+                    slow_query_log_file(pid), maxBytes=SLOW_QUERY_LOG_MAX_BYTES,
+                    backupCount=SLOW_QUERY_LOG_BACKUPS, encoding="utf-8", delay=True,
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger.addHandler(handler)
+                _slow_query_logger = logger
+                _slow_query_logger_pid = pid
+    return _slow_query_logger
+
+
+def log_slow_query(conn, sql: str, parameters, many: bool, seconds: float):
+    normalized = normalize_sql(sql)
+    if has_request_context():
+        route, method = request.endpoint or "unmatched", request.method
+    else:
+        route, method = f"({threading.current_thread().name})", None
+
+    if many:
+        rows = parameters or []
+        first = rows[0] if rows else None
+        shape = {"rows": len(rows) if parameters is not None else None, "row": param_shape(first)}
+    else:
+        first = parameters
+        shape = param_shape(parameters)
+    plan = explain_query_plan(conn, sql, first)
+
+    record = {
+        "ts": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "ms": round(seconds * 1000, 3),
+        "fingerprint": sql_fingerprint(normalized),
+        "sql": normalized,
+        "params": shape,
+        "route": route,
+        "method": method,
+        "plan": plan,
+        "full_scans": plan_full_scans(plan),
+        "pid": os.getpid(),
+    }
+    metrics.inc("bandme_slow_queries_total", (("endpoint", route),))
+    try:
+        _get_slow_query_logger().info(json.dumps(record, ensure_ascii=False))
+    except Exception:
+        app.logger.warning("writing slow query log failed", exc_info=True)
+
+
+def slow_query_log_files(path: str) -> list[str]:
+    """Every worker's log (<root>.<pid><ext>) and its rotated backups, oldest first per worker."""
+    root, ext = os.path.splitext(path)
+    files = []
+    for current in sorted(glob.glob(f"{glob.escape(root)}.*{glob.escape(ext)}")):
+        if not current[len(root) + 1:len(current) - len(ext)].isdigit():
+            continue
+        files.extend(f"{current}.{i}" for i in range(SLOW_QUERY_LOG_BACKUPS, 0, -1))
+        files.append(current)
+    return [fn for fn in files if os.path.exists(fn)]
+
+
+def read_slow_query_log(path: str):
+    """Records from all workers' logs and their rotated backups."""
+    for fn in slow_query_log_files(path):
+        with open(fn, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by rotation
+
+
+def summarize_slow_queries(records) -> list[dict]:
+    """Group records by statement, worst total time first."""
+    groups = {}
+    for r in records:
+        grp = groups.get(r["fingerprint"])
+        if grp is None:
+            grp = groups[r["fingerprint"]] = {
+                "fingerprint": r["fingerprint"], "sql": r["sql"], "timings": [],
+                "routes": {}, "plan": r["plan"], "full_scans": r["full_scans"], "last_seen": r["ts"],
+            }
+        grp["timings"].append(r["ms"])
+        grp["routes"][r["route"]] = grp["routes"].get(r["route"], 0) + 1
+        # the latest plan wins: it reflects indexes added since (workers' files interleave)
+        if r["ts"] >= grp["last_seen"]:
+            grp["plan"], grp["full_scans"], grp["last_seen"] = r["plan"], r["full_scans"], r["ts"]
+
+    out = []
+    for grp in groups.values():
+        timings = sorted(grp.pop("timings"))
+        grp["count"] = len(timings)
+        grp["total_ms"] = round(sum(timings), 3)
+        grp["p95_ms"] = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        grp["max_ms"] = timings[-1]
+        out.append(grp)
+    out.sort(key=lambda grp: grp["total_ms"], reverse=True)
+    return out
+
+
+@app.cli.command("slow-queries")
+@click.option("--log", "log_path", default=None, help="log base name (default: SLOW_QUERY_LOG)")
+@click.option("--top", default=20, show_default=True, help="number of statements to show")
+@click.option("--route", default=None, help="only statements seen on this endpoint")
+@click.option("--scans-only", is_flag=True, help="only statements whose plan has a full table scan")
+@click.option("--json", "as_json", is_flag=True, help="print the groups as JSON")
+def slow_queries_command(log_path, top, route, scans_only, as_json):
+    """Group the slow-query log by statement, worst total time first."""
+    records = read_slow_query_log(log_path or SLOW_QUERY_LOG)
+    if route:
+        records = (r for r in records if r["route"] == route)
+    groups = summarize_slow_queries(records)
+    if scans_only:
+        groups = [grp for grp in groups if grp["full_scans"]]
+    groups = groups[:top]
+
+    if as_json:
+        click.echo(json.dumps(groups, ensure_ascii=False, indent=2))
+        return
+    if not groups:
+        click.echo("no slow queries logged")
+        return
+    for grp in groups:
+        routes = ", ".join(f"{name} ({n})" for name, n in sorted(grp["routes"].items(), key=lambda kv: -kv[1]))
+        click.echo(f"{grp['fingerprint']}  count={grp['count']}  total={grp['total_ms']:.1f}ms  "
+                   f"p95={grp['p95_ms']:.1f}ms  max={grp['max_ms']:.1f}ms  last={grp['last_seen']}")
+        click.echo(f"  routes: {routes}")
+        if grp["full_scans"]:
+            click.echo(f"  full scans: {', '.join(grp['full_scans'])}")
+        click.echo(f"  sql: {grp['sql'][:500]}")
+        for line in grp["plan"]:
+            click.echo(f"    {line}")
+        click.echo("")
+
+
 # ---- Make header always reflect latest DB (custom avatar OR role default) ----
+def header_avatar_path() -> str | None:
+    """Logged-in user's avatar as shown in the header, for prime_media_urls."""
+    u = get_user_card(session["user_id"]) if "user_id" in session else None
+    return u.avatar if u else None
+
+
 @app.context_processor
 def inject_header_user():
     me = session.get("user_id")
     if not me:
         return {}
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT username, role, avatar_path FROM users WHERE id = ?", (me,))
-    u = c.fetchone()
-    conn.close()
-
+    u = get_user_card(me)
     if not u:
         return {}
 
-    header_avatar = u["avatar_path"] or default_avatar_for(u["role"])
+    # the original path: templates pick the 96px variant from the page's primed batch
     return {
-        "header_username": u["username"],
-        "header_avatar": header_avatar,
-        "header_role": u["role"],
+        "header_username": u.username,
+        "header_avatar": u.avatar,
+        "header_role": u.role,
     }
 
 
@@ -182,10 +1516,361 @@ def _ensure_user_columns(conn):
         c.execute("ALTER TABLE users ADD COLUMN avatar_path TEXT")
 
 
+# Full-text index over post caption/tags and author username.
+# trigram tokenizer => substring matching like the old LIKE '%x%' (works for Japanese too)
+FTS_MIN_QUERY_LEN = 3
+
+
+def _ensure_post_search_index(conn):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts_fts'")
+    exists = c.fetchone() is not None
+
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            caption, tags, username,
+            tokenize = 'trigram'
+        )
+    """)
+
+    # keep posts_fts in sync with posts/users (rowid = posts.id)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, caption, tags, username)
+            VALUES (new.id, new.caption, new.tags,
+                    (SELECT username FROM users WHERE id = new.user_id));
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS posts_fts_au AFTER UPDATE OF caption, tags ON posts BEGIN
+            UPDATE posts_fts SET caption = new.caption, tags = new.tags
+            WHERE rowid = new.id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts BEGIN
+            DELETE FROM posts_fts WHERE rowid = old.id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username ON users
+        WHEN new.username IS NOT old.username BEGIN
+            UPDATE posts_fts SET username = new.username
+            WHERE rowid IN (SELECT id FROM posts WHERE user_id = new.id);
+        END
+    """)
+
+    if not exists:
+        c.execute("""
+            INSERT INTO posts_fts (rowid, caption, tags, username)
+            SELECT p.id, p.caption, p.tags, u.username
+            FROM posts p
+            LEFT JOIN users u ON u.id = p.user_id
+        """)
+
+
+def _fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+# Normalized tags: one row per (post, tag), looked up through idx_post_tags_tag
+def _ensure_post_tags(conn):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_tags'")
+    exists = c.fetchone() is not None
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS post_tags (
+            post_id INTEGER NOT NULL,
+            tag     TEXT NOT NULL,
+            PRIMARY KEY (post_id, tag),
+            FOREIGN KEY (post_id) REFERENCES posts(id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_post_tags_tag ON post_tags (tag, post_id)")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS post_tags_ad AFTER DELETE ON posts BEGIN
+            DELETE FROM post_tags WHERE post_id = old.id;
+        END
+    """)
+
+    if not exists:
+        c.execute("SELECT id, tags FROM posts WHERE tags IS NOT NULL AND tags != ''")
+        rows = [(post_id, tag) for post_id, tags in c.fetchall() for tag in _split_tags(tags)]
+        c.executemany("INSERT OR IGNORE INTO post_tags (post_id, tag) VALUES (?, ?)", rows)
+
+
+def _normalize_tag(tag: str) -> str:
+    # same canonical form the tag inputs in home.js use (NFKC + lowercase)
+    return unicodedata.normalize("NFKC", tag).strip().lower()
+
+
+def _split_tags(tags_str: str | None) -> list[str]:
+    if not tags_str:
+        return []
+    tags = {_normalize_tag(t) for t in tags_str.split(",")}
+    tags.discard("")
+    return sorted(tags)
+
+
+def sync_post_tags(conn, post_id: int, tags_str: str | None):
+    c = conn.cursor()
+    c.execute("DELETE FROM post_tags WHERE post_id = ?", (post_id,))
+    c.executemany(
+        "INSERT OR IGNORE INTO post_tags (post_id, tag) VALUES (?, ?)",
+        [(post_id, t) for t in _split_tags(tags_str)],
+    )
+
+
+def _add_conversation_change_columns(conn):
+    """conversations.last_message_id / last_tombstone_id: what an open chat needs to revalidate."""
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(conversations)")
+    cols = {row[1] for row in c.fetchall()}
+
+    if "last_message_id" not in cols:
+        c.execute("ALTER TABLE conversations ADD COLUMN last_message_id INTEGER NOT NULL DEFAULT 0")
+        c.execute("""
+            UPDATE conversations
+            SET last_message_id = COALESCE(
+              (SELECT MAX(m.id) FROM messages m WHERE m.conversation_id = conversations.id), 0
+            )
+        """)
+    if "last_tombstone_id" not in cols:
+        c.execute("ALTER TABLE conversations ADD COLUMN last_tombstone_id INTEGER NOT NULL DEFAULT 0")
+
+
+def _add_conversation_state_change_seq(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(conversation_states)")
+    cols = {row[1] for row in c.fetchall()}
+    if "change_seq" not in cols:
+        c.execute("ALTER TABLE conversation_states ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0")
+
+
+def _add_follow_count_columns(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(users)")
+    cols = {row[1] for row in c.fetchall()}
+    if "follower_count" not in cols:
+        c.execute("ALTER TABLE users ADD COLUMN follower_count INTEGER NOT NULL DEFAULT 0")
+    if "following_count" not in cols:
+        c.execute("ALTER TABLE users ADD COLUMN following_count INTEGER NOT NULL DEFAULT 0")
+
+
+# users.follower_count / following_count are kept in step with follows by the
+# write paths (api_follow_toggle, api_account_delete); this recomputes them
+# from scratch and touches only the rows that drifted.
+REPAIR_FOLLOW_COUNTS_SQL = """
+    UPDATE users
+    SET follower_count = (SELECT COUNT(*) FROM follows WHERE following_id = users.id),
+        following_count = (SELECT COUNT(*) FROM follows WHERE follower_id = users.id)
+    WHERE follower_count != (SELECT COUNT(*) FROM follows WHERE following_id = users.id)
+       OR following_count != (SELECT COUNT(*) FROM follows WHERE follower_id = users.id)
+"""
+
+
+# ---- Schema migrations ----
+# Applied in order at startup; PRAGMA user_version holds the last applied version.
+# A step is either an SQL string or a callable(conn). Keep steps idempotent
+# (IF NOT EXISTS, column checks) so databases patched by hand upgrade cleanly.
+MIGRATIONS = [
+    (1, "secondary indexes for feed, messaging, follows and showcase queries", [
+        # feed: ORDER BY created_at DESC, id DESC + keyset cursor
+        "CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts (created_at, id)",
+        # delete_post/account delete, username trigger on posts_fts
+        "CREATE INDEX IF NOT EXISTS idx_posts_user_id ON posts (user_id)",
+        # last message / unread counts / message history per conversation
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_created ON messages (conversation_id, created_at)",
+        # account delete
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender_id)",
+        # follower lists and counts (follower_id is covered by the primary key)
+        "CREATE INDEX IF NOT EXISTS idx_follows_following_id ON follows (following_id)",
+        # get_showcase_items
+        "CREATE INDEX IF NOT EXISTS idx_showcase_items_user_created ON showcase_items (user_id, created_at)",
+        # inbox lookups (user1_id is covered by UNIQUE(user1_id, user2_id))
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user2_id ON conversations (user2_id)",
+    ]),
+    (2, "message history pages by id", [
+        # WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT n
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages (conversation_id, id)",
+    ]),
+    (3, "per-user event log for /api/stream", [
+        # written in the same transaction as the change; streams read it by id,
+        # so events survive across gunicorn workers and EventSource reconnects
+        """
+        CREATE TABLE IF NOT EXISTS user_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_events_user_id ON user_events (user_id, id)",
+    ]),
+    (4, "message deltas: conversation high-water marks and delete tombstones", [
+        _add_conversation_change_columns,
+        # seq = conversations.last_message_id when the message was deleted, so
+        # "deleted since after_id" is seq >= after_id
+        """
+        CREATE TABLE IF NOT EXISTS message_tombstones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_message_tombstones_conversation_seq ON message_tombstones (conversation_id, seq)",
+    ]),
+    (5, "inbox change tokens", [
+        # single-row counter; every inbox change takes the next value
+        """
+        CREATE TABLE IF NOT EXISTS change_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL
+        )
+        """,
+        "INSERT OR IGNORE INTO change_counter (id, seq) VALUES (1, 0)",
+        # per (conversation, user): unread/hidden are per user, so is the change
+        _add_conversation_state_change_seq,
+        "CREATE INDEX IF NOT EXISTS idx_conversation_states_user_change ON conversation_states (user_id, change_seq)",
+    ]),
+    (6, "presigned direct uploads", [
+        # one row per presigned key until a form claims it (or the sweep drops it)
+        """
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            key TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finalized_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pending_uploads_created_at ON pending_uploads (created_at)",
+    ]),
+    (7, "durable R2 delete queue", [
+        # next_attempt_at / leased_until are unix seconds (time.time())
+        """
+        CREATE TABLE IF NOT EXISTS r2_delete_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            leased_until REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_r2_delete_queue_due ON r2_delete_queue (next_attempt_at, id)",
+    ]),
+    (8, "image derivatives", [
+        # variant "blur" stores a data: URI in path; the others point at WebP files
+        """
+        CREATE TABLE IF NOT EXISTS media_variants (
+            source_path TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            path TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source_path, variant)
+        )
+        """,
+    ]),
+    (9, "media reference counts", [
+        """
+        CREATE TABLE IF NOT EXISTS media_objects (
+            path TEXT PRIMARY KEY,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # existing uploads: one reference per row that points at them
+        """
+        INSERT OR IGNORE INTO media_objects (path, refcount)
+        SELECT path, COUNT(*) FROM (
+            SELECT avatar_path AS path FROM users
+            UNION ALL SELECT media_path FROM posts
+            UNION ALL SELECT media_path FROM showcase_items
+        )
+        WHERE path LIKE '/r2/%' OR path LIKE '/static/uploads/%'
+        GROUP BY path
+        """,
+    ]),
+    (10, "denormalized follower / following counts", [
+        _add_follow_count_columns,
+        REPAIR_FOLLOW_COUNTS_SQL,
+    ]),
+    (11, "image derivatives per kind", [
+        # a deduplicated blob can be an avatar (square crops) and a post at once
+        """
+        CREATE TABLE IF NOT EXISTS media_variants_by_kind (
+            source_path TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            path TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source_path, kind, variant)
+        )
+        """,
+        # old rows were built for whichever kind came first: a thumb means avatar
+        """
+        INSERT OR IGNORE INTO media_variants_by_kind
+            (source_path, kind, variant, path, width, height, bytes, created_at)
+        SELECT mv.source_path,
+               CASE
+                   WHEN EXISTS (SELECT 1 FROM media_variants t
+                                WHERE t.source_path = mv.source_path AND t.variant = 'thumb') THEN 'avatar'
+                   WHEN EXISTS (SELECT 1 FROM posts p WHERE p.media_path = mv.source_path) THEN 'post'
+                   WHEN EXISTS (SELECT 1 FROM showcase_items s WHERE s.media_path = mv.source_path) THEN 'showcase'
+                   ELSE 'post'
+               END,
+               mv.variant, mv.path, mv.width, mv.height, mv.bytes, mv.created_at
+        FROM media_variants mv
+        """,
+        "DROP TABLE media_variants",
+        "ALTER TABLE media_variants_by_kind RENAME TO media_variants",
+    ]),
+]
+
+
+def run_migrations(conn):
+    """Apply pending MIGRATIONS. Caller owns the transaction."""
+    c = conn.cursor()
+    c.execute("PRAGMA user_version")
+    current = c.fetchone()[0]
+
+    for version, name, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        for step in steps:
+            if callable(step):
+                step(conn)
+            else:
+                c.execute(step)
+        # PRAGMA does not accept bound parameters
+        c.execute(f"PRAGMA user_version = {int(version)}")
+        app.logger.info("applied migration %d: %s", version, name)
+
+
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = connect_db()
     c = conn.cursor()
 
+    # WAL lets feed/chat readers run while a writer commits (persistent per DB file)
+    c.execute("PRAGMA journal_mode = WAL")
+
+    # one writer at a time: several gunicorn workers run this on import
+    c.execute("BEGIN IMMEDIATE")
+
     # users table
     c.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -289,6 +1974,9 @@ def init_db():
     """)
 
     _ensure_user_columns(conn)
+    _ensure_post_search_index(conn)
+    _ensure_post_tags(conn)
+    run_migrations(conn)
     conn.commit()
     conn.close()
 
@@ -305,11 +1993,741 @@ def get_showcase_items(conn, user_id: int, limit: int = 12):
     return c.fetchall()
 
 
+# ---- In-process cache (per worker) ----
+class LRUCache:
+    """Thread-safe LRU with a per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_where(self, predicate) -> int:
+        """Drop every entry for which predicate(key, value) is true."""
+        with self._lock:
+            doomed = [k for k, (_, v) in self._data.items() if predicate(k, v)]
+            for k in doomed:
+                del self._data[k]
+            return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / total) if total else 0.0,
+            }
+
+
+# ---- Signed media URLs (key -> storage.sign(), per worker) ----
+# Signing is reused until R2_SIGNED_URL_REFRESH_MARGIN seconds before expiry;
+# /r2/<key> redirects are cacheable by the browser for the rest of that window.
+R2_SIGNED_URL_CACHE_SIZE = int(os.getenv("R2_SIGNED_URL_CACHE_SIZE", "20000"))
+R2_SIGNED_URL_REFRESH_MARGIN = int(os.getenv(
+    "R2_SIGNED_URL_REFRESH_MARGIN", str(min(300, R2_SIGNED_URL_EXPIRES // 4))
+))
+signed_url_cache = LRUCache(R2_SIGNED_URL_CACHE_SIZE, max(0, R2_SIGNED_URL_EXPIRES - R2_SIGNED_URL_REFRESH_MARGIN))
+
+
+def signed_url_cached(key: str, min_valid: int = 0):
+    """(url, seconds it can still be handed out) for key, signing only on a miss
+    or when less than min_valid seconds are left."""
+    now = time.time()
+    hit = signed_url_cache.get(key)
+    if hit is not None and hit[1] - now >= min_valid:
+        url, usable_until = hit
+        return url, max(0, int(usable_until - now))
+
+    url = storage.sign(key, R2_SIGNED_URL_EXPIRES)
+    # stop handing out a URL while it still has the margin left to be fetched
+    usable_until = now + R2_SIGNED_URL_EXPIRES - R2_SIGNED_URL_REFRESH_MARGIN
+    signed_url_cache.set(key, (url, usable_until))
+    return url, max(0, int(usable_until - now))
+
+
+# Pages embed signed URLs directly (no /r2/ redirect per <img>); they must
+# outlive a typical page view, otherwise the element falls back to /r2/ on error.
+R2_EMBED_MIN_VALIDITY = int(os.getenv("R2_EMBED_MIN_VALIDITY", str(R2_SIGNED_URL_EXPIRES // 2)))
+
+
+def resolve_media_urls(paths) -> dict:
+    """Map every stored path to a direct signed URL in one pass.
+
+    Paths of backends that do not sign (local, memory) and static paths map to
+    themselves, and so does any path whose signing fails, so /r2/ keeps
+    working as the fallback.
+    """
+    resolved = {}
+    for path in paths:
+        if not path or path in resolved:
+            continue
+        key = storage.key_for_path(path)
+        if not key or not storage.signs_urls:
+            resolved[path] = path
+            continue
+        try:
+            resolved[path] = signed_url_cached(key, R2_EMBED_MIN_VALIDITY)[0]
+        except Exception:
+            app.logger.warning("signing %s failed; using /r2/ redirect", key, exc_info=True)
+            resolved[path] = path
+    return resolved
+
+
+@app.template_filter("media_url")
+def media_url_filter(path):
+    """{{ path|media_url }}: signed URL for /r2/ paths, resolved once per render."""
+    if not path:
+        return path
+    urls = g.setdefault("media_urls", {})
+    if path not in urls:
+        urls.update(resolve_media_urls([path]))
+    return urls[path]
+
+
+def prime_media_urls(paths):
+    """Resolve a page's media paths and their variants up front (one batch)."""
+    paths = [p for p in dict.fromkeys(paths) if p]
+    variants = prime_media_variants(paths)
+    variant_paths = [
+        v[1] for p in paths for by_kind in variants.get(p, {}).values() for v in by_kind
+        if not v[1].startswith("data:")
+    ]
+    g.setdefault("media_urls", {}).update(
+        resolve_media_urls(p for p in paths + variant_paths if p not in g.media_urls)
+    )
+
+
+# ---- Media variants (WebP thumbnails + blur placeholder per image) ----
+# Built in a background pool after an image is stored, recorded in media_variants
+# (source_path, kind, variant -> path, width). Uploads are deduplicated by content,
+# so one blob can be an avatar and a post at once; each kind gets its own set.
+# Renders fall back to the original until the variants exist, and when Pillow is
+# not installed.
+# kind -> [(variant, width, square crop)]
+MEDIA_VARIANT_SPECS = {
+    "avatar": [("thumb", 96, True), ("small", 320, True)],
+    "post": [("small", 320, False), ("medium", 720, False)],
+    "showcase": [("small", 320, False), ("medium", 720, False)],
+}
+MEDIA_VARIANT_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}  # GIFs keep their animation
+MEDIA_VARIANT_QUALITY = int(os.getenv("MEDIA_VARIANT_QUALITY", "80"))
+MEDIA_VARIANT_MAX_SOURCE_BYTES = int(os.getenv("MEDIA_VARIANT_MAX_SOURCE_BYTES", str(40 * 1024 * 1024)))
+MEDIA_PLACEHOLDER_WIDTH = 16
+_media_variant_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MEDIA_VARIANT_WORKERS", "2")), thread_name_prefix="media-variants"
+)
+
+
+def _is_variant_source(path: str | None) -> bool:
+    # stored uploads only: /static/img defaults never get variants, so skip their lookup
+    return _is_managed_media(path) and path.rsplit(".", 1)[-1].lower() in MEDIA_VARIANT_EXTENSIONS
+
+
+def _variant_name_for(source_path: str, kind: str, variant: str) -> str:
+    base = source_path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+    return f"{base}_{kind}_{variant}.webp"
+
+
+def _read_media_bytes(source_path: str) -> bytes | None:
+    key = storage.key_for_path(source_path)
+    if not key:
+        return None
+    meta = storage.stat(key)
+    if meta is None or meta[0] > MEDIA_VARIANT_MAX_SOURCE_BYTES:
+        return None
+    return storage.get(key)
+
+
+def _store_variant(source_path: str, kind: str, variant: str, blob: bytes) -> str:
+    key = storage_key("variants", _variant_name_for(source_path, kind, variant))
+    storage.put(key, BytesIO(blob), "image/webp", cache_control="public, max-age=31536000, immutable")
+    return storage.path_for_key(key)
+
+
+def render_image_variants(data: bytes, kind: str) -> list:
+    """[(variant, webp bytes, width, height)] plus ("blur", data URI, w, h). Needs Pillow."""
+    with Image.open(BytesIO(data)) as im:
+        im = ImageOps.exif_transpose(im)
+        im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "P") else "RGB")
+        out = []
+
+        for variant, width, square in MEDIA_VARIANT_SPECS[kind]:
+            if square:
+                side = min(width, im.width, im.height)
+                resized = ImageOps.fit(im, (side, side), Image.LANCZOS)
+            elif im.width > width:
+                resized = im.resize((width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+            else:
+                continue  # no upscaling; the original is already this small
+            buf = BytesIO()
+            resized.save(buf, "WEBP", quality=MEDIA_VARIANT_QUALITY, method=4)
+            out.append((variant, buf.getvalue(), resized.width, resized.height))
+
+        tiny = im.resize(
+            (MEDIA_PLACEHOLDER_WIDTH, max(1, round(im.height * MEDIA_PLACEHOLDER_WIDTH / im.width))),
+            Image.BILINEAR,
+        )
+        buf = BytesIO()
+        tiny.save(buf, "WEBP", quality=30)
+        uri = "data:image/webp;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+        out.append(("blur", uri, tiny.width, tiny.height))
+    return out
+
+
+def build_media_variants(source_path: str, kind: str, user_id: int | None = None) -> int:
+    """Generate and record variants for one stored image; returns how many were recorded."""
+    conn = connect_db()
+    try:
+        # deduplicated uploads share the variants of the first copy of the same kind
+        if conn.execute(
+            "SELECT 1 FROM media_variants WHERE source_path = ? AND kind = ? LIMIT 1", (source_path, kind)
+        ).fetchone():
+            return 0
+    finally:
+        conn.close()
+
+    data = _read_media_bytes(source_path)
+    if not data:
+        return 0
+
+    rows = []
+    for variant, blob, width, height in render_image_variants(data, kind):
+        if variant == "blur":
+            rows.append((source_path, kind, variant, blob, width, height, len(blob)))
+        else:
+            path = _store_variant(source_path, kind, variant, blob)
+            rows.append((source_path, kind, variant, path, width, height, len(blob)))
+
+    conn = connect_db()
+    try:
+        conn.executemany("""
+            INSERT OR REPLACE INTO media_variants (source_path, kind, variant, path, width, height, bytes)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if user_id is not None:
+        invalidate_user_card(user_id)  # cards carry the avatar thumbnail
+    return len(rows)
+
+
+def _build_media_variants_job(source_path, kind, user_id):
+    try:
+        build_media_variants(source_path, kind, user_id)
+    except Exception:
+        app.logger.exception("media variants for %s failed", source_path)
+
+
+def schedule_media_variants(source_path: str | None, kind: str, user_id: int | None = None):
+    """Queue variant generation for a newly stored image (no-op for videos / without Pillow)."""
+    if Image is None or not _is_variant_source(source_path):
+        return
+    _media_variant_pool.submit(_build_media_variants_job, source_path, kind, user_id)
+
+
+@app.cli.command("build-media-variants")
+def build_media_variants_command():
+    """Backfill variants for images stored before they were generated at upload time."""
+    if Image is None:
+        raise SystemExit("Pillow is not installed")
+    conn = connect_db()
+    try:
+        rows = conn.execute("""
+            SELECT avatar_path AS path, 'avatar' AS kind, id AS user_id FROM users WHERE avatar_path IS NOT NULL
+            UNION ALL
+            SELECT media_path, 'post', NULL FROM posts WHERE media_path IS NOT NULL
+            UNION ALL
+            SELECT media_path, 'showcase', NULL FROM showcase_items
+        """).fetchall()
+        done = {(r["source_path"], r["kind"])
+                for r in conn.execute("SELECT DISTINCT source_path, kind FROM media_variants")}
+    finally:
+        conn.close()
+
+    built = failed = 0
+    for r in rows:
+        if (r["path"], r["kind"]) in done or not _is_variant_source(r["path"]):
+            continue
+        try:
+            build_media_variants(r["path"], r["kind"], r["user_id"])
+            built += 1
+        except Exception as e:
+            failed += 1
+            click.echo(f"{r['path']}: {e}", err=True)
+        done.add((r["path"], r["kind"]))
+    click.echo(f"built variants for {built} images ({failed} failed)")
+
+
+def prime_media_variants(paths) -> dict:
+    """Load variants for a page's paths in one query into g.media_variants.
+
+    Returns {source_path: {kind: [(variant, path, width), ...]}}.
+    """
+    known = g.setdefault("media_variants", {})
+    missing = [p for p in dict.fromkeys(paths) if p and p not in known and _is_variant_source(p)]
+    for p in missing:
+        known[p] = {}
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        qmarks = ",".join(["?"] * len(chunk))
+        rows = get_db().execute(f"""
+            SELECT source_path, kind, variant, path, width
+            FROM media_variants
+            WHERE source_path IN ({qmarks})
+            ORDER BY width
+        """, chunk).fetchall()
+        for r in rows:
+            known[r["source_path"]].setdefault(r["kind"], []).append((r["variant"], r["path"], r["width"]))
+    return known
+
+
+def _variants_of(path: str, kind: str) -> list:
+    return prime_media_variants([path]).get(path, {}).get(kind, [])
+
+
+def pick_media_variant(path: str | None, min_width: int, kind: str) -> str | None:
+    """Smallest stored variant of this kind at least min_width wide, else the original path."""
+    if not path:
+        return path
+    for variant, vpath, width in _variants_of(path, kind):
+        if variant != "blur" and width >= min_width:
+            return vpath
+    return path
+
+
+@app.template_filter("media_variant")
+def media_variant_filter(path, min_width: int, kind: str):
+    """{{ path|media_variant(96, "avatar") }}: URL of the smallest variant that is wide enough."""
+    return media_url_filter(pick_media_variant(path, min_width, kind))
+
+
+@app.template_filter("media_srcset")
+def media_srcset_filter(path, kind: str):
+    """{{ path|media_srcset("post") }}: "url 320w, url 720w" over the WebP variants ("" if none)."""
+    if not path:
+        return ""
+    return ", ".join(
+        f"{media_url_filter(vpath)} {width}w" for variant, vpath, width in _variants_of(path, kind) if variant != "blur"
+    )
+
+
+@app.template_filter("media_placeholder")
+def media_placeholder_filter(path, kind: str):
+    """{{ path|media_placeholder("post") }}: tiny blurred data URI to paint before the image loads."""
+    if not path:
+        return ""
+    for variant, vpath, _ in _variants_of(path, kind):
+        if variant == "blur":
+            return vpath
+    return ""
+
+
+# ---- User cards (id -> username/role/avatar) ----
+# Header, follower lists, inbox and user search all render the same card.
+USER_CARD_CACHE_SIZE = int(os.getenv("USER_CARD_CACHE_SIZE", "10000"))
+USER_CARD_CACHE_TTL = float(os.getenv("USER_CARD_CACHE_TTL", "60"))
+user_card_cache = LRUCache(USER_CARD_CACHE_SIZE, USER_CARD_CACHE_TTL)
+
+
+class UserCard:
+    __slots__ = ("id", "username", "role", "avatar_path", "thumb_path")
+
+    def __init__(self, id: int, username: str, role: str, avatar_path: str | None,
+                 thumb_path: str | None = None):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.avatar_path = avatar_path
+        self.thumb_path = thumb_path
+
+    @property
+    def avatar(self) -> str:
+        return self.avatar_path or default_avatar_for(self.role)
+
+    @property
+    def thumb(self) -> str:
+        """96px WebP avatar once generated, else the full avatar."""
+        return self.thumb_path or self.avatar
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "username": self.username,
+            "role": self.role,
+            "avatar": self.thumb,
+        }
+
+
+def get_user_cards(user_ids) -> dict:
+    """Return {id: UserCard} for the ids that exist, reading through the cache."""
+    cards = {}
+    missing = []
+    for uid in set(user_ids):
+        card = user_card_cache.get(uid)
+        if card is None:
+            missing.append(uid)
+        else:
+            cards[uid] = card
+
+    c = get_db().cursor()
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        qmarks = ",".join(["?"] * len(chunk))
+        c.execute(f"""
+            SELECT u.id, u.username, u.role, u.avatar_path, mv.path AS thumb_path
+            FROM users u
+            LEFT JOIN media_variants mv
+                ON mv.source_path = u.avatar_path AND mv.kind = 'avatar' AND mv.variant = 'thumb'
+            WHERE u.id IN ({qmarks})
+        """, chunk)
+        for r in c.fetchall():
+            card = UserCard(r["id"], r["username"], r["role"], r["avatar_path"], r["thumb_path"])
+            user_card_cache.set(card.id, card)
+            cards[card.id] = card
+    return cards
+
+
+def get_user_card(user_id: int):
+    return get_user_cards([user_id]).get(user_id)
+
+
+def invalidate_user_card(user_id: int):
+    user_card_cache.pop(user_id)
+
+
+# ---- Feed helpers (keyset pagination on created_at, id) ----
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 50
+
+# Feed page cache. Writes in this worker invalidate it; other workers
+# catch up within FEED_CACHE_TTL seconds. So that an author's redirect to the
+# feed can land on any worker and still show their change, the author's own
+# feed reads skip the cache for FEED_CACHE_TTL after a write (note_feed_write).
+FEED_CACHE_SIZE = int(os.getenv("FEED_CACHE_SIZE", "512"))
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", "30"))
+feed_cache = LRUCache(FEED_CACHE_SIZE, FEED_CACHE_TTL)
+
+
+def _feed_filters_from_args(args) -> dict:
+    role = args.get("role")
+    tags_str = (args.get("tags") or "").strip()
+    return {
+        "role": role if role in ("individual", "band") else None,
+        "genre": args.get("genre_filter") or None,
+        "instrument": args.get("instrument_filter") or None,
+        "my_instrument": args.get("my_instrument_filter") or None,
+        "tags": tuple(_split_tags(tags_str)),
+        "q": (args.get("q") or "").strip(),
+    }
+
+
+def _encode_feed_cursor(created_at, post_id: int) -> str:
+    raw = f"{created_at}|{post_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_feed_cursor(raw: str | None):
+    if not raw:
+        return None
+    try:
+        padded = raw + "=" * (-len(raw) % 4)
+        created_at, post_id = base64.urlsafe_b64decode(padded).decode("utf-8").rsplit("|", 1)
+        return (created_at, int(post_id))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def fetch_feed_page(conn, filters: dict, cursor=None, limit: int = FEED_PAGE_SIZE):
+    """Return (posts, next_cursor) for one feed page.
+
+    Newest first, except keyword searches which are ordered by relevance.
+    """
+    where_clauses = []
+    params = []
+
+    if filters["role"]:
+        where_clauses.append("u.role = ?")
+        params.append(filters["role"])
+
+    if filters["genre"]:
+        where_clauses.append("p.genre = ?")
+        params.append(filters["genre"])
+
+    if filters["instrument"]:
+        where_clauses.append("p.target_instrument = ?")
+        params.append(filters["instrument"])
+
+    if filters["my_instrument"]:
+        where_clauses.append("p.my_instrument = ?")
+        params.append(filters["my_instrument"])
+
+    if filters["tags"]:
+        # any of the tags (exact match on the normalized tag)
+        qmarks = ",".join(["?"] * len(filters["tags"]))
+        where_clauses.append(f"p.id IN (SELECT post_id FROM post_tags WHERE tag IN ({qmarks}))")
+        params.extend(filters["tags"])
+
+    # keyword search goes through posts_fts and is ordered by relevance (bm25)
+    ranked = len(filters["q"]) >= FTS_MIN_QUERY_LEN
+    join_sql = ""
+    if ranked:
+        join_sql = "JOIN posts_fts ON posts_fts.rowid = p.id"
+        where_clauses.append("posts_fts MATCH ?")
+        params.append(_fts_phrase(filters["q"]))
+    elif filters["q"]:
+        where_clauses.append("(p.caption LIKE ? OR p.tags LIKE ? OR u.username LIKE ?)")
+        like = f"%{filters['q']}%"
+        params.extend([like, like, like])
+
+    if ranked:
+        sort_col = "posts_fts.rank"
+        order_sql = "ORDER BY posts_fts.rank ASC, p.id ASC"
+        if cursor:
+            where_clauses.append("(posts_fts.rank, p.id) > (?, ?)")
+            params.extend((float(cursor[0]), cursor[1]))
+    else:
+        sort_col = "p.created_at"
+        order_sql = "ORDER BY p.created_at DESC, p.id DESC"
+        if cursor:
+            where_clauses.append("(p.created_at, p.id) < (?, ?)")
+            params.extend(cursor)
+
+    where_sql = ""
+    if where_clauses:
+        where_sql = "WHERE " + " AND ".join(where_clauses)
+
+    # fetch one extra row to know whether another page exists
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT p.*, u.username, u.role, u.avatar_path, {sort_col} AS sort_key
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        {join_sql}
+        {where_sql}
+        {order_sql}
+        LIMIT ?
+    """, (*params, limit + 1))
+    posts = [dict(r) for r in c.fetchall()]
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = posts[-1]
+        next_cursor = _encode_feed_cursor(last["sort_key"], last["id"])
+
+    for post in posts:
+        del post["sort_key"]
+
+    return posts, next_cursor
+
+
+# cache key: (role, genre, instrument, my_instrument, tags, q, cursor, limit)
+def _feed_cache_key(filters: dict, cursor, limit: int) -> tuple:
+    return (
+        filters["role"],
+        filters["genre"],
+        filters["instrument"],
+        filters["my_instrument"],
+        filters["tags"],
+        filters["q"],
+        cursor,
+        limit,
+    )
+
+
+def note_feed_write():
+    """The current user changed something the feed shows (post, author card)."""
+    session["feed_fresh_until"] = time.time() + FEED_CACHE_TTL
+
+
+def _feed_cache_bypassed() -> bool:
+    return session.get("feed_fresh_until", 0) > time.time()
+
+
+def cached_feed_page(conn, filters: dict, cursor=None, limit: int = FEED_PAGE_SIZE):
+    key = _feed_cache_key(filters, cursor, limit)
+    # after their own write, this worker's entries may predate it; read through
+    # and refresh the entry instead
+    if not _feed_cache_bypassed():
+        hit = feed_cache.get(key)
+        if hit is not None:
+            return hit["posts"], hit["next_cursor"]
+
+    posts, next_cursor = fetch_feed_page(conn, filters, cursor, limit)
+    feed_cache.set(key, {
+        "posts": posts,
+        "next_cursor": next_cursor,
+        "post_ids": frozenset(p["id"] for p in posts),
+        "user_ids": frozenset(p["user_id"] for p in posts),
+    })
+    return posts, next_cursor
+
+
+def _feed_key_may_match(key: tuple, post: dict) -> bool:
+    """Could a post with these values appear under the filters in key?"""
+    role, genre, instrument, my_instrument, tags, q, _, _ = key
+    if role and role != post["role"]:
+        return False
+    if genre and genre != post["genre"]:
+        return False
+    if instrument and instrument != post["target_instrument"]:
+        return False
+    if my_instrument and my_instrument != post["my_instrument"]:
+        return False
+    if tags and not set(tags) & set(_split_tags(post["tags"])):
+        return False
+    # keyword matches are not re-evaluated here; treat them as a match
+    return True
+
+
+def invalidate_feed_for_new_post(post: dict):
+    # a new post is the newest one, so with created_at ordering it can only land on
+    # first pages; relevance-ordered searches can place it on any page
+    feed_cache.discard_where(
+        lambda k, v: (k[6] is None or k[5]) and _feed_key_may_match(k, post)
+    )
+
+
+def invalidate_feed_for_post(post_id: int, post: dict | None = None):
+    """Edited (post given) or deleted (post None) post."""
+    feed_cache.discard_where(
+        lambda k, v: post_id in v["post_ids"] or (post is not None and _feed_key_may_match(k, post))
+    )
+
+
+def invalidate_feed_for_user(user_id: int, renamed: bool = False):
+    # author card changed; a rename also changes username search results
+    feed_cache.discard_where(
+        lambda k, v: user_id in v["user_ids"] or (renamed and bool(k[5]))
+    )
+
+
 # ---- Helper for sorted user-pair ----
 def _sorted_pair(a: int, b: int):
     return (a, b) if a < b else (b, a)
 
 
+# ---- Message history pages (newest first, older pages via before_id) ----
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_MAX_PAGE_SIZE = 200
+
+
+def _message_page_args(limit_raw, before_id_raw):
+    """Parse limit/before_id; raises ValueError on bad input."""
+    limit = MESSAGE_PAGE_SIZE if limit_raw in (None, "") else int(limit_raw)
+    limit = max(1, min(limit, MESSAGE_MAX_PAGE_SIZE))
+    before_id = None if before_id_raw in (None, "") else int(before_id_raw)
+    return limit, before_id
+
+
+def fetch_message_page(conn, conv_id: int, cleared_at, before_id=None, limit: int = MESSAGE_PAGE_SIZE):
+    """Return (rows oldest-first, has_more) for the newest page before before_id."""
+    where_clauses = ["conversation_id = ?"]
+    params = [conv_id]
+
+    # messages from before "delete conversation" stay hidden for me
+    if cleared_at:
+        where_clauses.append("created_at > ?")
+        params.append(cleared_at)
+
+    if before_id is not None:
+        where_clauses.append("id < ?")
+        params.append(before_id)
+
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT id, sender_id, body, created_at
+        FROM messages
+        WHERE {" AND ".join(where_clauses)}
+        ORDER BY id DESC
+        LIMIT ?
+    """, (*params, limit + 1))
+    rows = c.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+
+def fetch_messages_after(conn, conv_id: int, cleared_at, after_id: int, limit: int = MESSAGE_MAX_PAGE_SIZE):
+    """Return (rows oldest-first, has_newer) for messages with id > after_id."""
+    where_clauses = ["conversation_id = ?", "id > ?"]
+    params = [conv_id, after_id]
+
+    if cleared_at:
+        where_clauses.append("created_at > ?")
+        params.append(cleared_at)
+
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT id, sender_id, body, created_at
+        FROM messages
+        WHERE {" AND ".join(where_clauses)}
+        ORDER BY id ASC
+        LIMIT ?
+    """, (*params, limit + 1))
+    rows = c.fetchall()
+
+    has_newer = len(rows) > limit
+    return rows[:limit], has_newer
+
+
+def fetch_deleted_message_ids(conn, conv_id: int, after_id: int):
+    """Ids up to after_id (what the client may hold) deleted since after_id was the newest."""
+    c = conn.cursor()
+    c.execute("""
+        SELECT message_id
+        FROM message_tombstones
+        WHERE conversation_id = ? AND seq >= ? AND message_id <= ?
+        ORDER BY message_id
+    """, (conv_id, after_id, after_id))
+    return [r["message_id"] for r in c.fetchall()]
+
+
+def conversation_etag(conv, user_id: int, cleared_at) -> str:
+    """Version of one user's view of a conversation; no messages read needed."""
+    return f"c{conv['id']}-u{user_id}-m{conv['last_message_id']}-t{conv['last_tombstone_id']}-{cleared_at or ''}"
+
+
 # ensure per-user state row exists
 def ensure_conv_state(conn, conversation_id: int, user_id: int):
     c = conn.cursor()
@@ -319,6 +2737,139 @@ def ensure_conv_state(conn, conversation_id: int, user_id: int):
     """, (conversation_id, user_id))
 
 
+# ---- Inbox change tokens (GET /api/conversations?since=) ----
+def mark_inbox_changed(conn, conv_user_pairs):
+    """Bump change_seq for (conversation_id, user_id) pairs; caller commits."""
+    pairs = list(dict.fromkeys(conv_user_pairs))
+    if not pairs:
+        return
+    c = conn.cursor()
+    c.execute("UPDATE change_counter SET seq = seq + 1 WHERE id = 1 RETURNING seq")
+    seq = c.fetchone()[0]
+    for conv_id, user_id in pairs:
+        ensure_conv_state(conn, conv_id, user_id)
+    c.executemany(
+        "UPDATE conversation_states SET change_seq = ? WHERE conversation_id = ? AND user_id = ?",
+        [(seq, conv_id, user_id) for conv_id, user_id in pairs],
+    )
+
+
+def current_inbox_token(conn) -> str:
+    # read before the inbox query: anything committed later gets a larger seq
+    row = conn.execute("SELECT seq FROM change_counter WHERE id = 1").fetchone()
+    return str(row[0] if row else 0)
+
+
+def _parse_inbox_token(raw):
+    """Token -> int; raises ValueError."""
+    value = int(raw)
+    if value < 0:
+        raise ValueError(raw)
+    return value
+
+
+# ---- Live events (/api/stream, Server-Sent Events) ----
+# Handlers write events into user_events inside their own transaction
+# (publish_event); after the request the local streams of those users are
+# woken (event_hub). Streams served by other workers find the rows on their
+# next poll, so delivery works with any number of processes.
+SSE_POLL_INTERVAL = float(os.getenv("SSE_POLL_INTERVAL", "2"))
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "20"))
+# streams end after this long; EventSource reconnects with Last-Event-ID
+SSE_MAX_STREAM_SECONDS = float(os.getenv("SSE_MAX_STREAM_SECONDS", "60"))
+# Every open stream holds a worker thread and a DB connection (see
+# gunicorn.conf.py: gthread workers). Above this many per worker, /api/stream
+# answers 503 and pages fall back to polling, leaving threads for normal requests.
+SSE_MAX_STREAMS_PER_WORKER = int(os.getenv("SSE_MAX_STREAMS_PER_WORKER", "8"))
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "3000"))
+SSE_EVENT_RETENTION_SECONDS = int(os.getenv("SSE_EVENT_RETENTION_SECONDS", "3600"))
+SSE_BATCH_SIZE = 100
+_sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS_PER_WORKER)
+
+
+class EventHub:
+    """In-process wake-ups for open streams (user_id -> threading.Event per stream)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    def subscribe(self, user_id):
+        ev = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(user_id, set()).add(ev)
+        return ev
+
+    def unsubscribe(self, user_id, ev):
+        with self._lock:
+            waiters = self._waiters.get(user_id)
+            if waiters:
+                waiters.discard(ev)
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def wake(self, user_ids):
+        with self._lock:
+            events = [ev for uid in user_ids for ev in self._waiters.get(uid, ())]
+        for ev in events:
+            ev.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._waiters),
+                "streams": sum(len(w) for w in self._waiters.values()),
+            }
+
+
+event_hub = EventHub()
+_events_pruned_at = 0.0
+
+
+def publish_event(conn, user_id: int, event: str, payload: dict):
+    """Queue an event for user_id; delivered once the caller commits."""
+    global _events_pruned_at
+
+    conn.execute(
+        "INSERT INTO user_events (user_id, event, data) VALUES (?, ?, ?)",
+        (user_id, event, json.dumps(payload, ensure_ascii=False)),
+    )
+    g.setdefault("wake_users", set()).add(user_id)
+
+    # old rows are only needed for reconnects; sweep at most once a minute per worker
+    now = time.monotonic()
+    if now - _events_pruned_at > 60:
+        _events_pruned_at = now
+        conn.execute(
+            "DELETE FROM user_events WHERE created_at < datetime('now', ?)",
+            (f"-{SSE_EVENT_RETENTION_SECONDS} seconds",),
+        )
+
+
+@app.teardown_appcontext
+def wake_event_streams(exc):
+    users = g.pop("wake_users", None)
+    if users and exc is None:
+        event_hub.wake(users)
+
+
+def _message_event_payload(conv_id: int, msg_id: int, sender_id: int, body: str, created_at, user_id: int):
+    return {
+        "conversation_id": conv_id,
+        "message": {
+            "id": msg_id,
+            "body": body,
+            "created_at": created_at,
+            "from_me": sender_id == user_id,
+        },
+    }
+
+
+def _sse_format(event_id, event: str, data: str) -> str:
+    # data comes from json.dumps, so it never contains a raw newline
+    return f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+
+
 # ---- Routes ----
 @app.route("/")
 def index():
@@ -332,11 +2883,10 @@ def login():
         username = request.form.get("username")
         password = request.form.get("password")
 
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password))
         user = c.fetchone()
-        conn.close()
 
         if user:
             session["user_id"] = user[0]
@@ -358,16 +2908,17 @@ def register():
         role = request.form.get("role", "individual")
 
         try:
-            conn = sqlite3.connect(DB_NAME)
+            conn = get_db()
             c = conn.cursor()
             c.execute(
                 "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
                 (username, password, role),
             )
             conn.commit()
-            conn.close()
+            invalidate_user_card(c.lastrowid)
             message = "アカウントを登録しました"
         except sqlite3.IntegrityError:
+            conn.rollback()
             message = "そのユーザー名はすでに使われています"
 
     return render_template("register.html", message=message)
@@ -383,77 +2934,70 @@ def home():
     if "username" not in session:
         return redirect(url_for("login"))
 
-    filter_role = request.args.get("role")
-    filter_genre = request.args.get("genre_filter")
-    filter_instrument = request.args.get("instrument_filter")
-    filter_my_instrument = request.args.get("my_instrument_filter")
-    filter_tags_str = request.args.get("tags", "").strip()
-    filter_q = request.args.get("q", "").strip()
+    filters = _feed_filters_from_args(request.args)
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    conn = get_db()
+    posts, next_cursor = cached_feed_page(conn, filters)
+    prime_media_urls(
+        [p["media_path"] for p in posts] + [p["avatar_path"] for p in posts] + [header_avatar_path()]
+    )
 
-    where_clauses = []
-    params = []
+    return render_template(
+        "home.html",
+        username=session.get("username"),
+        role=session.get("role", "individual"),
+        posts=posts,
+        next_cursor=next_cursor,
+        filter_role=filters["role"],
+        filter_genre=filters["genre"],
+        filter_instrument=filters["instrument"],
+        filter_my_instrument=filters["my_instrument"],
+        filter_tags_str=(request.args.get("tags") or "").strip(),
+        filter_q=filters["q"],
+    )
 
-    if filter_role in ("individual", "band"):
-        where_clauses.append("u.role = ?")
-        params.append(filter_role)
 
-    if filter_genre:
-        where_clauses.append("p.genre = ?")
-        params.append(filter_genre)
+# Infinite scroll: next feed page for the same filters as /home
+@app.route("/api/posts", methods=["GET"])
+def api_posts():
+    if "user_id" not in session:
+        return jsonify({"error": "unauthorized"}), 401
 
-    if filter_instrument:
-        where_clauses.append("p.target_instrument = ?")
-        params.append(filter_instrument)
+    filters = _feed_filters_from_args(request.args)
 
-    if filter_my_instrument:
-        where_clauses.append("p.my_instrument = ?")
-        params.append(filter_my_instrument)
-
-    if filter_tags_str:
-        tag_list = [t.strip() for t in filter_tags_str.split(",") if t.strip()]
-        if tag_list:
-            tag_conditions = []
-            for t in tag_list:
-                tag_conditions.append("p.tags LIKE ?")
-                params.append(f"%{t}%")
-            where_clauses.append("(" + " OR ".join(tag_conditions) + ")")
-
-    if filter_q:
-        where_clauses.append("(p.caption LIKE ? OR p.tags LIKE ? OR u.username LIKE ?)")
-        like = f"%{filter_q}%"
-        params.extend([like, like, like])
+    cursor_raw = request.args.get("cursor")
+    cursor = _decode_feed_cursor(cursor_raw)
+    if cursor_raw and cursor is None:
+        return jsonify({"error": "invalid cursor"}), 400
 
-    where_sql = ""
-    if where_clauses:
-        where_sql = "WHERE " + " AND ".join(where_clauses)
+    try:
+        limit = int(request.args.get("limit", FEED_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
 
-    query = f"""
-        SELECT p.*, u.username, u.role, u.avatar_path
-        FROM posts p
-        JOIN users u ON p.user_id = u.id
-        {where_sql}
-        ORDER BY p.created_at DESC
-    """
-    c.execute(query, params)
-    posts = c.fetchall()
-    conn.close()
+    conn = get_db()
+    try:
+        posts, next_cursor = cached_feed_page(conn, filters, cursor, limit)
+    except ValueError:
+        # relevance cursor that is not a number
+        return jsonify({"error": "invalid cursor"}), 400
 
-    return render_template(
-        "home.html",
-        username=session.get("username"),
-        role=session.get("role", "individual"),
-        posts=posts,
-        filter_role=filter_role,
-        filter_genre=filter_genre,
-        filter_instrument=filter_instrument,
-        filter_my_instrument=filter_my_instrument,
-        filter_tags_str=filter_tags_str,
-        filter_q=filter_q,
-    )
+    prime_media_urls([p["media_path"] for p in posts] + [p["avatar_path"] for p in posts])
+    html = render_template("_feed_posts.html", posts=posts, username=session.get("username"))
+
+    return jsonify({
+        "posts": posts,
+        "html": html,
+        "next_cursor": next_cursor,
+    })
+
+
+@app.route("/api/feed_cache/stats", methods=["GET"])
+def api_feed_cache_stats():
+    if "user_id" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(feed_cache.stats())
 
 
 @app.route("/profile")
@@ -463,26 +3007,21 @@ def profile():
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
-    c.execute("SELECT id, username, role, bio, avatar_path FROM users WHERE id = ?", (me,))
+    c.execute("""
+        SELECT id, username, role, bio, avatar_path, follower_count, following_count
+        FROM users WHERE id = ?
+    """, (me,))
     user = c.fetchone()
     if not user:
-        conn.close()
         return redirect(url_for("logout"))
 
     avatar = user["avatar_path"] or default_avatar_for(user["role"])
 
-    c.execute("SELECT COUNT(*) AS cnt FROM follows WHERE following_id = ?", (me,))
-    follower_count = c.fetchone()["cnt"]
-
-    c.execute("SELECT COUNT(*) AS cnt FROM follows WHERE follower_id = ?", (me,))
-    following_count = c.fetchone()["cnt"]
-
     showcase_items = get_showcase_items(conn, me)
-    conn.close()
+    prime_media_urls([avatar] + [item["media_path"] for item in showcase_items])
 
     return render_template(
         "profile.html",
@@ -491,8 +3030,8 @@ def profile():
         username=user["username"],
         role=user["role"],
         bio=user["bio"],
-        follower_count=follower_count,
-        following_count=following_count,
+        follower_count=user["follower_count"],
+        following_count=user["following_count"],
         page_user_id=me,
         showcase_items=showcase_items,
     )
@@ -510,46 +3049,37 @@ def update_profile():
     if not new_username:
         return "username is required", 400
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT username, role, avatar_path FROM users WHERE id = ?", (me,))
     me_row = c.fetchone()
     if not me_row:
-        conn.close()
         return "User not found", 404
 
     if new_username != me_row["username"]:
         c.execute("SELECT 1 FROM users WHERE username = ? AND id != ?", (new_username, me))
         if c.fetchone():
-            conn.close()
             return "そのユーザー名はすでに使われています", 400
 
     avatar_path = me_row["avatar_path"]
-    old_avatar_key = r2_key_from_db_path(avatar_path)
 
+    icon_key = (request.form.get("icon_key") or "").strip()
     file = request.files.get("icon")
-    if file and file.filename:
+    if icon_key:
+        # already in R2 via /api/uploads/presign
+        try:
+            avatar_path = claim_upload(conn, me, "avatar", icon_key)
+        except ValueError as e:
+            return str(e), 400
+    elif file and file.filename:
         if not allowed_avatar(file.filename):
-            conn.close()
             return "Invalid avatar file type", 400
+        avatar_path = store_upload(file)
 
-        unique = _unique_upload_name("avatar", me, file.filename)
-
-        if r2_enabled():
-            new_key = r2_make_key("avatars", unique)
-            r2_upload(file, new_key)
-            avatar_path = r2_path_for_key(new_key)
-
-            # optional cleanup: delete prior avatar object (only if it was stored in R2)
-            if old_avatar_key and old_avatar_key.startswith("avatars/"):
-                r2_delete_key(old_avatar_key)
-        else:
-            # fallback to local storage
-            save_path = os.path.join(app.config["UPLOAD_FOLDER"], unique)
-            file.save(save_path)
-            avatar_path = "/" + save_path.replace(os.sep, "/")
+    if avatar_path != me_row["avatar_path"]:
+        media_ref(conn, [avatar_path])
+        media_unref(conn, [me_row["avatar_path"]])
 
     c.execute("""
         UPDATE users
@@ -558,7 +3088,14 @@ def update_profile():
     """, (new_username, new_bio, avatar_path, me))
 
     conn.commit()
-    conn.close()
+    invalidate_user_card(me)
+    if avatar_path != me_row["avatar_path"]:
+        schedule_media_variants(avatar_path, "avatar", me)
+
+    renamed = new_username != me_row["username"]
+    if renamed or avatar_path != me_row["avatar_path"]:
+        invalidate_feed_for_user(me, renamed=renamed)
+        note_feed_write()
 
     session["username"] = new_username
     return redirect(url_for("profile"))
@@ -571,10 +3108,19 @@ def update_showcase():
 
     me = session["user_id"]
     delete_ids = request.form.getlist("delete_ids")
-    files = request.files.getlist("files[]")
+    files = [
+        f for f in request.files.getlist("files[]")
+        if f and f.filename and allowed_file(f.filename)
+    ]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    # upload first, outside any transaction, so the DB is not locked meanwhile
+    try:
+        new_paths = store_showcase_files(files)
+    except Exception:
+        app.logger.exception("showcase upload failed")
+        return "Upload failed", 502
+
+    conn = get_db()
     c = conn.cursor()
 
     # delete only my items (and delete R2 object if applicable)
@@ -584,40 +3130,29 @@ def update_showcase():
         except ValueError:
             continue
 
-        c.execute("SELECT media_path FROM showcase_items WHERE id = ? AND user_id = ?", (sid, me))
+        c.execute("DELETE FROM showcase_items WHERE id = ? AND user_id = ? RETURNING media_path", (sid, me))
         row = c.fetchone()
         if row:
-            key = r2_key_from_db_path(row["media_path"])
-            if key:
-                r2_delete_key(key)
-
-        c.execute("DELETE FROM showcase_items WHERE id = ? AND user_id = ?", (sid, me))
+            media_unref(conn, [row["media_path"]])
 
-    # add uploads
-    for f in files:
-        if not f or not f.filename:
-            continue
-        if not allowed_file(f.filename):
+    # direct uploads (keys from /api/uploads/presign), then form uploads
+    media_paths = []
+    for key in request.form.getlist("media_keys"):
+        try:
+            media_paths.append(claim_upload(conn, me, "showcase", key.strip()))
+        except ValueError:
             continue
+    media_paths.extend(new_paths)
 
-        unique = _unique_upload_name("showcase", me, f.filename)
-
-        if r2_enabled():
-            key = r2_make_key("showcase", unique)
-            r2_upload(f, key)
-            media_path = r2_path_for_key(key)
-        else:
-            save_path = os.path.join(app.config["UPLOAD_FOLDER"], unique)
-            f.save(save_path)
-            media_path = "/" + save_path.replace(os.sep, "/")
-
-        c.execute(
-            "INSERT INTO showcase_items (user_id, media_path) VALUES (?, ?)",
-            (me, media_path),
-        )
+    c.executemany(
+        "INSERT INTO showcase_items (user_id, media_path) VALUES (?, ?)",
+        [(me, p) for p in media_paths],
+    )
+    media_ref(conn, media_paths)
 
     conn.commit()
-    conn.close()
+    for p in media_paths:
+        schedule_media_variants(p, "showcase")
     return redirect(url_for("profile"))
 
 
@@ -648,8 +3183,7 @@ def create_post():
     target_instrument = request.form.get("instrument_filter", "")
     tags = request.form.get("tags", "").strip()
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     # ---------- EDIT MODE ----------
@@ -657,77 +3191,84 @@ def create_post():
         c.execute("SELECT user_id, media_path FROM posts WHERE id = ?", (post_id,))
         row = c.fetchone()
         if not row:
-            conn.close()
             return "Post not found", 404
         if row["user_id"] != me:
-            conn.close()
             return "Forbidden", 403
 
         media_path = row["media_path"]
-        old_key = r2_key_from_db_path(media_path)
 
         # if user clicked the X, remove existing media
         remove_media = (request.form.get("remove_media") or "0") == "1"
         if remove_media:
-            if old_key:
-                r2_delete_key(old_key)
-            elif media_path and media_path.startswith("/static/uploads/"):
-                try:
-                    os.remove(media_path.lstrip("/"))
-                except OSError:
-                    pass
             media_path = None
 
         # If user uploads a new file, it overrides removal
+        media_key = (request.form.get("media_key") or "").strip()
         file = request.files.get("media")
-        if file and file.filename and allowed_file(file.filename):
-            unique = _unique_upload_name("post", me, file.filename)
-
-            if r2_enabled():
-                new_key = r2_make_key("posts", unique)
-                r2_upload(file, new_key)
-                media_path = r2_path_for_key(new_key)
-
-                # optional cleanup: delete prior object if replacing
-                if old_key:
-                    r2_delete_key(old_key)
-            else:
-                save_path = os.path.join(app.config["UPLOAD_FOLDER"], unique)
-                file.save(save_path)
-                media_path = "/" + save_path.replace(os.sep, "/")
+        if media_key:
+            try:
+                media_path = claim_upload(conn, me, "post", media_key)
+            except ValueError as e:
+                return str(e), 400
+        elif file and file.filename and allowed_file(file.filename):
+            media_path = store_upload(file)
+
+        # the old blob goes only if nothing else uses it
+        if media_path != row["media_path"]:
+            media_ref(conn, [media_path])
+            media_unref(conn, [row["media_path"]])
 
         c.execute("""
             UPDATE posts
             SET caption=?, genre=?, my_instrument=?, target_instrument=?, tags=?, media_path=?
             WHERE id=?
         """, (caption, genre, my_instrument, target_instrument, tags, media_path, post_id))
+        sync_post_tags(conn, post_id, tags)
 
         conn.commit()
-        conn.close()
+        if media_path != row["media_path"]:
+            schedule_media_variants(media_path, "post")
+
+        invalidate_feed_for_post(post_id, {
+            "role": session.get("role"),
+            "genre": genre,
+            "my_instrument": my_instrument,
+            "target_instrument": target_instrument,
+            "tags": tags,
+        })
+        note_feed_write()
         return redirect(url_for("home"))
 
     # ---------- CREATE MODE ----------
     media_path = None
+    media_key = (request.form.get("media_key") or "").strip()
     file = request.files.get("media")
-    if file and file.filename and allowed_file(file.filename):
-        unique = _unique_upload_name("post", me, file.filename)
-
-        if r2_enabled():
-            key = r2_make_key("posts", unique)
-            r2_upload(file, key)
-            media_path = r2_path_for_key(key)
-        else:
-            save_path = os.path.join(app.config["UPLOAD_FOLDER"], unique)
-            file.save(save_path)
-            media_path = "/" + save_path.replace(os.sep, "/")
+    if media_key:
+        try:
+            media_path = claim_upload(conn, me, "post", media_key)
+        except ValueError as e:
+            return str(e), 400
+    elif file and file.filename and allowed_file(file.filename):
+        media_path = store_upload(file)
+    media_ref(conn, [media_path])
 
     c.execute("""
         INSERT INTO posts (user_id, caption, genre, my_instrument, target_instrument, tags, media_path)
         VALUES (?, ?, ?, ?, ?, ?, ?)
     """, (me, caption, genre, my_instrument, target_instrument, tags, media_path))
+    sync_post_tags(conn, c.lastrowid, tags)
 
     conn.commit()
-    conn.close()
+    schedule_media_variants(media_path, "post")
+
+    invalidate_feed_for_new_post({
+        "role": session.get("role"),
+        "genre": genre,
+        "my_instrument": my_instrument,
+        "target_instrument": target_instrument,
+        "tags": tags,
+    })
+    note_feed_write()
     return redirect(url_for("home"))
 
 
@@ -738,37 +3279,51 @@ def delete_post(post_id):
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT user_id, media_path FROM posts WHERE id = ?", (post_id,))
     row = c.fetchone()
     if not row:
-        conn.close()
         return "Post not found", 404
     if row["user_id"] != me:
-        conn.close()
         return "Forbidden", 403
 
-    # optional: delete underlying media
-    key = r2_key_from_db_path(row["media_path"])
-    if key:
-        r2_delete_key(key)
-    elif row["media_path"] and row["media_path"].startswith("/static/uploads/"):
-        try:
-            os.remove(row["media_path"].lstrip("/"))
-        except OSError:
-            pass
+    # underlying media goes with its last reference
+    media_unref(conn, [row["media_path"]])
 
     c.execute("DELETE FROM posts WHERE id = ?", (post_id,))
     conn.commit()
-    conn.close()
+
+    invalidate_feed_for_post(post_id)
+    note_feed_write()
     return redirect(url_for("home"))
 
 
 # ======================= FOLLOW API =======================
 
+def update_follow_counts(conn, follower_id: int, following_id: int, delta: int):
+    """Apply one follow (+1) / unfollow (-1) to the users counters, in the caller's transaction."""
+    conn.execute("""
+        UPDATE users
+        SET follower_count = follower_count + CASE WHEN id = ? THEN ? ELSE 0 END,
+            following_count = following_count + CASE WHEN id = ? THEN ? ELSE 0 END
+        WHERE id IN (?, ?)
+    """, (following_id, delta, follower_id, delta, follower_id, following_id))
+
+
+@app.cli.command("repair-follow-counts")
+def repair_follow_counts_command():
+    """Recompute users.follower_count / following_count from the follows table."""
+    conn = connect_db()
+    try:
+        fixed = conn.execute(REPAIR_FOLLOW_COUNTS_SQL).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f"repaired follow counts for {fixed} users")
+
+
 @app.route("/api/follow/toggle", methods=["POST"])
 def api_follow_toggle():
     if "user_id" not in session:
@@ -787,13 +3342,11 @@ def api_follow_toggle():
     if target == me:
         return jsonify({"error": "cannot follow yourself"}), 400
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT id FROM users WHERE id = ?", (target,))
     if not c.fetchone():
-        conn.close()
         return jsonify({"error": "user not found"}), 404
 
     c.execute("""
@@ -808,18 +3361,23 @@ def api_follow_toggle():
             WHERE follower_id = ? AND following_id = ?
         """, (me, target))
         is_following = False
+        delta = -1
     else:
         c.execute("""
             INSERT OR IGNORE INTO follows (follower_id, following_id)
             VALUES (?, ?)
         """, (me, target))
         is_following = True
+        delta = 1
+
+    # rowcount 0: a concurrent toggle got there first, the counts already match
+    if c.rowcount:
+        update_follow_counts(conn, me, target, delta)
 
-    c.execute("SELECT COUNT(*) AS cnt FROM follows WHERE following_id = ?", (target,))
-    follower_count = c.fetchone()["cnt"]
+    c.execute("SELECT follower_count FROM users WHERE id = ?", (target,))
+    follower_count = c.fetchone()["follower_count"]
 
     conn.commit()
-    conn.close()
 
     return jsonify({
         "is_following": is_following,
@@ -827,167 +3385,307 @@ def api_follow_toggle():
     })
 
 
-@app.route("/api/users/<int:user_id>/followers", methods=["GET"])
-def api_followers(user_id):
-    if "user_id" not in session:
-        return jsonify({"error": "unauthorized"}), 401
+# ---- Follower / following lists (keyset pagination on username, id) ----
+FOLLOW_PAGE_SIZE = 50
+FOLLOW_MAX_PAGE_SIZE = 100
+# Lists up to this size are read through the follows index and sorted; longer
+# ones walk users in username order (the UNIQUE index) and probe the follows
+# primary key per row, so a page costs about limit * users / list size probes
+# instead of sorting the whole list.
+FOLLOW_LIST_SORT_MAX = int(os.getenv("FOLLOW_LIST_SORT_MAX", "2000"))
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
 
-    c.execute("""
-        SELECT u.id, u.username, u.role, u.avatar_path
-        FROM follows f
-        JOIN users u ON u.id = f.follower_id
-        WHERE f.following_id = ?
-        ORDER BY u.username ASC
-    """, (user_id,))
-    rows = c.fetchall()
-    conn.close()
+def fetch_follow_page(conn, user_id: int, direction: str, me: int, list_size: int,
+                      cursor=None, limit: int = FOLLOW_PAGE_SIZE):
+    """One page of user_id's followers / following, ordered by (username, id).
 
-    out = []
+    Each user carries is_following_by_me / follows_me for the viewer, computed
+    in the same query. Returns (users, next_cursor).
+    """
+    if direction == "followers":
+        # rows where u follows user_id
+        member_col, other_col = "follower_id", "following_id"
+    else:
+        member_col, other_col = "following_id", "follower_id"
+
+    params = {"uid": user_id, "me": me, "limit": limit + 1}
+    where = []
+    if cursor is not None:
+        where.append("(u.username, u.id) > (:after_name, :after_id)")
+        params["after_name"], params["after_id"] = cursor
+
+    if list_size > FOLLOW_LIST_SORT_MAX:
+        source = "users u"
+        where.append(f"""EXISTS (
+            SELECT 1 FROM follows f WHERE f.{member_col} = u.id AND f.{other_col} = :uid
+        )""")
+    else:
+        source = f"follows f JOIN users u ON u.id = f.{member_col}"
+        where.append(f"f.{other_col} = :uid")
+
+    rows = conn.execute(f"""
+        SELECT u.id, u.username, u.role, u.avatar_path, mv.path AS thumb_path,
+               EXISTS (
+                   SELECT 1 FROM follows x WHERE x.follower_id = :me AND x.following_id = u.id
+               ) AS is_following_by_me,
+               EXISTS (
+                   SELECT 1 FROM follows y WHERE y.follower_id = u.id AND y.following_id = :me
+               ) AS follows_me
+        FROM {source}
+        LEFT JOIN media_variants mv
+            ON mv.source_path = u.avatar_path AND mv.kind = 'avatar' AND mv.variant = 'thumb'
+        WHERE {" AND ".join(where)}
+        ORDER BY u.username, u.id
+        LIMIT :limit
+    """, params).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    users = []
     for r in rows:
-        out.append({
-            "id": r["id"],
-            "username": r["username"],
-            "role": r["role"],
-            "avatar": r["avatar_path"] or default_avatar_for(r["role"]),
-        })
-    return jsonify(out)
+        item = UserCard(r["id"], r["username"], r["role"], r["avatar_path"], r["thumb_path"]).to_json()
+        item["is_following_by_me"] = bool(r["is_following_by_me"])
+        item["follows_me"] = bool(r["follows_me"])
+        users.append(item)
 
+    # same opaque "<value>|<id>" format as feed cursors
+    next_cursor = _encode_feed_cursor(rows[-1]["username"], rows[-1]["id"]) if has_more else None
+    return users, next_cursor
 
-@app.route("/api/users/<int:user_id>/following", methods=["GET"])
-def api_following(user_id):
+
+def _follow_list_response(user_id: int, direction: str):
     if "user_id" not in session:
         return jsonify({"error": "unauthorized"}), 401
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    cursor_raw = request.args.get("cursor")
+    cursor = _decode_feed_cursor(cursor_raw)
+    if cursor_raw and cursor is None:
+        return jsonify({"error": "invalid cursor"}), 400
 
-    c.execute("""
-        SELECT u.id, u.username, u.role, u.avatar_path
-        FROM follows f
-        JOIN users u ON u.id = f.following_id
-        WHERE f.follower_id = ?
-        ORDER BY u.username ASC
-    """, (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    try:
+        limit = int(request.args.get("limit", FOLLOW_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+    limit = max(1, min(limit, FOLLOW_MAX_PAGE_SIZE))
+
+    conn = get_db()
+    count_col = "follower_count" if direction == "followers" else "following_count"
+    row = conn.execute(f"SELECT {count_col} AS cnt FROM users WHERE id = ?", (user_id,)).fetchone()
+    if not row:
+        return jsonify({"error": "user not found"}), 404
 
-    out = []
-    for r in rows:
-        out.append({
-            "id": r["id"],
-            "username": r["username"],
-            "role": r["role"],
-            "avatar": r["avatar_path"] or default_avatar_for(r["role"]),
-        })
-    return jsonify(out)
+    users, next_cursor = fetch_follow_page(conn, user_id, direction, session["user_id"], row["cnt"], cursor, limit)
+    return jsonify({
+        "users": users,
+        "next_cursor": next_cursor,
+        "total": row["cnt"],
+    })
+
+
+@app.route("/api/users/<int:user_id>/followers", methods=["GET"])
+def api_followers(user_id):
+    return _follow_list_response(user_id, "followers")
+
+
+@app.route("/api/users/<int:user_id>/following", methods=["GET"])
+def api_following(user_id):
+    return _follow_list_response(user_id, "following")
 
 
 # ======================= MESSAGING API =======================
 
-@app.route("/api/conversations", methods=["GET"])
-def api_conversations():
+@app.route("/api/stream", methods=["GET"])
+def api_stream():
+    """SSE: message-created / message-deleted / conversation-unhidden for the logged-in user."""
     if "user_id" not in session:
         return jsonify({"error": "unauthorized"}), 401
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    # EventSource sends Last-Event-ID on reconnect; ?last_event_id= for manual resumes
+    raw_last = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_id = int(raw_last) if raw_last else None
+    except ValueError:
+        last_id = None
+
+    if not _sse_slots.acquire(blocking=False):
+        # EventSource gives up on a non-200 answer; the pages then poll instead
+        return Response("too many open streams", status=503, headers={"Retry-After": "60"})
+
+    def generate():
+        # the stream outlives the request context, so it gets its own connection
+        conn = connect_db()
+        wake = event_hub.subscribe(me)
+        try:
+            cursor_id = last_id
+            if cursor_id is None:
+                # fresh stream: only events from now on
+                row = conn.execute(
+                    "SELECT COALESCE(MAX(id), 0) FROM user_events WHERE user_id = ?", (me,)
+                ).fetchone()
+                cursor_id = row[0]
+
+            # an id-only event sets Last-Event-ID, so even an idle stream reconnects
+            # from here instead of from a fresh MAX(id) that skips the retry gap
+            yield f"retry: {SSE_RETRY_MS}\nid: {cursor_id}\n\n"
+
+            started = last_beat = time.monotonic()
+            while time.monotonic() - started < SSE_MAX_STREAM_SECONDS:
+                # clear before reading so a wake-up during the read is not lost
+                wake.clear()
+                rows = conn.execute("""
+                    SELECT id, event, data
+                    FROM user_events
+                    WHERE user_id = ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                """, (me, cursor_id, SSE_BATCH_SIZE)).fetchall()
+
+                for r in rows:
+                    cursor_id = r["id"]
+                    yield _sse_format(r["id"], r["event"], r["data"])
+                if len(rows) == SSE_BATCH_SIZE:
+                    continue
+                if rows:
+                    last_beat = time.monotonic()
+
+                # local publishers wake us; other workers' events show up on the next poll
+                wake.wait(SSE_POLL_INTERVAL)
+
+                if time.monotonic() - last_beat >= SSE_HEARTBEAT_SECONDS:
+                    last_beat = time.monotonic()
+                    yield f": ping\nid: {cursor_id}\n\n"
+        finally:
+            event_hub.unsubscribe(me, wake)
+            conn.close()
 
-    c.execute("""
+    resp = Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # nginx / Render proxies: do not buffer the stream
+        "X-Accel-Buffering": "no",
+    })
+    # runs when the server closes the response, even if the stream never started
+    resp.call_on_close(_sse_slots.release)
+    return resp
+
+
+def fetch_inbox(conn, me: int, since=None):
+    """Inbox rows for me; with since, only conversations whose change_seq > since."""
+    if since is None:
+        my_convs = """
+          SELECT id, user1_id, user2_id, created_at FROM conversations WHERE user1_id = ?
+          UNION ALL
+          SELECT id, user1_id, user2_id, created_at FROM conversations WHERE user2_id = ?
+        """
+        params = [me, me]
+    else:
+        my_convs = """
+          SELECT c.id, c.user1_id, c.user2_id, c.created_at
+          FROM conversation_states cs
+          JOIN conversations c ON c.id = cs.conversation_id
+          WHERE cs.user_id = ? AND cs.change_seq > ?
+        """
+        params = [me, since]
+
+    c = conn.cursor()
+    # One statement for the whole inbox: last message and unread flag are
+    # index lookups per row (idx_messages_conversation_created), no N+1 from Python.
+    c.execute(f"""
+        WITH my_convs AS ({my_convs})
         SELECT
           c.id AS conversation_id,
           c.user1_id,
           c.user2_id,
-          u1.username AS user1_name,
-          u1.role     AS user1_role,
-          u1.avatar_path AS user1_avatar,
-          u2.username AS user2_name,
-          u2.role     AS user2_role,
-          u2.avatar_path AS user2_avatar,
-          (
-            SELECT body FROM messages m
-            WHERE m.conversation_id = c.id
-            ORDER BY m.created_at DESC
-            LIMIT 1
-          ) AS last_message,
-          (
-            SELECT created_at FROM messages m
+          lm.body       AS last_message,
+          lm.created_at AS last_created_at,
+          EXISTS (
+            SELECT 1 FROM messages m
             WHERE m.conversation_id = c.id
-            ORDER BY m.created_at DESC
-            LIMIT 1
-          ) AS last_created_at
-        FROM conversations c
-        JOIN users u1 ON u1.id = c.user1_id
-        JOIN users u2 ON u2.id = c.user2_id
+              AND m.created_at > COALESCE(r.last_read_at, '')
+              AND m.sender_id != ?
+          ) AS unread
+        FROM my_convs c
         LEFT JOIN conversation_states s
           ON s.conversation_id = c.id AND s.user_id = ?
-        WHERE (c.user1_id = ? OR c.user2_id = ?)
-          AND COALESCE(s.hidden, 0) = 0
+        LEFT JOIN conversation_reads r
+          ON r.conversation_id = c.id AND r.user_id = ?
+        LEFT JOIN messages lm
+          ON lm.id = (
+            SELECT m.id FROM messages m
+            WHERE m.conversation_id = c.id
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT 1
+          )
+        WHERE COALESCE(s.hidden, 0) = 0
         ORDER BY last_created_at DESC, c.created_at DESC
-    """, (me, me, me))
+    """, (*params, me, me, me))
 
     rows = c.fetchall()
+    cards = get_user_cards(r["user2_id"] if r["user1_id"] == me else r["user1_id"] for r in rows)
 
     convs = []
     for r in rows:
-        if r["user1_id"] == me:
-            other_id = r["user2_id"]
-            other_name = r["user2_name"]
-            other_role = r["user2_role"]
-            other_avatar = r["user2_avatar"] or default_avatar_for(other_role)
-        else:
-            other_id = r["user1_id"]
-            other_name = r["user1_name"]
-            other_role = r["user1_role"]
-            other_avatar = r["user1_avatar"] or default_avatar_for(other_role)
-
-        c2 = conn.cursor()
-        c2.execute("""
-            SELECT last_read_at
-            FROM conversation_reads
-            WHERE conversation_id = ? AND user_id = ?
-        """, (r["conversation_id"], me))
-        rd = c2.fetchone()
-
-        if rd and rd["last_read_at"]:
-            last_read_at = rd["last_read_at"]
-            c2.execute("""
-                SELECT COUNT(*) AS cnt
-                FROM messages
-                WHERE conversation_id = ?
-                  AND sender_id != ?
-                  AND created_at > ?
-            """, (r["conversation_id"], me, last_read_at))
-        else:
-            c2.execute("""
-                SELECT COUNT(*) AS cnt
-                FROM messages
-                WHERE conversation_id = ?
-                  AND sender_id != ?
-            """, (r["conversation_id"], me))
-
-        unread_count = c2.fetchone()["cnt"]
-        unread = unread_count > 0
+        other_id = r["user2_id"] if r["user1_id"] == me else r["user1_id"]
+        other = cards.get(other_id)
+        if not other:
+            continue
 
         convs.append({
             "id": r["conversation_id"],
             "other_user_id": other_id,
-            "other_username": other_name,
-            "other_avatar": other_avatar,
+            "other_username": other.username,
+            "other_avatar": other.thumb,
             "last_message": r["last_message"] or "",
             "last_created_at": r["last_created_at"],
-            "unread": unread,
+            "unread": bool(r["unread"]),
         })
+    return convs
 
-    conn.close()
-    return jsonify(convs)
+
+def fetch_inbox_removed(conn, me: int, since: int):
+    """Conversation ids changed after since that left my inbox (hidden or deleted)."""
+    c = conn.cursor()
+    c.execute("""
+        SELECT cs.conversation_id
+        FROM conversation_states cs
+        LEFT JOIN conversations c ON c.id = cs.conversation_id
+        WHERE cs.user_id = ? AND cs.change_seq > ?
+          AND (cs.hidden != 0 OR c.id IS NULL)
+    """, (me, since))
+    return [r["conversation_id"] for r in c.fetchall()]
+
+
+@app.route("/api/conversations", methods=["GET"])
+def api_conversations():
+    """Full inbox (list, token in X-Inbox-Token) or, with ?since=, only what changed."""
+    if "user_id" not in session:
+        return jsonify({"error": "unauthorized"}), 401
+
+    me = session["user_id"]
+
+    since_raw = request.args.get("since")
+    since = None
+    if since_raw not in (None, ""):
+        try:
+            since = _parse_inbox_token(since_raw)
+        except ValueError:
+            return jsonify({"error": "invalid since"}), 400
+
+    conn = get_db()
+    token = current_inbox_token(conn)
+
+    if since is None:
+        resp = jsonify(fetch_inbox(conn, me))
+        resp.headers["X-Inbox-Token"] = token
+        return resp
+
+    return jsonify({
+        "conversations": fetch_inbox(conn, me, since),
+        "removed": fetch_inbox_removed(conn, me, since),
+        "token": token,
+    })
 
 
 @app.route("/api/messages/<int:msg_id>/delete", methods=["POST"])
@@ -997,29 +3695,36 @@ def api_delete_message(msg_id):
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT id, conversation_id, sender_id FROM messages WHERE id = ?", (msg_id,))
     m = c.fetchone()
     if not m:
-        conn.close()
         return jsonify({"error": "message not found"}), 404
 
     if m["sender_id"] != me:
-        conn.close()
         return jsonify({"error": "forbidden"}), 403
 
-    c.execute("SELECT user1_id, user2_id FROM conversations WHERE id = ?", (m["conversation_id"],))
+    c.execute("SELECT user1_id, user2_id, last_message_id FROM conversations WHERE id = ?", (m["conversation_id"],))
     conv = c.fetchone()
     if not conv or me not in (conv["user1_id"], conv["user2_id"]):
-        conn.close()
         return jsonify({"error": "forbidden"}), 403
 
     c.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+    # tombstone for ?after_id= deltas; also changes the conversation ETag
+    c.execute("""
+        INSERT INTO message_tombstones (conversation_id, message_id, seq)
+        VALUES (?, ?, ?)
+    """, (m["conversation_id"], msg_id, conv["last_message_id"]))
+    c.execute("UPDATE conversations SET last_tombstone_id = ? WHERE id = ?", (c.lastrowid, m["conversation_id"]))
+    for uid in (conv["user1_id"], conv["user2_id"]):
+        publish_event(conn, uid, "message-deleted", {
+            "conversation_id": m["conversation_id"],
+            "message_id": msg_id,
+        })
+    mark_inbox_changed(conn, [(m["conversation_id"], conv["user1_id"]), (m["conversation_id"], conv["user2_id"])])
     conn.commit()
-    conn.close()
 
     return jsonify({"ok": True, "deleted_id": msg_id})
 
@@ -1043,8 +3748,7 @@ def api_delete_conversations():
     if not conv_ids:
         return jsonify({"ok": True, "deleted": 0})
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     qmarks = ",".join(["?"] * len(conv_ids))
@@ -1060,7 +3764,6 @@ def api_delete_conversations():
     allowed = [row["id"] for row in c.fetchall()]
 
     if not allowed:
-        conn.close()
         return jsonify({"ok": True, "deleted": 0})
 
     qmarks2 = ",".join(["?"] * len(allowed))
@@ -1090,9 +3793,9 @@ def api_delete_conversations():
         """,
         params2,
     )
+    mark_inbox_changed(conn, [(conv_id, me) for conv_id in allowed])
 
     conn.commit()
-    conn.close()
 
     return jsonify({"ok": True, "deleted": len(allowed)})
 
@@ -1110,18 +3813,21 @@ def api_start_conversation():
     except (TypeError, ValueError):
         return jsonify({"error": "invalid other_user_id"}), 400
 
+    try:
+        limit, _ = _message_page_args(data.get("limit"), None)
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid limit"}), 400
+
     me = session["user_id"]
     if other_user_id == me:
         return jsonify({"error": "cannot message yourself"}), 400
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT id, username FROM users WHERE id = ?", (other_user_id,))
     row = c.fetchone()
     if not row:
-        conn.close()
         return jsonify({"error": "user not found"}), 404
     other_username = row["username"]
 
@@ -1142,8 +3848,11 @@ def api_start_conversation():
     c.execute("""
         UPDATE conversation_states
         SET hidden = 0
-        WHERE conversation_id = ? AND user_id = ?
+        WHERE conversation_id = ? AND user_id = ? AND hidden != 0
     """, (conv_id, me))
+    # my other tabs/devices put the conversation back into their inbox
+    if not conv or c.rowcount:
+        publish_event(conn, me, "conversation-unhidden", {"conversation_id": conv_id})
 
     c.execute("""
         SELECT cleared_at
@@ -1153,22 +3862,7 @@ def api_start_conversation():
     st = c.fetchone()
     cleared_at = st["cleared_at"] if st else None
 
-    if cleared_at:
-        c.execute("""
-            SELECT id, sender_id, body, created_at
-            FROM messages
-            WHERE conversation_id = ?
-              AND created_at > ?
-            ORDER BY created_at ASC
-        """, (conv_id, cleared_at))
-    else:
-        c.execute("""
-            SELECT id, sender_id, body, created_at
-            FROM messages
-            WHERE conversation_id = ?
-            ORDER BY created_at ASC
-        """, (conv_id,))
-    msgs = c.fetchall()
+    msgs, has_more = fetch_message_page(conn, conv_id, cleared_at, limit=limit)
 
     last_read_at = datetime.utcnow().isoformat(" ")
     c.execute("""
@@ -1177,8 +3871,9 @@ def api_start_conversation():
         ON CONFLICT(conversation_id, user_id)
         DO UPDATE SET last_read_at = excluded.last_read_at
     """, (conv_id, me, last_read_at))
+    # a new conversation shows up (empty) in the other inbox as well
+    mark_inbox_changed(conn, [(conv_id, me)] if conv else [(conv_id, me), (conv_id, other_user_id)])
     conn.commit()
-    conn.close()
 
     messages = [{
         "id": m["id"],
@@ -1192,6 +3887,7 @@ def api_start_conversation():
         "other_user_id": other_user_id,
         "other_username": other_username,
         "messages": messages,
+        "has_more": has_more,
     })
 
 
@@ -1202,79 +3898,83 @@ def api_conversation_messages(conv_id):
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    try:
+        limit, before_id = _message_page_args(request.args.get("limit"), request.args.get("before_id"))
+        after_raw = request.args.get("after_id")
+        after_id = None if after_raw in (None, "") else int(after_raw)
+    except ValueError:
+        return jsonify({"error": "invalid limit, before_id or after_id"}), 400
+    if after_id is not None and (after_id < 0 or before_id is not None):
+        return jsonify({"error": "invalid limit, before_id or after_id"}), 400
+
+    conn = get_db()
     c = conn.cursor()
 
+    # conversation + my state in one lookup; enough to answer If-None-Match
     c.execute("""
-        SELECT c.*, u1.username AS user1_name, u2.username AS user2_name
+        SELECT c.id, c.user1_id, c.user2_id, c.last_message_id, c.last_tombstone_id, s.cleared_at
         FROM conversations c
-        JOIN users u1 ON u1.id = c.user1_id
-        JOIN users u2 ON u2.id = c.user2_id
+        LEFT JOIN conversation_states s
+          ON s.conversation_id = c.id AND s.user_id = ?
         WHERE c.id = ?
-    """, (conv_id,))
+    """, (me, conv_id))
     conv = c.fetchone()
     if not conv:
-        conn.close()
         return jsonify({"error": "conversation not found"}), 404
 
     if me not in (conv["user1_id"], conv["user2_id"]):
-        conn.close()
         return jsonify({"error": "forbidden"}), 403
 
+    cleared_at = conv["cleared_at"]
+    etag = conversation_etag(conv, me, cleared_at)
+
+    # nothing new, deleted or cleared: no messages read, no read-marker write
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
+
     other_id = conv["user2_id"] if conv["user1_id"] == me else conv["user1_id"]
-    other_username = conv["user2_name"] if conv["user1_id"] == me else conv["user1_name"]
+    other = get_user_card(other_id)
 
     ensure_conv_state(conn, conv_id, me)
 
-    c.execute("""
-        SELECT cleared_at
-        FROM conversation_states
-        WHERE conversation_id = ? AND user_id = ?
-    """, (conv_id, me))
-    st = c.fetchone()
-    cleared_at = st["cleared_at"] if st else None
+    payload = {
+        "conversation_id": conv_id,
+        "other_user_id": other_id,
+        "other_username": other.username if other else None,
+    }
 
-    if cleared_at:
-        c.execute("""
-            SELECT id, sender_id, body, created_at
-            FROM messages
-            WHERE conversation_id = ?
-              AND created_at > ?
-            ORDER BY created_at ASC
-        """, (conv_id, cleared_at))
+    if after_id is not None:
+        rows, payload["has_newer"] = fetch_messages_after(conn, conv_id, cleared_at, after_id, limit)
+        payload["deleted_ids"] = fetch_deleted_message_ids(conn, conv_id, after_id)
     else:
-        c.execute("""
-            SELECT id, sender_id, body, created_at
-            FROM messages
-            WHERE conversation_id = ?
-            ORDER BY created_at ASC
-        """, (conv_id,))
-    rows = c.fetchall()
+        rows, payload["has_more"] = fetch_message_page(conn, conv_id, cleared_at, before_id, limit)
 
-    last_read_at = datetime.utcnow().isoformat(" ")
-    c.execute("""
-        INSERT INTO conversation_reads (conversation_id, user_id, last_read_at)
-        VALUES (?, ?, ?)
-        ON CONFLICT(conversation_id, user_id)
-        DO UPDATE SET last_read_at = excluded.last_read_at
-    """, (conv_id, me, last_read_at))
+    # loading older history does not change what has been read
+    if before_id is None:
+        last_read_at = datetime.utcnow().isoformat(" ")
+        c.execute("""
+            INSERT INTO conversation_reads (conversation_id, user_id, last_read_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(conversation_id, user_id)
+            DO UPDATE SET last_read_at = excluded.last_read_at
+        """, (conv_id, me, last_read_at))
+        mark_inbox_changed(conn, [(conv_id, me)])
     conn.commit()
-    conn.close()
 
-    messages = [{
+    payload["messages"] = [{
         "id": m["id"],
         "body": m["body"],
         "created_at": m["created_at"],
         "from_me": (m["sender_id"] == me),
     } for m in rows]
 
-    return jsonify({
-        "conversation_id": conv_id,
-        "other_user_id": other_id,
-        "other_username": other_username,
-        "messages": messages,
-    })
+    resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 @app.route("/api/messages", methods=["POST"])
@@ -1296,42 +3996,48 @@ def api_send_message():
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT user1_id, user2_id FROM conversations WHERE id = ?", (conv_id,))
     conv = c.fetchone()
     if not conv:
-        conn.close()
         return jsonify({"error": "conversation not found"}), 404
 
     if me not in (conv["user1_id"], conv["user2_id"]):
-        conn.close()
         return jsonify({"error": "forbidden"}), 403
 
     c.execute("INSERT INTO messages (conversation_id, sender_id, body) VALUES (?, ?, ?)", (conv_id, me, body))
     msg_id = c.lastrowid
+    c.execute("UPDATE conversations SET last_message_id = ? WHERE id = ?", (msg_id, conv_id))
 
     c.execute("SELECT created_at FROM messages WHERE id = ?", (msg_id,))
     row = c.fetchone()
 
+    created_at = row["created_at"] if row else None
+
     other_id = conv["user2_id"] if conv["user1_id"] == me else conv["user1_id"]
     ensure_conv_state(conn, conv_id, other_id)
     c.execute("""
         UPDATE conversation_states
         SET hidden = 0
-        WHERE conversation_id = ? AND user_id = ?
+        WHERE conversation_id = ? AND user_id = ? AND hidden != 0
     """, (conv_id, other_id))
+    if c.rowcount:
+        publish_event(conn, other_id, "conversation-unhidden", {"conversation_id": conv_id})
+
+    for uid in (me, other_id):
+        publish_event(conn, uid, "message-created",
+                      _message_event_payload(conv_id, msg_id, me, body, created_at, uid))
+    mark_inbox_changed(conn, [(conv_id, me), (conv_id, other_id)])
 
     conn.commit()
-    conn.close()
 
     return jsonify({
         "id": msg_id,
         "conversation_id": conv_id,
         "body": body,
-        "created_at": row["created_at"] if row else None,
+        "created_at": created_at,
         "from_me": True,
     })
 
@@ -1348,12 +4054,11 @@ def api_user_search():
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("""
-        SELECT id, username, role, avatar_path
+        SELECT id
         FROM users
         WHERE username LIKE ?
           AND id != ?
@@ -1361,18 +4066,10 @@ def api_user_search():
         LIMIT 10
     """, (f"%{q}%", me))
 
-    rows = c.fetchall()
-    conn.close()
+    ids = [r["id"] for r in c.fetchall()]
+    cards = get_user_cards(ids)
 
-    users = []
-    for r in rows:
-        avatar = r["avatar_path"] or default_avatar_for(r["role"])
-        users.append({
-            "id": r["id"],
-            "username": r["username"],
-            "role": r["role"],
-            "avatar": avatar,
-        })
+    users = [cards[uid].to_json() for uid in ids if uid in cards]
     return jsonify(users)
 
 
@@ -1384,24 +4081,19 @@ def user_profile(user_id):
 
     me = session["user_id"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
-    c.execute("SELECT id, username, role, bio, avatar_path FROM users WHERE id = ?", (user_id,))
+    c.execute("""
+        SELECT id, username, role, bio, avatar_path, follower_count, following_count
+        FROM users WHERE id = ?
+    """, (user_id,))
     user = c.fetchone()
     if not user:
-        conn.close()
         return "User not found", 404
 
     avatar = user["avatar_path"] or default_avatar_for(user["role"])
 
-    c.execute("SELECT COUNT(*) AS cnt FROM follows WHERE following_id = ?", (user_id,))
-    follower_count = c.fetchone()["cnt"]
-
-    c.execute("SELECT COUNT(*) AS cnt FROM follows WHERE follower_id = ?", (user_id,))
-    following_count = c.fetchone()["cnt"]
-
     c.execute("""
         SELECT 1 FROM follows
         WHERE follower_id = ? AND following_id = ?
@@ -1409,14 +4101,14 @@ def user_profile(user_id):
     is_following = c.fetchone() is not None
 
     showcase_items = get_showcase_items(conn, user_id)
-    conn.close()
+    prime_media_urls([avatar, header_avatar_path()] + [item["media_path"] for item in showcase_items])
 
     return render_template(
         "user_profile.html",
         user=user,
         avatar=avatar,
-        follower_count=follower_count,
-        following_count=following_count,
+        follower_count=user["follower_count"],
+        following_count=user["following_count"],
         is_following=is_following,
         showcase_items=showcase_items,
     )
@@ -1434,19 +4126,16 @@ def api_account_delete():
     if not password:
         return jsonify({"error": "password required"}), 400
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     c.execute("SELECT password FROM users WHERE id = ?", (me,))
     row = c.fetchone()
     if not row:
-        conn.close()
         session.clear()
         return jsonify({"error": "user not found"}), 404
 
     if row["password"] != password:
-        conn.close()
         return jsonify({"error": "パスワードが正しくありません"}), 403
 
     c.execute("DELETE FROM messages WHERE sender_id = ?", (me,))
@@ -1458,44 +4147,59 @@ def api_account_delete():
     """, (me, me))
     c.execute("DELETE FROM conversation_reads WHERE user_id = ?", (me,))
     c.execute("DELETE FROM conversation_states WHERE user_id = ?", (me,))
+    # the other side sees these conversations as removed on its next ?since= refresh
+    c.execute("SELECT id, user1_id, user2_id FROM conversations WHERE user1_id = ? OR user2_id = ?", (me, me))
+    mark_inbox_changed(conn, [
+        (r["id"], r["user2_id"] if r["user1_id"] == me else r["user1_id"]) for r in c.fetchall()
+    ])
+
+    c.execute("""
+        DELETE FROM message_tombstones
+        WHERE conversation_id IN (
+            SELECT id FROM conversations WHERE user1_id = ? OR user2_id = ?
+        )
+    """, (me, me))
     c.execute("DELETE FROM conversations WHERE user1_id = ? OR user2_id = ?", (me, me))
+    c.execute("DELETE FROM user_events WHERE user_id = ?", (me,))
 
+    # the people on the other end of my follows lose one follower / following
+    c.execute("""
+        UPDATE users SET follower_count = follower_count - 1
+        WHERE id IN (SELECT following_id FROM follows WHERE follower_id = ?)
+    """, (me,))
+    c.execute("""
+        UPDATE users SET following_count = following_count - 1
+        WHERE id IN (SELECT follower_id FROM follows WHERE following_id = ?)
+    """, (me,))
     c.execute("DELETE FROM follows WHERE follower_id = ? OR following_id = ?", (me, me))
 
-    # Optional: delete R2 objects for showcase/posts for this user before deleting rows
-    c.execute("SELECT media_path FROM showcase_items WHERE user_id = ?", (me,))
-    for r in c.fetchall():
-        key = r2_key_from_db_path(r["media_path"])
-        if key:
-            r2_delete_key(key)
-
-    c.execute("SELECT media_path FROM posts WHERE user_id = ?", (me,))
-    for r in c.fetchall():
-        key = r2_key_from_db_path(r["media_path"])
-        if key:
-            r2_delete_key(key)
-
-    # Optional: delete avatar object
-    c.execute("SELECT avatar_path FROM users WHERE id = ?", (me,))
-    av = c.fetchone()
-    if av and av["avatar_path"]:
-        key = r2_key_from_db_path(av["avatar_path"])
-        if key:
-            r2_delete_key(key)
+    # one reference per showcase item / post / avatar; unshared blobs are deleted
+    c.execute("""
+        SELECT media_path AS path FROM showcase_items WHERE user_id = ?
+        UNION ALL
+        SELECT media_path FROM posts WHERE user_id = ?
+        UNION ALL
+        SELECT avatar_path FROM users WHERE id = ?
+    """, (me, me, me))
+    media_unref(conn, [r["path"] for r in c.fetchall()])
 
     c.execute("DELETE FROM showcase_items WHERE user_id = ?", (me,))
     c.execute("DELETE FROM posts WHERE user_id = ?", (me,))
     c.execute("DELETE FROM users WHERE id = ?", (me,))
 
     conn.commit()
-    conn.close()
+    invalidate_user_card(me)
+
+    invalidate_feed_for_user(me)
 
     session.clear()
     return jsonify({"ok": True})
 
 
 # ---- Run app ----
+# run on import so gunicorn workers get new tables/indexes too
+init_db()
+
 if __name__ == "__main__":
-    init_db()
     app.run(port=5001, debug=True)
 
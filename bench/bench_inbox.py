@@ -0,0 +1,105 @@
+"""Benchmark GET /api/conversations as the inbox grows.
+
+Builds a throwaway database per size, then reports median latency and the
+number of SQL statements one inbox request runs. The statement count should
+stay constant; latency should grow roughly with the rows returned.
+
+    python bench/bench_inbox.py --sizes 10,100,300,1000 --messages 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build_db(conn, n_conversations: int, messages_per_conv: int):
+    c = conn.cursor()
+    c.execute("INSERT INTO users (id, username, password, role) VALUES (1, 'me', 'pw', 'individual')")
+    c.executemany(
+        "INSERT INTO users (id, username, password, role) VALUES (?, ?, 'pw', ?)",
+        [(uid, f"user{uid}", "band" if uid % 3 == 0 else "individual") for uid in range(2, n_conversations + 2)],
+    )
+    c.executemany(
+        "INSERT INTO conversations (id, user1_id, user2_id) VALUES (?, 1, ?)",
+        [(cid, cid + 1) for cid in range(1, n_conversations + 1)],
+    )
+    rows = []
+    for cid in range(1, n_conversations + 1):
+        for i in range(messages_per_conv):
+            sender = 1 if i % 2 else cid + 1
+            ts = f"2024-01-01 00:{(cid * 7 + i) % 60:02d}:{i % 60:02d}"
+            rows.append((cid, sender, f"message {i}", ts))
+    c.executemany(
+        "INSERT INTO messages (conversation_id, sender_id, body, created_at) VALUES (?, ?, ?, ?)",
+        rows,
+    )
+    # half the inbox has been read
+    c.executemany(
+        "INSERT INTO conversation_reads (conversation_id, user_id, last_read_at) VALUES (?, 1, '2024-01-01 00:30:00')",
+        [(cid,) for cid in range(1, n_conversations + 1, 2)],
+    )
+    conn.commit()
+
+
+def run(sizes, messages_per_conv: int, repeat: int):
+    workdir = tempfile.mkdtemp(prefix="bandme-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as bandme
+
+    statements = []
+    connect_db = bandme.connect_db
+
+    def traced_connect():
+        conn = connect_db()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    bandme.connect_db = traced_connect
+
+    print(f"{'conversations':>13} {'median ms':>10} {'p95 ms':>8} {'statements':>10}")
+    for n in sizes:
+        bandme.DB_NAME = os.path.join(workdir, f"inbox_{n}.db")
+        bandme.init_db()
+        conn = connect_db()
+        build_db(conn, n, messages_per_conv)
+        conn.close()
+        bandme.user_card_cache.clear()
+
+        client = bandme.app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = 1
+            sess["username"] = "me"
+
+        client.get("/api/conversations")  # warm caches
+
+        timings = []
+        counts = []
+        for _ in range(repeat):
+            statements.clear()
+            t0 = time.perf_counter()
+            res = client.get("/api/conversations")
+            timings.append((time.perf_counter() - t0) * 1000)
+            counts.append(sum(1 for s in statements if not s.startswith("PRAGMA")))
+            assert res.status_code == 200 and len(res.get_json()) == n
+
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{n:>13} {statistics.median(timings):>10.2f} {p95:>8.2f} {max(counts):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,300,1000")
+    parser.add_argument("--messages", type=int, default=20, help="messages per conversation")
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+    run([int(x) for x in args.sizes.split(",")], args.messages, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
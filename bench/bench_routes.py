@@ -0,0 +1,225 @@
+"""Route-level benchmarks against a seeded database (see bench/seed.py).
+
+Drives the hot routes through the Flask test client as user 1 and reports
+p50 / p95 / p99 latency and SQL statements per request. Results can be saved
+as a baseline and later runs compared against it; a route regresses when its
+p95 grows by more than --threshold (and --min-delta-ms) or it runs more
+statements than before.
+
+    python bench/seed.py --out bench/data/small.db --scale 0.01
+    python bench/bench_routes.py --db bench/data/small.db --save bench/baselines/small.json
+    python bench/bench_routes.py --db bench/data/small.db --compare bench/baselines/small.json
+
+--cold clears the in-process caches (feed pages, user cards, signed URLs)
+before every request, which is closer to a freshly started worker.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = 1
+
+
+def pick_fixtures(conn) -> dict:
+    """Concrete ids for parameterised routes: the busiest conversation and user."""
+    conv = conn.execute("""
+        SELECT id FROM conversations WHERE user1_id = ? OR user2_id = ?
+        ORDER BY last_message_id DESC LIMIT 1
+    """, (USER_ID, USER_ID)).fetchone()
+    popular = conn.execute("""
+        SELECT following_id FROM follows WHERE following_id != ?
+        GROUP BY following_id ORDER BY COUNT(*) DESC LIMIT 1
+    """, (USER_ID,)).fetchone()
+    return {
+        "conv_id": conv[0] if conv else 1,
+        "user_id": popular[0] if popular else 2,
+    }
+
+
+def routes(fx: dict) -> list:
+    # (name, url); everything runs logged in as USER_ID
+    return [
+        ("home", "/home"),
+        ("api_posts", "/api/posts"),
+        ("api_posts_filtered", "/api/posts?genre_filter=jazz&instrument_filter=drum&tags=東京"),
+        ("api_posts_search", "/api/posts?q=スタジオ"),
+        ("profile", "/profile"),
+        ("user_profile", f"/user/{fx['user_id']}"),
+        ("api_followers", f"/api/users/{fx['user_id']}/followers"),
+        ("api_following", f"/api/users/{USER_ID}/following"),
+        ("api_conversations", "/api/conversations"),
+        ("api_conversation_messages", f"/api/conversations/{fx['conv_id']}/messages"),
+        ("api_user_search", "/api/user_search?q=user00"),
+    ]
+
+
+def is_app_statement(sql: str) -> bool:
+    """Statements the app issued, not PRAGMAs, trigger bodies ("-- ...") or
+    FTS5's own reads of its shadow tables ('main'.'posts_fts_data' ...)."""
+    return not sql.startswith(("PRAGMA", "--")) and "'main'." not in sql
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def run(db: str, repeat: int, warmup: int, only, cold: bool) -> dict:
+    db = os.path.abspath(db)
+    if not os.path.exists(db):
+        raise SystemExit(f"{db} not found; build it with bench/seed.py")
+
+    # importing app runs init_db() on ./users.db; keep that out of the repo
+    os.chdir(tempfile.mkdtemp(prefix="bandme-bench-"))
+    sys.path.insert(0, REPO_ROOT)
+    import app as bandme
+
+    bandme.DB_NAME = db
+    bandme.init_db()  # no-op on an up-to-date seed; applies newer migrations otherwise
+
+    statements = []
+    connect_db = bandme.connect_db
+
+    def traced_connect():
+        conn = connect_db()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    bandme.connect_db = traced_connect
+
+    with sqlite3.connect(db) as conn:
+        fx = pick_fixtures(conn)
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                  for t in ("users", "posts", "follows", "conversations", "messages")}
+
+    client = bandme.app.test_client()
+    with client.session_transaction() as sess:
+        sess["user_id"] = USER_ID
+        sess["username"] = f"user{USER_ID:06d}"
+        sess["role"] = "individual"
+
+    def clear_caches():
+        bandme.feed_cache.clear()
+        bandme.user_card_cache.clear()
+        bandme.signed_url_cache.clear()
+
+    results = {}
+    print(f"{'route':<28} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for name, url in routes(fx):
+        if only and name not in only:
+            continue
+        for _ in range(warmup):
+            client.get(url)
+
+        timings = []
+        queries = []
+        for _ in range(repeat):
+            if cold:
+                clear_caches()
+            statements.clear()
+            t0 = time.perf_counter()
+            res = client.get(url)
+            timings.append((time.perf_counter() - t0) * 1000)
+            queries.append(sum(1 for s in statements if is_app_statement(s)))
+            if res.status_code != 200:
+                raise SystemExit(f"{name}: GET {url} returned {res.status_code}")
+
+        timings.sort()
+        results[name] = {
+            "url": url,
+            "p50_ms": round(percentile(timings, 50), 3),
+            "p95_ms": round(percentile(timings, 95), 3),
+            "p99_ms": round(percentile(timings, 99), 3),
+            "mean_ms": round(statistics.fmean(timings), 3),
+            "queries": max(queries),
+        }
+        r = results[name]
+        print(f"{name:<28} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['queries']:>8}")
+
+    return {
+        "meta": {
+            "db": os.path.basename(db),
+            "rows": counts,
+            "repeat": repeat,
+            "cold": cold,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float, min_delta_ms: float) -> int:
+    """Print a diff against the baseline; returns the number of regressions."""
+    if baseline["meta"].get("rows") != current["meta"]["rows"]:
+        print("warning: baseline was recorded on a different dataset", baseline["meta"].get("rows"))
+    if baseline["meta"].get("cold") != current["meta"]["cold"]:
+        print("warning: baseline was recorded with a different --cold setting")
+
+    regressions = 0
+    print(f"\n{'route':<28} {'base p95':>9} {'p95':>9} {'change':>8} {'queries':>9}")
+    for name, cur in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<28} {'-':>9} {cur['p95_ms']:>9.2f} {'new':>8} {cur['queries']:>9}")
+            continue
+        change = (cur["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+        # sub-millisecond routes jitter by more than the threshold on their own
+        slower = change > threshold and cur["p95_ms"] - base["p95_ms"] > min_delta_ms
+        more_queries = cur["queries"] > base["queries"]
+        flag = "  <-- REGRESSION" if slower or more_queries else ""
+        regressions += bool(flag)
+        print(f"{name:<28} {base['p95_ms']:>9.2f} {cur['p95_ms']:>9.2f} {change:>+8.0%} "
+              f"{base['queries']:>4}->{cur['queries']:<4}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=os.path.join(REPO_ROOT, "bench", "data", "seed.db"))
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--routes", default="", help="comma-separated subset of route names")
+    parser.add_argument("--cold", action="store_true", help="clear in-process caches before each request")
+    parser.add_argument("--save", metavar="FILE", help="write results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.20, help="allowed p95 growth (0.20 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="ignore p95 growth smaller than this many ms")
+    args = parser.parse_args()
+
+    only = {r for r in args.routes.split(",") if r}
+    # run() changes into a scratch directory
+    save = os.path.abspath(args.save) if args.save else None
+    baseline_file = os.path.abspath(args.compare) if args.compare else None
+    current = run(args.db, args.repeat, args.warmup, only, args.cold)
+
+    if save:
+        os.makedirs(os.path.dirname(save), exist_ok=True)
+        with open(save, "w", encoding="utf-8") as fh:
+            json.dump(current, fh, indent=2, ensure_ascii=False)
+        print(f"\nbaseline saved to {args.save}")
+
+    if baseline_file:
+        with open(baseline_file, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        regressions = compare(current, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"\n{regressions} route(s) regressed")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
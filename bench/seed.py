@@ -0,0 +1,246 @@
+"""Build a synthetic BANDme database at production-like scale.
+
+Creates the schema through app.init_db() (so migrations match the app), then
+bulk-loads users, posts (genres / instruments / tags), showcase items, follows,
+conversations and messages with executemany in large transactions. Popularity
+is skewed: a few users get most of the followers and post the most.
+
+    python bench/seed.py --out bench/data/seed.db                # full size (slow, GBs)
+    python bench/seed.py --out bench/data/small.db --scale 0.01  # ~1% of that, seconds
+
+Every logged-in benchmark uses user 1 (username user000001, password "pw").
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# same values as the <select>s in templates/home.html
+GENRES = ["classic", "jazz", "blues", "pop", "metal", "rock", "other"]
+INSTRUMENTS = ["acoustic", "bass", "drum", "electric_guitar", "keyboard", "piano", "vocal", "other"]
+TAGS = [
+    "初心者歓迎", "社会人", "学生", "東京", "大阪", "名古屋", "福岡", "週末", "平日夜", "ライブ",
+    "レコーディング", "コピバン", "オリジナル", "jpop", "ジャズセッション", "metalcore", "funk",
+    "fusion", "indie", "acoustic", "cover", "作曲", "作詞", "dtm", "ボカロ", "アニソン",
+]
+CAPTION_WORDS = [
+    "メンバー募集", "一緒に", "スタジオ", "練習", "できる方", "を探しています", "よろしくお願いします",
+    "経験", "年", "ライブ予定あり", "looking for", "a drummer", "bassist", "jam session",
+    "weekend", "original songs", "気軽に", "連絡ください", "週1", "で活動中",
+]
+MESSAGE_WORDS = [
+    "こんにちは", "はじめまして", "投稿見ました", "ありがとうございます", "いつ空いてますか",
+    "スタジオ", "了解です", "よろしくお願いします", "hello", "sounds good", "see you", "👍",
+]
+
+BATCH = 50_000
+DAY = 86400
+
+
+def chunks(rows, size=BATCH):
+    it = iter(rows)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ts(t: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+def skewed(rng: random.Random, n: int, power: float = 3.0) -> int:
+    """1..n, low ids much more likely (a few very popular / active users)."""
+    return 1 + min(n - 1, int(n * rng.random() ** power))
+
+
+def bulk(conn, sql: str, rows, label: str):
+    t0 = time.perf_counter()
+    total = 0
+    for batch in chunks(rows):
+        conn.execute("BEGIN")
+        conn.executemany(sql, batch)
+        conn.commit()
+        total += len(batch)
+    print(f"  {label:<14} {total:>11,} rows  {time.perf_counter() - t0:7.1f}s", flush=True)
+    return total
+
+
+def gen_users(rng, n_users, now):
+    for uid in range(1, n_users + 1):
+        role = "band" if rng.random() < 0.25 else "individual"
+        bio = " ".join(rng.sample(CAPTION_WORDS, 3)) if rng.random() < 0.6 else ""
+        yield uid, f"user{uid:06d}", "pw", role, bio
+
+
+def gen_posts(rng, n_posts, n_users, start, span, split_tags, post_tags):
+    for pid in range(1, n_posts + 1):
+        tags = ",".join(rng.sample(TAGS, rng.randint(0, 3)))
+        post_tags.extend((pid, t) for t in split_tags(tags))
+        yield (
+            pid,
+            skewed(rng, n_users, 2.0),
+            " ".join(rng.choices(CAPTION_WORDS, k=rng.randint(3, 12))),
+            rng.choice(GENRES + [""]),
+            rng.choice(INSTRUMENTS + [""]),
+            rng.choice(INSTRUMENTS + [""]),
+            tags,
+            None,
+            ts(start + span * pid / n_posts),
+        )
+
+
+def gen_follows(rng, n_follows, n_users, start, span):
+    seen = set()
+    while len(seen) < n_follows:
+        follower = rng.randint(1, n_users)
+        following = skewed(rng, n_users)
+        if follower == following:
+            continue
+        pair = follower * (n_users + 1) + following
+        if pair in seen:
+            continue
+        seen.add(pair)
+        yield follower, following, ts(start + span * rng.random())
+
+
+def gen_conversations(rng, n_convs, n_users, start, span, pairs):
+    seen = set()
+    cid = 0
+    while cid < n_convs:
+        a, b = rng.randint(1, n_users), skewed(rng, n_users, 2.0)
+        if a == b:
+            continue
+        u1, u2 = min(a, b), max(a, b)
+        key = u1 * (n_users + 1) + u2
+        if key in seen:
+            continue
+        seen.add(key)
+        cid += 1
+        pairs.append((u1, u2))
+        yield cid, u1, u2, ts(start + span * cid / n_convs)
+
+
+def gen_messages(rng, n_messages, pairs, start, span):
+    n_convs = len(pairs)
+    for mid in range(1, n_messages + 1):
+        cid = skewed(rng, n_convs, 1.5)
+        u1, u2 = pairs[cid - 1]
+        yield (
+            mid,
+            cid,
+            u1 if rng.random() < 0.5 else u2,
+            " ".join(rng.choices(MESSAGE_WORDS, k=rng.randint(1, 8))),
+            ts(start + span * mid / n_messages),
+        )
+
+
+def seed(out: str, users: int, posts: int, showcase: int, follows: int,
+         conversations: int, messages: int, seed_value: int):
+    out = os.path.abspath(out)
+    if os.path.exists(out):
+        raise SystemExit(f"{out} exists; remove it first")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+
+    # importing app runs init_db() on ./users.db; keep that out of the repo
+    os.chdir(tempfile.mkdtemp(prefix="bandme-seed-"))
+    sys.path.insert(0, REPO_ROOT)
+    import app as bandme
+
+    bandme.DB_NAME = out
+    bandme.init_db()
+
+    rng = random.Random(seed_value)
+    now = time.time()
+    start = now - 365 * DAY
+    span = 365 * DAY - 60
+    follows = min(follows, users * (users - 1) // 2)
+    conversations = min(conversations, users * (users - 1) // 4)
+
+    conn = sqlite3.connect(bandme.DB_NAME, isolation_level=None)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")  # 256 MiB
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+    # the FTS index is rebuilt in one pass at the end instead of per-row triggers
+    conn.execute("DROP TRIGGER IF EXISTS posts_fts_ai")
+    conn.execute("DROP TABLE IF EXISTS posts_fts")
+
+    print(f"seeding {out}")
+    bulk(conn, "INSERT INTO users (id, username, password, role, bio) VALUES (?, ?, ?, ?, ?)",
+         gen_users(rng, users, now), "users")
+
+    post_tags = []
+    bulk(conn, """
+        INSERT INTO posts (id, user_id, caption, genre, my_instrument, target_instrument, tags, media_path, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, gen_posts(rng, posts, users, start, span, bandme._split_tags, post_tags), "posts")
+    bulk(conn, "INSERT INTO post_tags (post_id, tag) VALUES (?, ?)", post_tags, "post_tags")
+    del post_tags
+
+    bulk(conn, "INSERT INTO showcase_items (user_id, media_path, created_at) VALUES (?, ?, ?)",
+         ((skewed(rng, users, 2.0), "/static/img/profile_icon_band.png", ts(start + span * rng.random()))
+          for _ in range(showcase)), "showcase")
+
+    bulk(conn, "INSERT INTO follows (follower_id, following_id, created_at) VALUES (?, ?, ?)",
+         gen_follows(rng, follows, users, start, span), "follows")
+
+    pairs = []
+    bulk(conn, "INSERT INTO conversations (id, user1_id, user2_id, created_at) VALUES (?, ?, ?, ?)",
+         gen_conversations(rng, conversations, users, start, span, pairs), "conversations")
+    if pairs:
+        bulk(conn, "INSERT INTO messages (id, conversation_id, sender_id, body, created_at) VALUES (?, ?, ?, ?, ?)",
+             gen_messages(rng, messages, pairs, start, span), "messages")
+    del pairs
+
+    t0 = time.perf_counter()
+    conn.execute("BEGIN")
+    # derived state the request handlers keep up to date
+    conn.execute("""
+        UPDATE conversations
+        SET last_message_id = COALESCE((SELECT MAX(id) FROM messages m WHERE m.conversation_id = conversations.id), 0)
+    """)
+    # about half of each user's chats have been read
+    conn.execute("""
+        INSERT INTO conversation_reads (conversation_id, user_id, last_read_at)
+        SELECT id, user1_id, created_at FROM conversations WHERE id % 2 = 0
+    """)
+    conn.execute(bandme.REPAIR_FOLLOW_COUNTS_SQL)
+    bandme._ensure_post_search_index(conn)
+    conn.commit()
+    print(f"  {'derived':<14} {'':>11}       {time.perf_counter() - t0:7.1f}s", flush=True)
+
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"done: {os.path.getsize(out) / 1e6:,.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", default=os.path.join(REPO_ROOT, "bench", "data", "seed.db"))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for every count below")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--posts", type=int, default=1_000_000)
+    parser.add_argument("--showcase", type=int, default=200_000)
+    parser.add_argument("--follows", type=int, default=5_000_000)
+    parser.add_argument("--conversations", type=int, default=1_000_000)
+    parser.add_argument("--messages", type=int, default=10_000_000)
+    parser.add_argument("--seed", type=int, default=1, help="random seed (same seed => same DB)")
+    args = parser.parse_args()
+
+    def n(x):
+        return max(1, int(x * args.scale))
+
+    seed(args.out, max(2, n(args.users)), n(args.posts), n(args.showcase), n(args.follows),
+         n(args.conversations), n(args.messages), args.seed)
+
+
+if __name__ == "__main__":
+    main()
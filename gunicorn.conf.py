@@ -0,0 +1,18 @@
+# gunicorn settings; `gunicorn app:app` picks this file up from the working directory.
+#
+# /api/stream (Server-Sent Events) keeps one thread busy per open tab for up to
+# SSE_MAX_STREAM_SECONDS, so sync workers (one request at a time) would stall
+# the site with a handful of tabs. gthread workers serve each request on a
+# thread; app.py caps streams per worker (SSE_MAX_STREAMS_PER_WORKER) below
+# `threads` so normal requests always have threads left.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+# worker heartbeat; with gthread long streams do not count against it
+timeout = 60
+# restarts wait this long for open streams before closing them
+graceful_timeout = 30
+keepalive = 5
@@ -0,0 +1,90 @@
+// =============== DIRECT UPLOADS (browser -> R2, no file bytes through Flask) =====================
+// On submit, files in the bound inputs are PUT to a presigned R2 URL and the
+// form sends the returned keys instead. If presigning is unavailable (local
+// storage) or anything fails, the form is submitted as a normal multipart post.
+(function () {
+  async function postJson(url, body) {
+    const res = await fetch(url, {
+      method: "POST",
+      credentials: "same-origin",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(body),
+    });
+    if (!res.ok) throw new Error(`${url} failed (${res.status})`);
+    return res.json();
+  }
+
+  async function uploadFile(kind, file) {
+    const p = await postJson("/api/uploads/presign", {
+      kind,
+      filename: file.name,
+      size: file.size,
+    });
+
+    const put = await fetch(p.url, {
+      method: p.method || "PUT",
+      headers: p.headers || {},
+      body: file,
+    });
+    if (!put.ok) throw new Error(`upload failed (${put.status})`);
+
+    await postJson("/api/uploads/finalize", { key: p.key });
+    return p.key;
+  }
+
+  function addHidden(form, name, value) {
+    const inp = document.createElement("input");
+    inp.type = "hidden";
+    inp.name = name;
+    inp.value = value;
+    inp.dataset.directUpload = "1";
+    form.appendChild(inp);
+  }
+
+  // bindings: [{ inputs: () => [fileInput, ...], kind: "post", field: "media_key" }]
+  function bindForm(form, bindings) {
+    if (!form || !window.fetch) return;
+    let busy = false;
+
+    form.addEventListener("submit", async (e) => {
+      const jobs = [];
+      bindings.forEach((b) => {
+        b.inputs().forEach((input) => {
+          if (input && !input.disabled && input.files && input.files.length) {
+            jobs.push({ input, kind: b.kind, field: b.field });
+          }
+        });
+      });
+      if (!jobs.length) return; // nothing to upload: normal submit
+
+      e.preventDefault();
+      if (busy) return;
+      busy = true;
+
+      // form.elements also covers buttons outside the form (form="...")
+      const submitBtns = Array.from(form.elements).filter((el) => el.type === "submit");
+      submitBtns.forEach((btn) => { btn.disabled = true; });
+
+      for (const job of jobs) {
+        try {
+          const keys = [];
+          for (const file of Array.from(job.input.files)) {
+            keys.push(await uploadFile(job.kind, file));
+          }
+          keys.forEach((key) => addHidden(form, job.field, key));
+          // disabled inputs are not submitted, so the bytes stay out of the request
+          job.input.disabled = true;
+        } catch (err) {
+          // keep this input in the multipart body instead
+          console.error(err);
+        }
+      }
+
+      busy = false;
+      submitBtns.forEach((btn) => { btn.disabled = false; });
+      HTMLFormElement.prototype.submit.call(form);
+    });
+  }
+
+  window.directUpload = { uploadFile, bindForm };
+})();
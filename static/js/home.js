@@ -1,5 +1,17 @@
 // home.js
 
+// =============== MEDIA URL FALLBACK =====================
+// pages embed signed R2 URLs; if one has expired (long-open tab), go back to
+// the /r2/ redirect, which signs a fresh one
+document.addEventListener("error", (e) => {
+  const el = e.target;
+  const fallback = el?.dataset?.fallbackSrc;
+  if (!fallback || !fallback.startsWith("/r2/")) return;
+  delete el.dataset.fallbackSrc; // once per element
+  el.removeAttribute("srcset"); // WebP variants are signed too; use the original
+  el.src = fallback;
+}, true);
+
 // =============== PROFILE MENU =====================
 document.addEventListener("DOMContentLoaded", () => {
   const usernameTrigger = document.getElementById("usernameTrigger");
@@ -578,6 +590,12 @@ if (mediaInput && previewBox) {
   });
 }
 
+// =============== DIRECT UPLOAD (CREATE/EDIT POST) =====================
+// media goes straight to R2 when possible (direct_upload.js); sends media_key instead
+window.directUpload?.bindForm(document.getElementById("create-post-form"), [
+  { inputs: () => [mediaInput], kind: "post", field: "media_key" },
+]);
+
 // =============== AUTOGROW TEXTAREA =====================
 const caption = document.getElementById("caption");
 if (caption) {
@@ -614,6 +632,61 @@ document.addEventListener("DOMContentLoaded", () => {
   });
 });
 
+// =============== FEED INFINITE SCROLL =====================
+document.addEventListener("DOMContentLoaded", () => {
+  const sentinel = document.getElementById("feed-sentinel");
+  if (!sentinel) return;
+
+  let nextCursor = sentinel.dataset.nextCursor || "";
+  let loading = false;
+
+  // same filters as the current /home URL
+  const baseParams = new URLSearchParams(window.location.search);
+
+  async function loadMore() {
+    if (loading || !nextCursor) return;
+    loading = true;
+
+    try {
+      const params = new URLSearchParams(baseParams);
+      params.set("cursor", nextCursor);
+
+      const res = await fetch(`/api/posts?${params.toString()}`, { credentials: "same-origin" });
+      if (!res.ok) throw new Error("Failed to load posts");
+      const data = await res.json();
+
+      const tpl = document.createElement("template");
+      tpl.innerHTML = data.html || "";
+      const nodes = Array.from(tpl.content.querySelectorAll(".post"));
+
+      nodes.forEach((node) => {
+        node.querySelectorAll(".post-time[data-utc]").forEach((el) => {
+          el.textContent = formatPostTimeJST(el.dataset.utc);
+        });
+        sentinel.before(node);
+      });
+
+      document.dispatchEvent(new CustomEvent("feed:appended", { detail: { nodes } }));
+
+      nextCursor = data.next_cursor || "";
+      if (!nextCursor) io.disconnect();
+    } catch (err) {
+      console.error(err);
+    } finally {
+      loading = false;
+    }
+  }
+
+  const io = new IntersectionObserver(
+    (entries) => {
+      if (entries.some((e) => e.isIntersecting)) loadMore();
+    },
+    { root: null, rootMargin: "0px 0px 600px 0px" }
+  );
+
+  if (nextCursor) io.observe(sentinel);
+});
+
 /* ================== CHAT MODAL ================== */
 document.addEventListener("DOMContentLoaded", () => {
   const launcher = document.getElementById("chatLauncher");
@@ -637,6 +710,14 @@ document.addEventListener("DOMContentLoaded", () => {
 
   let currentConvId = null;
 
+  // message history paging: latest page first, older pages on scroll-up
+  const scrollBox = msgList.closest(".chat-panel") || msgList;
+  let oldestMsgId = null;
+  let hasOlder = false;
+  let loadingOlder = false;
+  let newestMsgId = 0;
+  let threadEtag = null;
+
   // NEW: conversation delete "select mode"
   let convSelectMode = false;
   const selectedConvIds = new Set();
@@ -823,28 +904,105 @@ document.addEventListener("DOMContentLoaded", () => {
       .join("");
   }
 
-  function renderMessages(messages) {
-    msgList.innerHTML = (messages || [])
-      .map((m) => {
-        const who = m.from_me ? `<div class="who">You</div>` : ``;
-  
-        return `
-          <li class="msg ${m.from_me ? "you" : ""}" data-msg-id="${m.id}">
-            <div>
-              <div class="bubble">
-                ${who}
-                <div class="body">${escapeHtml(m.body)}</div>
-              </div>
-            </div>
-          </li>
-        `;
-      })
-      .join("");
+  function messageHtml(m) {
+    const who = m.from_me ? `<div class="who">You</div>` : ``;
   
+    return `
+      <li class="msg ${m.from_me ? "you" : ""}" data-msg-id="${m.id}">
+        <div>
+          <div class="bubble">
+            ${who}
+            <div class="body">${escapeHtml(m.body)}</div>
+          </div>
+        </div>
+      </li>
+    `;
+  }
+
+  function renderMessages(messages) {
+    msgList.innerHTML = (messages || []).map(messageHtml).join("");
     scrollMessagesToBottom();
   }
 
+  function resetHistory(data) {
+    const msgs = data.messages || [];
+    oldestMsgId = msgs.length ? msgs[0].id : null;
+    hasOlder = !!data.has_more;
+    newestMsgId = msgs.length ? msgs[msgs.length - 1].id : 0;
+    threadEtag = null;
+  }
+
+  // open thread deltas: only messages after newestMsgId + deleted ids, 304 when idle
+  const THREAD_POLL_MS = 10000;
+  let syncingThread = null;
+
+  async function syncThread() {
+    if (!currentConvId) return;
+    if (syncingThread) return syncingThread;
+    const convId = currentConvId;
+
+    syncingThread = (async () => {
+      const res = await fetch(`/api/conversations/${convId}/messages?after_id=${newestMsgId}`, {
+        credentials: "same-origin",
+        // we send If-None-Match ourselves and want to see the 304
+        cache: "no-store",
+        headers: threadEtag ? { "If-None-Match": threadEtag } : {},
+      });
+      if (res.status === 304) return;
+      if (!res.ok) throw new Error("Failed to sync messages");
+      const data = await res.json();
+      if (convId !== currentConvId) return;
+
+      threadEtag = res.headers.get("ETag");
+      (data.deleted_ids || []).forEach((id) => {
+        msgList.querySelector(`[data-msg-id="${id}"]`)?.remove();
+      });
+      (data.messages || []).forEach(appendMessage);
+      if (data.has_newer) setTimeout(() => syncThread().catch(console.error), 0);
+    })().finally(() => {
+      syncingThread = null;
+    });
+    return syncingThread;
+  }
+
+  async function loadOlderMessages() {
+    if (loadingOlder || !hasOlder || !currentConvId || oldestMsgId == null) return;
+    loadingOlder = true;
+    const convId = currentConvId;
+
+    try {
+      const res = await fetch(`/api/conversations/${convId}/messages?before_id=${oldestMsgId}`, {
+        credentials: "same-origin",
+      });
+      if (!res.ok) throw new Error("Failed to load older messages");
+      const data = await res.json();
+      if (convId !== currentConvId) return;
+
+      const msgs = data.messages || [];
+      if (msgs.length) {
+        // keep the viewport on the message the user was reading
+        const prevHeight = scrollBox.scrollHeight;
+        msgList.insertAdjacentHTML("afterbegin", msgs.map(messageHtml).join(""));
+        scrollBox.scrollTop += scrollBox.scrollHeight - prevHeight;
+        oldestMsgId = msgs[0].id;
+      }
+      hasOlder = !!data.has_more;
+    } finally {
+      loadingOlder = false;
+    }
+  }
+
+  scrollBox.addEventListener("scroll", () => {
+    if (!threadView.hidden && scrollBox.scrollTop < 80) {
+      loadOlderMessages().catch(console.error);
+    }
+  }, { passive: true });
+
   function appendMessage(m) {
+    // the same message can arrive from the send response and from /api/stream
+    if (msgList.querySelector(`[data-msg-id="${m.id}"]`)) return;
+    newestMsgId = Math.max(newestMsgId, Number(m.id) || 0);
+
     const li = document.createElement("li");
     li.className = `msg ${m.from_me ? "you" : ""}`;
     li.dataset.msgId = m.id;
@@ -864,13 +1022,52 @@ document.addEventListener("DOMContentLoaded", () => {
     scrollMessagesToBottom();
   }
 
-  async function loadConversations() {
+  // inbox: one full list, then only what changed since the last token
+  let inboxToken = null;
+  let inboxLoading = Promise.resolve();
+
+  function sortConversations(convs) {
+    // same order as the server: newest last message first, empty conversations last
+    return convs.sort((a, b) => String(b.last_created_at || "").localeCompare(String(a.last_created_at || "")));
+  }
+
+  function mergeConversations(convs, delta) {
+    const drop = new Set([...(delta.removed || []), ...(delta.conversations || []).map((c) => c.id)].map(String));
+    return sortConversations([
+      ...(delta.conversations || []),
+      ...(convs || []).filter((c) => !drop.has(String(c.id))),
+    ]);
+  }
+
+  async function fetchConversations() {
+    if (inboxToken !== null) {
+      const res = await fetch(`/api/conversations?since=${encodeURIComponent(inboxToken)}`, {
+        credentials: "same-origin",
+      });
+      if (res.ok) {
+        const delta = await res.json();
+        inboxToken = delta.token;
+        renderConversations(mergeConversations(lastRenderedConvs, delta));
+        return;
+      }
+      // bad/unknown token: start over with the full list
+      inboxToken = null;
+    }
+
     const res = await fetch("/api/conversations", { credentials: "same-origin" });
     if (!res.ok) throw new Error("Failed to load conversations");
     const convs = await res.json();
+    inboxToken = res.headers.get("X-Inbox-Token");
     renderConversations(convs);
   }
 
+  function loadConversations() {
+    // one at a time so each delta starts from the previous token
+    const run = inboxLoading.catch(() => {}).then(fetchConversations);
+    inboxLoading = run;
+    return run;
+  }
+
   async function openConversation(convId, otherName) {
     const res = await fetch(`/api/conversations/${convId}/messages`, { credentials: "same-origin" });
     if (!res.ok) throw new Error("Failed to load messages");
@@ -880,7 +1077,9 @@ document.addEventListener("DOMContentLoaded", () => {
     threadTitle.textContent = otherName || data.other_username || "Chat";
 
     renderMessages(data.messages || []);
+    resetHistory(data);
     showThread();
+    threadEtag = res.headers.get("ETag");
 
     // opening marks read in backend, so refresh list
     loadConversations().catch(console.error);
@@ -896,7 +1095,8 @@ document.addEventListener("DOMContentLoaded", () => {
     if (!res.ok) throw new Error("Failed to send message");
     const msg = await res.json();
     appendMessage(msg);
-    loadConversations().catch(console.error);
+    // the message-created event refreshes the inbox; without a stream do it here
+    if (!streamOpen) loadConversations().catch(console.error);
   }
 
   // Events
@@ -1007,15 +1207,73 @@ document.addEventListener("DOMContentLoaded", () => {
   // Bootstrap unread dot on page load
   (async function bootstrapUnreadDot() {
     try {
-      const res = await fetch("/api/conversations", { credentials: "same-origin" });
-      if (!res.ok) return;
-      const convs = await res.json();
-      ensureLauncherDot(convs.some((c) => c.unread));
+      // renders the (hidden) list too, so later refreshes are ?since= deltas
+      await loadConversations();
     } catch (e) {
       console.error(e);
     }
   })();
 
+  // ---- live updates: /api/stream pushes message and inbox events (no polling) ----
+  let streamOpen = false;
+  let inboxRefreshTimer = null;
+
+  function refreshInboxSoon() {
+    // coalesce bursts of events into one inbox read
+    clearTimeout(inboxRefreshTimer);
+    inboxRefreshTimer = setTimeout(() => {
+      loadConversations().catch(console.error);
+    }, 200);
+  }
+
+  function isOpenThread(convId) {
+    return !modal.hidden && !threadView.hidden && String(convId) === String(currentConvId);
+  }
+
+  (function connectStream() {
+    if (!window.EventSource) return;
+
+    // EventSource reconnects by itself and resumes with Last-Event-ID
+    const es = new EventSource("/api/stream");
+    es.addEventListener("open", () => {
+      streamOpen = true;
+      // catch up on anything missed while disconnected (or before the first connect)
+      if (isOpenThread(currentConvId)) syncThread().catch(console.error);
+      refreshInboxSoon();
+    });
+    es.addEventListener("error", () => { streamOpen = false; });
+
+    es.addEventListener("message-created", (e) => {
+      const ev = JSON.parse(e.data);
+      if (isOpenThread(ev.conversation_id)) {
+        appendMessage(ev.message);
+        if (!ev.message.from_me) {
+          // the delta fetch also moves my read marker before the inbox refresh
+          syncThread().catch(console.error).finally(refreshInboxSoon);
+          return;
+        }
+      }
+      refreshInboxSoon();
+    });
+
+    es.addEventListener("message-deleted", (e) => {
+      const ev = JSON.parse(e.data);
+      if (isOpenThread(ev.conversation_id)) {
+        msgList.querySelector(`[data-msg-id="${ev.message_id}"]`)?.remove();
+      }
+      refreshInboxSoon();
+    });
+
+    es.addEventListener("conversation-unhidden", refreshInboxSoon);
+  })();
+
+  // no stream (unsupported or reconnecting): poll the open thread; idle polls are 304s
+  setInterval(() => {
+    if (!streamOpen && !document.hidden && isOpenThread(currentConvId)) {
+      syncThread().catch(console.error);
+    }
+  }, THREAD_POLL_MS);
+
   // ---- NEW: click "メッセージ" on a post => start/open conversation and jump to thread ----
   document.addEventListener("click", async (e) => {
     const btn = e.target.closest(".message-btn");
@@ -1044,6 +1302,7 @@ document.addEventListener("DOMContentLoaded", () => {
       currentConvId = data.conversation_id;
       threadTitle.textContent = otherUsername || data.other_username || "Chat";
       renderMessages(data.messages || []);
+      resetHistory(data);
       showThread();
 
       // NEW: make sure selection mode is off when jumping in
@@ -1197,8 +1456,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
 // =============== FEED VIDEO: STABLE AUTOPLAY ON SCROLL =====================
 document.addEventListener("DOMContentLoaded", () => {
-  const videos = Array.from(document.querySelectorAll(".post-media-video"));
-  if (!videos.length) return;
+  const videos = [];
 
   let audioUnlocked = false;
 
@@ -1210,15 +1468,6 @@ document.addEventListener("DOMContentLoaded", () => {
   // NEW: when a video is fullscreen (or PiP), lock autoplay to it
   let lockedVideo = null;
 
-  videos.forEach((v) => {
-    v.loop = true;
-    v.muted = true;
-    v.setAttribute("muted", "");
-    v.setAttribute("playsinline", "");
-    v.preload = "metadata";
-    ratioByVideo.set(v, 0);
-  });
-
   function pauseAllExcept(except) {
     videos.forEach((v) => {
       if (v !== except && !v.paused) v.pause();
@@ -1319,19 +1568,47 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   );
 
-  videos.forEach((v) => io.observe(v));
+  // videos can also arrive later via infinite scroll
+  function registerVideo(v) {
+    if (ratioByVideo.has(v)) return;
 
-  window.addEventListener("scroll", schedulePick, { passive: true });
-  window.addEventListener("resize", schedulePick);
+    v.loop = true;
+    v.muted = true;
+    v.setAttribute("muted", "");
+    v.setAttribute("playsinline", "");
+    v.preload = "metadata";
+    ratioByVideo.set(v, 0);
+    videos.push(v);
 
-  // ✅ NEW: if ANY video starts playing (user taps / fullscreen / etc), pause the rest
-  videos.forEach((v) => {
+    // ✅ NEW: if ANY video starts playing (user taps / fullscreen / etc), pause the rest
     v.addEventListener("play", () => {
       pauseAllExcept(v);
       current = v; // keep current in sync
     });
+
+    // ✅ NEW: iOS Safari fullscreen events
+    v.addEventListener("webkitbeginfullscreen", () => lockToVideo(v));
+    v.addEventListener("webkitendfullscreen", () => unlockVideo());
+
+    // ✅ Optional but nice: Picture-in-Picture locking (Chrome/Safari desktop)
+    v.addEventListener("enterpictureinpicture", () => lockToVideo(v));
+    v.addEventListener("leavepictureinpicture", () => unlockVideo());
+
+    io.observe(v);
+  }
+
+  document.querySelectorAll(".post-media-video").forEach(registerVideo);
+
+  document.addEventListener("feed:appended", (e) => {
+    (e.detail?.nodes || []).forEach((node) => {
+      node.querySelectorAll(".post-media-video").forEach(registerVideo);
+    });
+    schedulePick();
   });
 
+  window.addEventListener("scroll", schedulePick, { passive: true });
+  window.addEventListener("resize", schedulePick);
+
   // ✅ NEW: fullscreen locking (standard browsers)
   document.addEventListener("fullscreenchange", () => {
     const fsEl = document.fullscreenElement;
@@ -1342,18 +1619,6 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   });
 
-  // ✅ NEW: iOS Safari fullscreen events
-  videos.forEach((v) => {
-    v.addEventListener("webkitbeginfullscreen", () => lockToVideo(v));
-    v.addEventListener("webkitendfullscreen", () => unlockVideo());
-  });
-
-  // ✅ Optional but nice: Picture-in-Picture locking (Chrome/Safari desktop)
-  videos.forEach((v) => {
-    v.addEventListener("enterpictureinpicture", () => lockToVideo(v));
-    v.addEventListener("leavepictureinpicture", () => unlockVideo());
-  });
-
   // Unlock audio on first user gesture
   const unlock = () => {
     audioUnlocked = true;
@@ -1,5 +1,17 @@
 // profile.js
 
+// =============== MEDIA URL FALLBACK =====================
+// pages embed signed R2 URLs; if one has expired (long-open tab), go back to
+// the /r2/ redirect, which signs a fresh one
+document.addEventListener("error", (e) => {
+  const el = e.target;
+  const fallback = el?.dataset?.fallbackSrc;
+  if (!fallback || !fallback.startsWith("/r2/")) return;
+  delete el.dataset.fallbackSrc; // once per element
+  el.removeAttribute("srcset"); // WebP variants are signed too; use the original
+  el.src = fallback;
+}, true);
+
 document.addEventListener("DOMContentLoaded", () => {
   const profileIconLink = document.getElementById("profileIconLink");
   const profileMenu = document.getElementById("profileMenu");
@@ -107,6 +119,11 @@ document.addEventListener("DOMContentLoaded", () => {
     currentIcon.src = URL.createObjectURL(file);
   });
 
+  // new icon goes straight to R2 when possible (direct_upload.js)
+  window.directUpload?.bindForm(document.getElementById("editProfileForm"), [
+    { inputs: () => [iconInput], kind: "avatar", field: "icon_key" },
+  ]);
+
   // ---------------- DELETE POPUP ----------------
   const openDeletePopup = () => {
     if (!deletePopup) return;
@@ -197,34 +214,123 @@ document.addEventListener("DOMContentLoaded", () => {
     if (e.target === modal) close();
   });
 
+  // pages of { users, next_cursor }; the next one loads as the list scrolls to its end
+  const scrollBox = listEl.closest(".popup-content") || listEl;
+  let listType = null;
+  let nextCursor = null;
+  let loading = false;
+  let generation = 0;
+
+  function itemHtml(u) {
+    const label = u.is_following_by_me ? "フォロー中" : (u.follows_me ? "フォローバック" : "フォローする");
+    return `
+      <li class="follow-item">
+        <a class="follow-link" href="/user/${u.id}">
+          <img class="follow-avatar" src="${u.avatar || window.DEFAULT_AVATAR}" alt="" loading="lazy">
+          <span class="follow-text">
+            <span class="follow-name">${escapeHtml(u.username)}</span>
+            ${u.follows_me ? `<span class="follow-badge">フォローされています</span>` : ``}
+          </span>
+        </a>
+        ${
+          String(u.id) === String(userId)
+            ? ``
+            : `<button type="button" class="follow-toggle ${u.is_following_by_me ? "is-following" : ""}"
+                 data-user-id="${u.id}" data-follows-me="${u.follows_me ? "1" : ""}"
+                 aria-pressed="${u.is_following_by_me ? "true" : "false"}">${label}</button>`
+        }
+      </li>
+    `;
+  }
+
+  async function loadPage() {
+    if (loading || !listType) return;
+    loading = true;
+    const gen = generation;
+
+    try {
+      const base = listType === "followers"
+        ? `/api/users/${userId}/followers`
+        : `/api/users/${userId}/following`;
+      const url = nextCursor ? `${base}?cursor=${encodeURIComponent(nextCursor)}` : base;
+
+      const res = await fetch(url, { credentials: "same-origin" });
+      if (!res.ok || gen !== generation) return;
+
+      const data = await res.json();
+      if (gen !== generation) return;
+
+      const users = data.users || [];
+      nextCursor = data.next_cursor || null;
+      if (!users.length && !listEl.children.length) {
+        emptyEl.hidden = false;
+        emptyEl.textContent = "0";
+        return;
+      }
+      listEl.insertAdjacentHTML("beforeend", users.map(itemHtml).join(""));
+    } finally {
+      if (gen === generation) loading = false;
+    }
+
+    // a short first page may not fill the popup enough to scroll
+    if (gen === generation && nextCursor && scrollBox.scrollHeight <= scrollBox.clientHeight) {
+      await loadPage();
+    }
+  }
+
   async function load(type) {
+    generation += 1;
+    loading = false;
+    listType = type;
+    nextCursor = null;
+
     titleEl.textContent = type === "followers" ? "フォロワー" : "フォロー";
     listEl.innerHTML = "";
     emptyEl.hidden = true;
+    scrollBox.scrollTop = 0;
 
-    const url = type === "followers"
-      ? `/api/users/${userId}/followers`
-      : `/api/users/${userId}/following`;
-
-    const res = await fetch(url, { credentials: "same-origin" });
-    if (!res.ok) return;
+    await loadPage();
+  }
 
-    const data = await res.json();
-    if (!data.length) {
-      emptyEl.hidden = false;
-      emptyEl.textContent = "0";
-      return;
+  scrollBox.addEventListener("scroll", () => {
+    if (modal.hidden || !nextCursor) return;
+    if (scrollBox.scrollTop + scrollBox.clientHeight >= scrollBox.scrollHeight - 200) {
+      loadPage().catch(console.error);
     }
+  }, { passive: true });
 
-    listEl.innerHTML = data.map(u => `
-      <li class="follow-item">
-        <a class="follow-link" href="/user/${u.id}">
-          <img class="follow-avatar" src="${u.avatar || window.DEFAULT_AVATAR}" alt="">
-          <span class="follow-name">${escapeHtml(u.username)}</span>
-        </a>
-      </li>
-    `).join("");
-  }
+  listEl.addEventListener("click", async (e) => {
+    const btn = e.target.closest(".follow-toggle");
+    if (!btn || btn.disabled) return;
+    btn.disabled = true;
+
+    try {
+      const res = await fetch("/api/follow/toggle", {
+        method: "POST",
+        credentials: "same-origin",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ other_user_id: Number(btn.dataset.userId) }),
+      });
+      if (!res.ok) throw new Error("follow api error");
+      const data = await res.json();
+
+      const following = !!data.is_following;
+      btn.classList.toggle("is-following", following);
+      btn.setAttribute("aria-pressed", following ? "true" : "false");
+      btn.textContent = following ? "フォロー中" : (btn.dataset.followsMe ? "フォローバック" : "フォローする");
+
+      // this page is my own profile: keep my following count in step
+      const countEl = document.querySelector(".following-count");
+      if (countEl) {
+        const n = Number(countEl.textContent) || 0;
+        countEl.textContent = String(Math.max(0, n + (following ? 1 : -1)));
+      }
+    } catch (err) {
+      console.error(err);
+    } finally {
+      btn.disabled = false;
+    }
+  });
 
   followersBtn?.addEventListener("click", async () => {
     open();
@@ -269,6 +375,15 @@ document.addEventListener("DOMContentLoaded", () => {
 
   let previewUrls = [];
 
+  // picked files go straight to R2 when possible (direct_upload.js)
+  window.directUpload?.bindForm(document.getElementById("showcaseForm"), [
+    {
+      inputs: () => Array.from(uploadInputs?.querySelectorAll("input[type=file]") || []),
+      kind: "showcase",
+      field: "media_keys",
+    },
+  ]);
+
   const openPopup = () => {
     popup.hidden = false;
     document.body.classList.add("modal-open");
@@ -486,6 +601,14 @@ document.addEventListener("DOMContentLoaded", () => {
 
   let currentConvId = null;
 
+  // message history paging: latest page first, older pages on scroll-up
+  const scrollBox = msgList.closest(".chat-panel") || msgList;
+  let oldestMsgId = null;
+  let hasOlder = false;
+  let loadingOlder = false;
+  let newestMsgId = 0;
+  let threadEtag = null;
+
   // ---- NEW: conversation delete "select mode"
   let convSelectMode = false;
   const selectedConvIds = new Set();
@@ -672,28 +795,105 @@ document.addEventListener("DOMContentLoaded", () => {
       .join("");
   }
 
-  function renderMessages(messages) {
-    msgList.innerHTML = (messages || [])
-      .map((m) => {
-        const who = m.from_me ? `<div class="who">You</div>` : ``;
-  
-        return `
-          <li class="msg ${m.from_me ? "you" : ""}" data-msg-id="${m.id}">
-            <div>
-              <div class="bubble">
-                ${who}
-                <div class="body">${escapeHtml(m.body)}</div>
-              </div>
-            </div>
-          </li>
-        `;
-      })
-      .join("");
+  function messageHtml(m) {
+    const who = m.from_me ? `<div class="who">You</div>` : ``;
   
+    return `
+      <li class="msg ${m.from_me ? "you" : ""}" data-msg-id="${m.id}">
+        <div>
+          <div class="bubble">
+            ${who}
+            <div class="body">${escapeHtml(m.body)}</div>
+          </div>
+        </div>
+      </li>
+    `;
+  }
+
+  function renderMessages(messages) {
+    msgList.innerHTML = (messages || []).map(messageHtml).join("");
     scrollMessagesToBottom();
   }
 
+  function resetHistory(data) {
+    const msgs = data.messages || [];
+    oldestMsgId = msgs.length ? msgs[0].id : null;
+    hasOlder = !!data.has_more;
+    newestMsgId = msgs.length ? msgs[msgs.length - 1].id : 0;
+    threadEtag = null;
+  }
+
+  // open thread deltas: only messages after newestMsgId + deleted ids, 304 when idle
+  const THREAD_POLL_MS = 10000;
+  let syncingThread = null;
+
+  async function syncThread() {
+    if (!currentConvId) return;
+    if (syncingThread) return syncingThread;
+    const convId = currentConvId;
+
+    syncingThread = (async () => {
+      const res = await fetch(`/api/conversations/${convId}/messages?after_id=${newestMsgId}`, {
+        credentials: "same-origin",
+        // we send If-None-Match ourselves and want to see the 304
+        cache: "no-store",
+        headers: threadEtag ? { "If-None-Match": threadEtag } : {},
+      });
+      if (res.status === 304) return;
+      if (!res.ok) throw new Error("Failed to sync messages");
+      const data = await res.json();
+      if (convId !== currentConvId) return;
+
+      threadEtag = res.headers.get("ETag");
+      (data.deleted_ids || []).forEach((id) => {
+        msgList.querySelector(`[data-msg-id="${id}"]`)?.remove();
+      });
+      (data.messages || []).forEach(appendMessage);
+      if (data.has_newer) setTimeout(() => syncThread().catch(console.error), 0);
+    })().finally(() => {
+      syncingThread = null;
+    });
+    return syncingThread;
+  }
+
+  async function loadOlderMessages() {
+    if (loadingOlder || !hasOlder || !currentConvId || oldestMsgId == null) return;
+    loadingOlder = true;
+    const convId = currentConvId;
+
+    try {
+      const res = await fetch(`/api/conversations/${convId}/messages?before_id=${oldestMsgId}`, {
+        credentials: "same-origin",
+      });
+      if (!res.ok) throw new Error("Failed to load older messages");
+      const data = await res.json();
+      if (convId !== currentConvId) return;
+
+      const msgs = data.messages || [];
+      if (msgs.length) {
+        // keep the viewport on the message the user was reading
+        const prevHeight = scrollBox.scrollHeight;
+        msgList.insertAdjacentHTML("afterbegin", msgs.map(messageHtml).join(""));
+        scrollBox.scrollTop += scrollBox.scrollHeight - prevHeight;
+        oldestMsgId = msgs[0].id;
+      }
+      hasOlder = !!data.has_more;
+    } finally {
+      loadingOlder = false;
+    }
+  }
+
+  scrollBox.addEventListener("scroll", () => {
+    if (!threadView.hidden && scrollBox.scrollTop < 80) {
+      loadOlderMessages().catch(console.error);
+    }
+  }, { passive: true });
+
   function appendMessage(m) {
+    // the same message can arrive from the send response and from /api/stream
+    if (msgList.querySelector(`[data-msg-id="${m.id}"]`)) return;
+    newestMsgId = Math.max(newestMsgId, Number(m.id) || 0);
+
     const li = document.createElement("li");
     li.className = `msg ${m.from_me ? "you" : ""}`;
     li.dataset.msgId = m.id;
@@ -713,13 +913,52 @@ document.addEventListener("DOMContentLoaded", () => {
     scrollMessagesToBottom();
   }
 
-  async function loadConversations() {
+  // inbox: one full list, then only what changed since the last token
+  let inboxToken = null;
+  let inboxLoading = Promise.resolve();
+
+  function sortConversations(convs) {
+    // same order as the server: newest last message first, empty conversations last
+    return convs.sort((a, b) => String(b.last_created_at || "").localeCompare(String(a.last_created_at || "")));
+  }
+
+  function mergeConversations(convs, delta) {
+    const drop = new Set([...(delta.removed || []), ...(delta.conversations || []).map((c) => c.id)].map(String));
+    return sortConversations([
+      ...(delta.conversations || []),
+      ...(convs || []).filter((c) => !drop.has(String(c.id))),
+    ]);
+  }
+
+  async function fetchConversations() {
+    if (inboxToken !== null) {
+      const res = await fetch(`/api/conversations?since=${encodeURIComponent(inboxToken)}`, {
+        credentials: "same-origin",
+      });
+      if (res.ok) {
+        const delta = await res.json();
+        inboxToken = delta.token;
+        renderConversations(mergeConversations(lastRenderedConvs, delta));
+        return;
+      }
+      // bad/unknown token: start over with the full list
+      inboxToken = null;
+    }
+
     const res = await fetch("/api/conversations", { credentials: "same-origin" });
     if (!res.ok) throw new Error("Failed to load conversations");
     const convs = await res.json();
+    inboxToken = res.headers.get("X-Inbox-Token");
     renderConversations(convs);
   }
 
+  function loadConversations() {
+    // one at a time so each delta starts from the previous token
+    const run = inboxLoading.catch(() => {}).then(fetchConversations);
+    inboxLoading = run;
+    return run;
+  }
+
   async function openConversation(convId, otherName) {
     const res = await fetch(`/api/conversations/${convId}/messages`, { credentials: "same-origin" });
     if (!res.ok) throw new Error("Failed to load messages");
@@ -729,7 +968,9 @@ document.addEventListener("DOMContentLoaded", () => {
     threadTitle.textContent = otherName || data.other_username || "Chat";
 
     renderMessages(data.messages || []);
+    resetHistory(data);
     showThread();
+    threadEtag = res.headers.get("ETag");
 
     loadConversations().catch(console.error);
   }
@@ -744,7 +985,8 @@ document.addEventListener("DOMContentLoaded", () => {
     if (!res.ok) throw new Error("Failed to send message");
     const msg = await res.json();
     appendMessage(msg);
-    loadConversations().catch(console.error);
+    // the message-created event refreshes the inbox; without a stream do it here
+    if (!streamOpen) loadConversations().catch(console.error);
   }
 
   // Events
@@ -847,12 +1089,70 @@ document.addEventListener("DOMContentLoaded", () => {
   // Bootstrap unread dot on page load
   (async function bootstrapUnreadDot() {
     try {
-      const res = await fetch("/api/conversations", { credentials: "same-origin" });
-      if (!res.ok) return;
-      const convs = await res.json();
-      ensureLauncherDot(convs.some((c) => c.unread));
+      // renders the (hidden) list too, so later refreshes are ?since= deltas
+      await loadConversations();
     } catch (e) {
       console.error(e);
     }
   })();
+
+  // ---- live updates: /api/stream pushes message and inbox events (no polling) ----
+  let streamOpen = false;
+  let inboxRefreshTimer = null;
+
+  function refreshInboxSoon() {
+    // coalesce bursts of events into one inbox read
+    clearTimeout(inboxRefreshTimer);
+    inboxRefreshTimer = setTimeout(() => {
+      loadConversations().catch(console.error);
+    }, 200);
+  }
+
+  function isOpenThread(convId) {
+    return !modal.hidden && !threadView.hidden && String(convId) === String(currentConvId);
+  }
+
+  (function connectStream() {
+    if (!window.EventSource) return;
+
+    // EventSource reconnects by itself and resumes with Last-Event-ID
+    const es = new EventSource("/api/stream");
+    es.addEventListener("open", () => {
+      streamOpen = true;
+      // catch up on anything missed while disconnected (or before the first connect)
+      if (isOpenThread(currentConvId)) syncThread().catch(console.error);
+      refreshInboxSoon();
+    });
+    es.addEventListener("error", () => { streamOpen = false; });
+
+    es.addEventListener("message-created", (e) => {
+      const ev = JSON.parse(e.data);
+      if (isOpenThread(ev.conversation_id)) {
+        appendMessage(ev.message);
+        if (!ev.message.from_me) {
+          // the delta fetch also moves my read marker before the inbox refresh
+          syncThread().catch(console.error).finally(refreshInboxSoon);
+          return;
+        }
+      }
+      refreshInboxSoon();
+    });
+
+    es.addEventListener("message-deleted", (e) => {
+      const ev = JSON.parse(e.data);
+      if (isOpenThread(ev.conversation_id)) {
+        msgList.querySelector(`[data-msg-id="${ev.message_id}"]`)?.remove();
+      }
+      refreshInboxSoon();
+    });
+
+    es.addEventListener("conversation-unhidden", refreshInboxSoon);
+  })();
+
+  // no stream (unsupported or reconnecting): poll the open thread; idle polls are 304s
+  setInterval(() => {
+    if (!streamOpen && !document.hidden && isOpenThread(currentConvId)) {
+      syncThread().catch(console.error);
+    }
+  }, THREAD_POLL_MS);
 });
@@ -1,5 +1,17 @@
 // user_profile.js
 
+// =============== MEDIA URL FALLBACK =====================
+// pages embed signed R2 URLs; if one has expired (long-open tab), go back to
+// the /r2/ redirect, which signs a fresh one
+document.addEventListener("error", (e) => {
+  const el = e.target;
+  const fallback = el?.dataset?.fallbackSrc;
+  if (!fallback || !fallback.startsWith("/r2/")) return;
+  delete el.dataset.fallbackSrc; // once per element
+  el.removeAttribute("srcset"); // WebP variants are signed too; use the original
+  el.src = fallback;
+}, true);
+
 // ================== HEADER PROFILE MENU ==================
 document.addEventListener("DOMContentLoaded", () => {
   const profileIconLink = document.getElementById("profileIconLink");
@@ -117,6 +129,14 @@ document.addEventListener("DOMContentLoaded", () => {
 
   let currentConvId = null;
 
+  // message history paging: latest page first, older pages on scroll-up
+  const scrollBox = msgList.closest(".chat-panel") || msgList;
+  let oldestMsgId = null;
+  let hasOlder = false;
+  let loadingOlder = false;
+  let newestMsgId = 0;
+  let threadEtag = null;
+
   // conversation select-delete mode
   let convSelectMode = false;
   const selectedConvIds = new Set();
@@ -301,28 +321,105 @@ document.addEventListener("DOMContentLoaded", () => {
     }).join("");
   }
 
-  function renderMessages(messages) {
-    msgList.innerHTML = (messages || [])
-      .map((m) => {
-        const who = m.from_me ? `<div class="who">You</div>` : ``;
-  
-        return `
-          <li class="msg ${m.from_me ? "you" : ""}" data-msg-id="${m.id}">
-            <div>
-              <div class="bubble">
-                ${who}
-                <div class="body">${escapeHtml(m.body)}</div>
-              </div>
-            </div>
-          </li>
-        `;
-      })
-      .join("");
+  function messageHtml(m) {
+    const who = m.from_me ? `<div class="who">You</div>` : ``;
   
+    return `
+      <li class="msg ${m.from_me ? "you" : ""}" data-msg-id="${m.id}">
+        <div>
+          <div class="bubble">
+            ${who}
+            <div class="body">${escapeHtml(m.body)}</div>
+          </div>
+        </div>
+      </li>
+    `;
+  }
+
+  function renderMessages(messages) {
+    msgList.innerHTML = (messages || []).map(messageHtml).join("");
     scrollMessagesToBottom();
   }
 
+  function resetHistory(data) {
+    const msgs = data.messages || [];
+    oldestMsgId = msgs.length ? msgs[0].id : null;
+    hasOlder = !!data.has_more;
+    newestMsgId = msgs.length ? msgs[msgs.length - 1].id : 0;
+    threadEtag = null;
+  }
+
+  // open thread deltas: only messages after newestMsgId + deleted ids, 304 when idle
+  const THREAD_POLL_MS = 10000;
+  let syncingThread = null;
+
+  async function syncThread() {
+    if (!currentConvId) return;
+    if (syncingThread) return syncingThread;
+    const convId = currentConvId;
+
+    syncingThread = (async () => {
+      const res = await fetch(`/api/conversations/${convId}/messages?after_id=${newestMsgId}`, {
+        credentials: "same-origin",
+        // we send If-None-Match ourselves and want to see the 304
+        cache: "no-store",
+        headers: threadEtag ? { "If-None-Match": threadEtag } : {},
+      });
+      if (res.status === 304) return;
+      if (!res.ok) throw new Error("Failed to sync messages");
+      const data = await res.json();
+      if (convId !== currentConvId) return;
+
+      threadEtag = res.headers.get("ETag");
+      (data.deleted_ids || []).forEach((id) => {
+        msgList.querySelector(`[data-msg-id="${id}"]`)?.remove();
+      });
+      (data.messages || []).forEach(appendMessage);
+      if (data.has_newer) setTimeout(() => syncThread().catch(console.error), 0);
+    })().finally(() => {
+      syncingThread = null;
+    });
+    return syncingThread;
+  }
+
+  async function loadOlderMessages() {
+    if (loadingOlder || !hasOlder || !currentConvId || oldestMsgId == null) return;
+    loadingOlder = true;
+    const convId = currentConvId;
+
+    try {
+      const res = await fetch(`/api/conversations/${convId}/messages?before_id=${oldestMsgId}`, {
+        credentials: "same-origin",
+      });
+      if (!res.ok) throw new Error("Failed to load older messages");
+      const data = await res.json();
+      if (convId !== currentConvId) return;
+
+      const msgs = data.messages || [];
+      if (msgs.length) {
+        // keep the viewport on the message the user was reading
+        const prevHeight = scrollBox.scrollHeight;
+        msgList.insertAdjacentHTML("afterbegin", msgs.map(messageHtml).join(""));
+        scrollBox.scrollTop += scrollBox.scrollHeight - prevHeight;
+        oldestMsgId = msgs[0].id;
+      }
+      hasOlder = !!data.has_more;
+    } finally {
+      loadingOlder = false;
+    }
+  }
+
+  scrollBox.addEventListener("scroll", () => {
+    if (!threadView.hidden && scrollBox.scrollTop < 80) {
+      loadOlderMessages().catch(console.error);
+    }
+  }, { passive: true });
+
   function appendMessage(m) {
+    // the same message can arrive from the send response and from /api/stream
+    if (msgList.querySelector(`[data-msg-id="${m.id}"]`)) return;
+    newestMsgId = Math.max(newestMsgId, Number(m.id) || 0);
+
     const li = document.createElement("li");
     li.className = `msg ${m.from_me ? "you" : ""}`;
     li.dataset.msgId = m.id;
@@ -342,13 +439,52 @@ document.addEventListener("DOMContentLoaded", () => {
     scrollMessagesToBottom();
   }
 
-  async function loadConversations() {
+  // inbox: one full list, then only what changed since the last token
+  let inboxToken = null;
+  let inboxLoading = Promise.resolve();
+
+  function sortConversations(convs) {
+    // same order as the server: newest last message first, empty conversations last
+    return convs.sort((a, b) => String(b.last_created_at || "").localeCompare(String(a.last_created_at || "")));
+  }
+
+  function mergeConversations(convs, delta) {
+    const drop = new Set([...(delta.removed || []), ...(delta.conversations || []).map((c) => c.id)].map(String));
+    return sortConversations([
+      ...(delta.conversations || []),
+      ...(convs || []).filter((c) => !drop.has(String(c.id))),
+    ]);
+  }
+
+  async function fetchConversations() {
+    if (inboxToken !== null) {
+      const res = await fetch(`/api/conversations?since=${encodeURIComponent(inboxToken)}`, {
+        credentials: "same-origin",
+      });
+      if (res.ok) {
+        const delta = await res.json();
+        inboxToken = delta.token;
+        renderConversations(mergeConversations(lastRenderedConvs, delta));
+        return;
+      }
+      // bad/unknown token: start over with the full list
+      inboxToken = null;
+    }
+
     const res = await fetch("/api/conversations", { credentials: "same-origin" });
     if (!res.ok) throw new Error("Failed to load conversations");
     const convs = await res.json();
+    inboxToken = res.headers.get("X-Inbox-Token");
     renderConversations(convs);
   }
 
+  function loadConversations() {
+    // one at a time so each delta starts from the previous token
+    const run = inboxLoading.catch(() => {}).then(fetchConversations);
+    inboxLoading = run;
+    return run;
+  }
+
   async function openConversation(convId, otherName) {
     const res = await fetch(`/api/conversations/${convId}/messages`, { credentials: "same-origin" });
     if (!res.ok) throw new Error("Failed to load messages");
@@ -358,7 +494,9 @@ document.addEventListener("DOMContentLoaded", () => {
     threadTitle.textContent = otherName || data.other_username || "Chat";
 
     renderMessages(data.messages || []);
+    resetHistory(data);
     showThread();
+    threadEtag = res.headers.get("ETag");
 
     // opening marks read, refresh list
     loadConversations().catch(console.error);
@@ -374,7 +512,8 @@ document.addEventListener("DOMContentLoaded", () => {
     if (!res.ok) throw new Error("Failed to send message");
     const msg = await res.json();
     appendMessage(msg);
-    loadConversations().catch(console.error);
+    // the message-created event refreshes the inbox; without a stream do it here
+    if (!streamOpen) loadConversations().catch(console.error);
   }
 
   // events
@@ -474,15 +613,73 @@ document.addEventListener("DOMContentLoaded", () => {
   // unread dot on load
   (async function bootstrapUnreadDot() {
     try {
-      const res = await fetch("/api/conversations", { credentials: "same-origin" });
-      if (!res.ok) return;
-      const convs = await res.json();
-      ensureLauncherDot(convs.some(c => c.unread));
+      // renders the (hidden) list too, so later refreshes are ?since= deltas
+      await loadConversations();
     } catch (e) {
       console.error(e);
     }
   })();
 
+  // ---- live updates: /api/stream pushes message and inbox events (no polling) ----
+  let streamOpen = false;
+  let inboxRefreshTimer = null;
+
+  function refreshInboxSoon() {
+    // coalesce bursts of events into one inbox read
+    clearTimeout(inboxRefreshTimer);
+    inboxRefreshTimer = setTimeout(() => {
+      loadConversations().catch(console.error);
+    }, 200);
+  }
+
+  function isOpenThread(convId) {
+    return !modal.hidden && !threadView.hidden && String(convId) === String(currentConvId);
+  }
+
+  (function connectStream() {
+    if (!window.EventSource) return;
+
+    // EventSource reconnects by itself and resumes with Last-Event-ID
+    const es = new EventSource("/api/stream");
+    es.addEventListener("open", () => {
+      streamOpen = true;
+      // catch up on anything missed while disconnected (or before the first connect)
+      if (isOpenThread(currentConvId)) syncThread().catch(console.error);
+      refreshInboxSoon();
+    });
+    es.addEventListener("error", () => { streamOpen = false; });
+
+    es.addEventListener("message-created", (e) => {
+      const ev = JSON.parse(e.data);
+      if (isOpenThread(ev.conversation_id)) {
+        appendMessage(ev.message);
+        if (!ev.message.from_me) {
+          // the delta fetch also moves my read marker before the inbox refresh
+          syncThread().catch(console.error).finally(refreshInboxSoon);
+          return;
+        }
+      }
+      refreshInboxSoon();
+    });
+
+    es.addEventListener("message-deleted", (e) => {
+      const ev = JSON.parse(e.data);
+      if (isOpenThread(ev.conversation_id)) {
+        msgList.querySelector(`[data-msg-id="${ev.message_id}"]`)?.remove();
+      }
+      refreshInboxSoon();
+    });
+
+    es.addEventListener("conversation-unhidden", refreshInboxSoon);
+  })();
+
+  // no stream (unsupported or reconnecting): poll the open thread; idle polls are 304s
+  setInterval(() => {
+    if (!streamOpen && !document.hidden && isOpenThread(currentConvId)) {
+      syncThread().catch(console.error);
+    }
+  }, THREAD_POLL_MS);
+
   // ✅ UPDATED: Message button on user profile (opens chat directly with that user)
   const messageBtn = document.getElementById("messageBtn");
   if (messageBtn) {
@@ -512,6 +709,7 @@ document.addEventListener("DOMContentLoaded", () => {
         currentConvId = data.conversation_id;
         threadTitle.textContent = data.other_username || "Chat";
         renderMessages(data.messages || []);
+        resetHistory(data);
         showThread();
 
         // refresh list